@@ -0,0 +1,146 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from index_snapshot import corpus_version, ensure_version_table
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# Minimum cosine similarity between rewritten-query embeddings to reuse an answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "900"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+# How often lookups re-read the bents and products versions to drop answers other processes made stale
+ANSWER_CACHE_CHECK_SECONDS = float(os.getenv("ANSWER_CACHE_CHECK_SECONDS", "5"))
+
+
+class SemanticAnswerCache:
+    """
+    Stores finished chat answers keyed by the rewritten query's embedding.
+    A lookup returns the closest live entry if it clears the cosine threshold.
+
+    Cached answers embed both the bents corpus and the products table, so
+    every entry is tagged with their corpus versions. With a connection, the
+    versions are re-read at most every check_seconds, and entries from an
+    older version are dropped, whichever process made the change. Writers in
+    this process also call invalidate() so their own change shows at once.
+    """
+
+    def __init__(self, connection=None, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                 max_entries=ANSWER_CACHE_SIZE, check_seconds=ANSWER_CACHE_CHECK_SECONDS,
+                 tables=("bents", "products")):
+        self._connection = connection
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.check_seconds = check_seconds
+        self.tables = tables
+        self._lock = threading.Lock()
+        self._version_lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._live_version = None
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._entries = []
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0}
+
+    def lookup(self, query_embedding):
+        query = self._normalize(query_embedding)
+        if query is None:
+            return None
+        now = time.time()
+        version = self._corpus_version()
+        with self._lock:
+            self._expire(now)
+            self._drop_stale(version)
+            if not self._entries or self._vectors.shape[1] != len(query):
+                self._stats['misses'] += 1
+                return None
+            scores = self._vectors @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            return dict(self._entries[best]['payload'], similarity=float(scores[best]))
+
+    def store(self, query_embedding, payload):
+        vector = self._normalize(query_embedding)
+        if vector is None:
+            return
+        version = self._corpus_version()
+        with self._lock:
+            self._expire(time.time())
+            self._drop_stale(version)
+            if self._entries and self._vectors.shape[1] != len(vector):
+                return
+            self._entries.append({'payload': payload, 'created': time.time(), 'version': version})
+            vectors = vector[None, :] if not self._vectors.size else np.vstack([self._vectors, vector])
+            if len(self._entries) > self.max_entries:
+                drop = len(self._entries) - self.max_entries
+                self._entries = self._entries[drop:]
+                vectors = vectors[drop:]
+            self._vectors = vectors
+            self._stats['stores'] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = []
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['threshold'] = self.threshold
+        return stats
+
+    def _corpus_version(self):
+        """The versions of the cached tables, re-read at most every check_seconds by one thread at a time."""
+        if self._connection is None:
+            return None
+        if time.monotonic() - self._checked_at < self.check_seconds or not self._version_lock.acquire(blocking=False):
+            return self._version
+        try:
+            self._checked_at = time.monotonic()
+            ensure_version_table(self._connection)
+            with self._connection() as conn:
+                self._version = tuple(corpus_version(conn, table) for table in self.tables)
+        except Exception as e:
+            logging.error(f"Error checking the answer cache corpus version: {str(e)}")
+        finally:
+            self._version_lock.release()
+        return self._version
+
+    def _drop_stale(self, version):
+        # Call with self._lock held
+        if version == self._live_version:
+            return
+        keep = [i for i, entry in enumerate(self._entries) if entry['version'] == version]
+        if len(keep) < len(self._entries):
+            self._entries = [self._entries[i] for i in keep]
+            self._vectors = self._vectors[keep] if keep else np.zeros((0, 0), dtype=np.float32)
+            self._stats['invalidations'] += 1
+        self._live_version = version
+
+    def _expire(self, now):
+        # Entries are kept in insertion order, so expired ones form a prefix
+        live = 0
+        while live < len(self._entries) and now - self._entries[live]['created'] > self.ttl:
+            live += 1
+        if live:
+            self._entries = self._entries[live:]
+            self._vectors = self._vectors[live:] if self._entries else np.zeros((0, 0), dtype=np.float32)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
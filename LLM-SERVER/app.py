@@ -1,27 +1,42 @@
+import asyncio
+import io
 import os
 import uuid
 import re
 import logging
 from flask import Flask, render_template, request, jsonify, session, Response
 from werkzeug.utils import secure_filename
-from docx import Document
 from dotenv import load_dotenv
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain.chains import ConversationalRetrievalChain
 from langchain.schema import Document as LangchainDocument, BaseRetriever
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 import langsmith
 from flask_cors import CORS
-import psycopg2
 from psycopg2.extras import RealDictCursor
+import db_pool
 import base64
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-import time
-import json
-import numpy as np
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel, Field
+from retrieval_backends import get_retrieval_backend, cosine_similarity
+from lexical_index import HYBRID_CANDIDATES, RETRIEVAL_MODE, get_lexical_index, reciprocal_rank_fusion
+from ingest import (
+    build_chunk_rows, extract_metadata_from_text, extract_text_from_docx, ingest_transcript, split_transcript
+)
+from embedding_cache import embedding_cache
+from answer_cache import ANSWER_CACHE_ENABLED, SemanticAnswerCache
+from marker_parser import StreamingMarkerParser
+from description_service import DescriptionService
+from product_index import ProductIndex
+from pipeline import PreRetrieval
+from intent_classifier import IntentClassifier
+from stream_protocol import reply_frame, stream_encoder
+from context_packer import pack_context
+from history_manager import HistoryManager
+from index_snapshot import bump_version, ensure_version_table
+from job_queue import JobQueue
+from metrics import metered_stream, metered_tokens, metrics, stage, timed
 
 class LLMResponseError(Exception):
     pass
@@ -35,7 +50,8 @@ class LLMNoResponseError(LLMResponseError):
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": ["http://localhost:5173", "http://localhost:5002","https://bents-frontend-server.vercel.app","https://bents-backend-server.vercel.app"]}})
+CORS_ORIGINS = ["http://localhost:5173", "http://localhost:5002","https://bents-frontend-server.vercel.app","https://bents-backend-server.vercel.app"]
+CORS(app, resources={r"/*": {"origins": CORS_ORIGINS}})
 
 
 
@@ -104,64 +120,58 @@ os.environ["LANGCHAIN_PROJECT"] = "jason-json"
 # Initialize Langchain components
 embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
 llm = ChatOpenAI(openai_api_key=OPENAI_API_KEY, model="gpt-4o-2024-11-20", temperature=0)
+description_service = DescriptionService(llm)
+product_index = ProductIndex(db_pool.connection)
+answer_cache = SemanticAnswerCache(db_pool.connection)
+history_manager = HistoryManager(llm)
 
 logging.basicConfig(level=logging.DEBUG)
 
-def rewrite_query(query, chat_history=None):
-    """
-    Rewrites the user query to be more specific and searchable using LLM.
-    """
-    try:
-        # Create prompt that's compatible with the existing LLM setup
-        rewrite_prompt = f"""You are bent's woodworks assistant so question will be related to wood shop. Rewrites user query to make them more specific and searchable, taking into account the chat history if provided. Only return the rewritten query without any explanations.
+def build_rewrite_prompt(query, chat_history=None):
+    """chat_history is the compacted history as rendered by HistoryManager."""
+    return f"""You are bent's woodworks assistant so question will be related to wood shop. Rewrites user query to make them more specific and searchable, taking into account the chat history if provided. Only return the rewritten query without any explanations.
 
         Original query: {query}
         
-        Chat history: {json.dumps(chat_history) if chat_history else '[]'}
+        Chat history: {chat_history or '[]'}
         
         Rewritten query:"""
-        
-        # Use the existing LLM instance
-        response = llm.predict(rewrite_prompt)
-        
-        # Clean up the response
-        cleaned_response = response.replace("Rewritten query:", "").strip()
-        
-        # Add logging for debugging
-        logging.debug(f"Original query: {query}")
-        logging.debug(f"Rewritten query: {cleaned_response}")
-        
-        return cleaned_response if cleaned_response else query
+
+def clean_rewritten_query(query, response):
+    cleaned_response = response.replace("Rewritten query:", "").strip()
+    
+    # Add logging for debugging
+    logging.debug(f"Original query: {query}")
+    logging.debug(f"Rewritten query: {cleaned_response}")
+    
+    return cleaned_response if cleaned_response else query
+
+@timed('rewrite')
+def rewrite_query(query, history=None):
+    """
+    Rewrites the user query to be more specific and searchable using LLM.
+    """
+    try:
+        response = llm.predict(build_rewrite_prompt(query, history.render() if history else None))
+        return clean_rewritten_query(query, response)
         
     except Exception as e:
         logging.error(f"Error in query rewriting: {str(e)}", exc_info=True)
         return query  # Fallback to original query
 
+@timed('rewrite')
+async def arewrite_query(query, history=None):
+    try:
+        response = await llm.ainvoke(build_rewrite_prompt(query, await history.arender() if history else None))
+        return clean_rewritten_query(query, response.content)
+    except Exception as e:
+        logging.error(f"Error in query rewriting: {str(e)}", exc_info=True)
+        return query
+
 def get_matched_products(video_title):
     logging.debug(f"Attempting to get matched products for title: {video_title}")
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query = """
-                SELECT id, title, tags, link FROM products 
-                WHERE LOWER(tags) LIKE LOWER(%s)
-            """
-            search_term = f"%{video_title}%"
-            logging.debug(f"Executing SQL query: {query} with search term: {search_term}")
-            cur.execute(query, (search_term,))
-            matched_products = cur.fetchall()
-            logging.debug(f"Raw matched products from database: {matched_products}")
-        conn.close()
-
-        related_products = [
-            {
-                'id': product['id'],
-                'title': product['title'],
-                'tags': product['tags'].split(',') if product['tags'] else [],
-                'link': product['link']
-            } for product in matched_products
-        ]
-
+        related_products = product_index.match(video_title)
         logging.debug(f"Processed related products: {related_products}")
         return related_products
 
@@ -170,55 +180,29 @@ def get_matched_products(video_title):
         return []
 def verify_database():
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT COUNT(*) FROM products")
-            count = cur.fetchone()['count']
-            logging.info(f"Total products in database: {count}")
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT COUNT(*) FROM products")
+                count = cur.fetchone()['count']
+                logging.info(f"Total products in database: {count}")
             
-            cur.execute("SELECT title FROM products LIMIT 5")
-            sample_titles = [row['title'] for row in cur.fetchall()]
-            logging.info(f"Sample product titles: {sample_titles}")
-        conn.close()
+                cur.execute("SELECT title FROM products LIMIT 5")
+                sample_titles = [row['title'] for row in cur.fetchall()]
+                logging.info(f"Sample product titles: {sample_titles}")
         return True
     except Exception as e:
         logging.error(f"Database verification failed: {str(e)}", exc_info=True)
         return False
 
+def generate_description(context, timestamp, title=None):
+    return description_service.describe(context, timestamp, title)
+
 def process_answer(answer, urls, source_documents):
     def extract_context(text, marker_pos, window=150):
         start = max(0, marker_pos - window)
         end = min(len(text), marker_pos + window)
         return text[start:end].strip()
 
-    def generate_description(context, timestamp):
-        description_prompt = f"""
-        Given this woodworking video context at {timestamp}, create an extremely concise action phrase (max 6-8 words).
-
-        Context: {context}
-
-        Rules:
-        1. Start with an action verb
-        2. Name the specific tool/technique
-        3. Must be 6-8 words only
-        4. Focus on the single main action
-        5. Be direct and clear
-
-        Example formats:
-        - "Demonstrates table saw fence alignment technique"
-        - "Installs dust collection system components"
-        - "Shows track saw cutting method"
-
-        Description:"""
-
-        try:
-            enhanced_description = llm.predict(description_prompt).strip()
-            words = enhanced_description.split()[:8]
-            return ' '.join(words)
-        except Exception as e:
-            logging.error(f"Error generating description: {str(e)}")
-            return ' '.join(context.split()[:6])
-
     def process_markers(timestamp_match, title_match, source_index):
         timestamp = timestamp_match.group(1)
         title = title_match.group(1)
@@ -227,14 +211,13 @@ def process_answer(answer, urls, source_documents):
         
         timestamp_pos = timestamp_match.start()
         context = extract_context(answer, timestamp_pos)
-        enhanced_description = generate_description(context, timestamp)
         
         full_urls = [combine_url_and_timestamp(url, timestamp)] if url else []
         
         return {
             'links': full_urls,
             'timestamp': timestamp,
-            'description': enhanced_description,
+            'context': context,
             'video_title': title
         }
     
@@ -247,6 +230,14 @@ def process_answer(answer, urls, source_documents):
     for i, (ts_match, title_match) in enumerate(zip(timestamp_matches, title_matches)):
         timestamps_info.append(process_markers(ts_match, title_match, i))
     
+    # Describe every citation in one batched call
+    descriptions = description_service.describe_many([
+        {'title': entry['video_title'], 'timestamp': entry['timestamp'], 'context': entry['context']}
+        for entry in timestamps_info
+    ])
+    for entry, description in zip(timestamps_info, descriptions):
+        entry['description'] = description
+    
     video_dict = {
         str(i): {
             'urls': entry['links'],
@@ -281,46 +272,40 @@ def combine_url_and_timestamp(base_url, timestamp):
     else:
         return f"{base_url}?t={total_seconds}"
 
-def extract_text_from_docx(file):
-    doc = Document(file)
-    text = "\n".join([para.text for para in doc.paragraphs])
-    return text
-
-def extract_metadata_from_text(text):
-    title = text.split('\n')[0] if text else "Untitled Video"
-    return {"title": title}
-
 def upsert_transcript(transcript_text, metadata, index_name):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = text_splitter.split_text(transcript_text)
+    chunks = split_transcript(transcript_text)
     
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            for i, chunk in enumerate(chunks):
-                chunk_metadata = metadata.copy()
-                chunk_metadata['chunk_id'] = f"{metadata['title']}_chunk_{i}"
-                chunk_metadata['url'] = metadata.get('url', '')
-                chunk_metadata['title'] = metadata.get('title', 'Unknown Video')
-                
-                # Generate embeddings for the chunk
-                chunk_embedding = embeddings.embed_query(chunk)
-                
-                # Insert into bents table
-                cur.execute("""
-                    INSERT INTO bents (text, title, url, chunk_id, vector)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON CONFLICT (chunk_id) DO UPDATE
-                    SET text = EXCLUDED.text, vector = EXCLUDED.vector
-                """, (chunk, chunk_metadata['title'], chunk_metadata['url'], 
-                      chunk_metadata['chunk_id'], str(chunk_embedding)))
-        conn.commit()
+        report = ingest_transcript(build_chunk_rows(chunks, metadata), embeddings, "bents")
+        answer_cache.invalidate()
+        return report
     except Exception as e:
         logging.error(f"Error upserting transcript: {str(e)}")
         raise
-    finally:
-        if conn:
-            conn.close()
+
+def process_upload_job(job, progress):
+    """Ingestion job handler: parse the uploaded .docx from memory, then embed and write its chunks."""
+    transcript_text = extract_text_from_docx(io.BytesIO(job['payload']))
+    metadata = extract_metadata_from_text(transcript_text)
+    chunks = split_transcript(transcript_text)
+    report = ingest_transcript(build_chunk_rows(chunks, metadata), embeddings, "bents", progress=progress)
+    answer_cache.invalidate()
+    return dict(report, title=metadata['title'])
+
+# Uploads are processed off the request by a pool of worker threads
+ingest_jobs = JobQueue(db_pool.connection, process_upload_job)
+# Start the workers on import; off for tools that import the app without serving it
+INGEST_JOBS_AT_STARTUP = os.getenv("INGEST_JOBS_AT_STARTUP", "true").lower() == "true"
+
+def start_ingest_jobs():
+    """Start the ingestion workers so jobs queued before a restart are picked up without a new upload."""
+    try:
+        ingest_jobs.start()
+    except Exception as e:
+        logging.error(f"Error starting ingestion job workers: {str(e)}")
+
+if INGEST_JOBS_AT_STARTUP:
+    start_ingest_jobs()
 
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_exception_type(LLMResponseError))
 def retry_llm_call(qa_chain, query, chat_history):
@@ -340,66 +325,59 @@ def retry_llm_call(qa_chain, query, chat_history):
         logging.error(f"Unexpected error in LLM call: {str(e)}")
         raise LLMNoResponseError("LLM failed due to an unexpected error")
 
-def connect_to_db():
-    return psycopg2.connect(os.getenv("POSTGRES_URL"))
-
+@timed('embedding')
 def get_embeddings(query):
     try:
-        return embeddings.embed_query(query)
+        return embedding_cache.get_or_compute(query, embeddings.model, lambda: embeddings.embed_query(query))
     except Exception as e:
         logging.error(f"Error generating embeddings: {str(e)}")
         raise
 
-def cosine_similarity(v1, v2):
-    return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-
-def search_neon_db(query_embedding, table_name, top_k=5):
-    conn = None
+@timed('embedding')
+async def aget_embeddings(query):
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Query with table name as parameter
-            query = f"""
-                SELECT id, vector, text, title, url, chunk_id 
-                FROM {table_name}
-                WHERE vector IS NOT NULL
-            """
-            cur.execute(query)
-            rows = cur.fetchall()
-            
-            similarities = []
-            for row in rows:
-                try:
-                    vector_str = row['vector']
-                    vector_values = vector_str.strip('[]').split(',')
-                    vector = np.array([float(x.strip()) for x in vector_values])
-                    
-                    if len(vector) == len(query_embedding):
-                        similarity = cosine_similarity(query_embedding, vector)
-                        similarities.append((similarity, row))
-                except Exception as e:
-                    logging.error(f"Error processing vector for row {row['id']}: {str(e)}")
-                    continue
-            
-            similarities.sort(reverse=True, key=lambda x: x[0])
-            return [
-                {
-                    'id': row['id'],
-                    'text': row['text'],
-                    'title': row['title'],
-                    'url': row['url'],
-                    'chunk_id': row['chunk_id'],
-                    'similarity_score': float(sim)
-                }
-                for sim, row in similarities[:top_k]
-            ]
+        vector = embedding_cache.get(query, embeddings.model)
+        if vector is None:
+            vector = await embeddings.aembed_query(query)
+            embedding_cache.put(query, embeddings.model, vector)
+        return vector
+    except Exception as e:
+        logging.error(f"Error generating embeddings: {str(e)}")
+        raise
 
+def search_neon_db(query_embedding, table_name="bents", top_k=5, backend=None):
+    try:
+        return get_retrieval_backend(table_name, db_pool.connection, backend).search(query_embedding, top_k)
     except Exception as e:
         logging.error(f"Error in search_neon_db: {str(e)}")
         raise
-    finally:
-        if conn:
-            conn.close()
+
+async def asearch_neon_db(query_embedding, table_name="bents", top_k=5, backend=None):
+    try:
+        return await get_retrieval_backend(table_name, db_pool.connection, backend).asearch(query_embedding, top_k)
+    except Exception as e:
+        logging.error(f"Error in asearch_neon_db: {str(e)}")
+        raise
+
+def lexical_search(query, table_name="bents", top_k=5):
+    try:
+        return get_lexical_index(table_name, db_pool.connection).search(query, top_k)
+    except Exception as e:
+        logging.error(f"Error in lexical_search: {str(e)}")
+        raise
+
+def hybrid_search(query, query_embedding, table_name="bents", top_k=5, backend=None):
+    """Fuse the dense and BM25 rankings with reciprocal rank fusion."""
+    dense = search_neon_db(query_embedding, table_name, HYBRID_CANDIDATES, backend)
+    lexical = lexical_search(query, table_name, HYBRID_CANDIDATES)
+    return reciprocal_rank_fusion([dense, lexical], top_k)
+
+async def ahybrid_search(query, query_embedding, table_name="bents", top_k=5, backend=None):
+    dense, lexical = await asyncio.gather(
+        asearch_neon_db(query_embedding, table_name, HYBRID_CANDIDATES, backend),
+        asyncio.to_thread(lexical_search, query, table_name, HYBRID_CANDIDATES)
+    )
+    return reciprocal_rank_fusion([dense, lexical], top_k)
 
 def handle_query(query):
     query_embedding = get_embeddings(query)
@@ -409,14 +387,39 @@ def handle_query(query):
 # Update the custom retriever class
 class CustomNeonRetriever(BaseRetriever, BaseModel):
     table_name: str = Field(...)  # The ... means this field is required
+    backend: Optional[str] = None  # Retrieval backend name; defaults to RETRIEVAL_BACKEND
+    mode: str = RETRIEVAL_MODE  # 'dense', 'lexical' or 'hybrid'
     
     class Config:
         arbitrary_types_allowed = True  # This allows for non-pydantic types
     
     def get_relevant_documents(self, query: str) -> List[LangchainDocument]:
-        query_embedding = get_embeddings(query)
-        results = search_neon_db(query_embedding, self.table_name)
-        
+        query_embedding = get_embeddings(query) if self.mode != 'lexical' else None
+        return self.documents_for_query(query, query_embedding)
+
+    def documents_for_query(self, query, query_embedding) -> List[LangchainDocument]:
+        if self.mode == 'lexical':
+            return self._to_documents(lexical_search(query, self.table_name))
+        if self.mode == 'hybrid':
+            return self._to_documents(hybrid_search(query, query_embedding, self.table_name, backend=self.backend))
+        return self.documents_for_embedding(query_embedding)
+
+    async def adocuments_for_query(self, query, query_embedding) -> List[LangchainDocument]:
+        if self.mode == 'lexical':
+            return self._to_documents(await asyncio.to_thread(lexical_search, query, self.table_name))
+        if self.mode == 'hybrid':
+            return self._to_documents(await ahybrid_search(query, query_embedding, self.table_name, backend=self.backend))
+        return await self.adocuments_for_embedding(query_embedding)
+
+    def documents_for_embedding(self, query_embedding) -> List[LangchainDocument]:
+        results = search_neon_db(query_embedding, self.table_name, backend=self.backend)
+        return self._to_documents(results)
+
+    async def adocuments_for_embedding(self, query_embedding) -> List[LangchainDocument]:
+        results = await asearch_neon_db(query_embedding, self.table_name, backend=self.backend)
+        return self._to_documents(results)
+
+    def _to_documents(self, results) -> List[LangchainDocument]:
         documents = []
         for result in results:
             timestamp_match = re.search(r'\[Timestamp: ([^\]]+)\]', result['text'])
@@ -429,7 +432,8 @@ class CustomNeonRetriever(BaseRetriever, BaseModel):
                     'url': result['url'],
                     'timestamp': timestamp,
                     'chunk_id': result['chunk_id'],
-                    'source': self.table_name
+                    'source': self.table_name,
+                    'similarity_score': result.get('similarity_score')
                 }
             )
             documents.append(doc)
@@ -437,50 +441,24 @@ class CustomNeonRetriever(BaseRetriever, BaseModel):
         return documents
 
     async def aget_relevant_documents(self, query: str) -> List[LangchainDocument]:
-        return self.get_relevant_documents(query)
+        query_embedding = await aget_embeddings(query) if self.mode != 'lexical' else None
+        return await self.adocuments_for_query(query, query_embedding)
 
+@timed('products')
 def get_all_related_products(video_dict):
     """Get related products from all video titles in video_links"""
-    all_products = []  # Use list instead of set
-    seen_products = set()  # Use a set of IDs to track duplicates
-    
     # Extract unique video titles from video_dict
     video_titles = {entry['video_title'] for entry in video_dict.values()}
     
-    # Get products for each video title
-    for title in video_titles:
-        if title:
-            products = get_matched_products(title)
-            for product in products:
-                # Use product ID as unique identifier
-                if product['id'] not in seen_products:
-                    seen_products.add(product['id'])
-                    all_products.append(product)
-    
-    return all_products
-
-@app.route('/')
-@app.route('/database')
-def serve_spa():
-    return render_template('index.html')
-
-@app.route('/chat', methods=['POST'])
-def chat():
     try:
-        data = request.json
-        user_query = data['message'].strip()
-        chat_history = data.get('chat_history', [])
-
-        # Format chat history
-        formatted_history = []
-        for i in range(0, len(chat_history) - 1, 2):
-            human = chat_history[i]
-            ai = chat_history[i + 1] if i + 1 < len(chat_history) else ""
-            formatted_history.append((human, ai))
+        # One pass over the product index for all titles, deduplicated by product ID
+        return product_index.match_all(video_titles)
+    except Exception as e:
+        logging.error(f"Error in get_all_related_products: {str(e)}", exc_info=True)
+        return []
 
-        def generate_response():
-            # Check relevance first
-            relevance_check_prompt = f"""
+def build_relevance_prompt(user_query, formatted_history):
+    return f"""
             Given the following question or message and the chat history, determine if it is:
             1. A greeting or send-off like "thankyou" or "goodbye" or messages or casual messages like 'hey' or 'hello' or general conversation starter
             2. Related to woodworking, tools, home improvement, or the assistant's capabilities and also query about bents-woodworking youtube channel general questions.
@@ -502,103 +480,164 @@ def chat():
             
             Response (GREETING, RELEVANT, INAPPROPRIATE, or NOT RELEVANT):
             """
-            
-            relevance_response = llm.predict(relevance_check_prompt)
-            
-            if "GREETING" in relevance_response.upper():
-                greeting_prompt = f"""
+
+def classify_query(user_query, history):
+    """Classify a message as GREETING, RELEVANT, INAPPROPRIATE or NOT RELEVANT."""
+    return llm.predict(build_relevance_prompt(user_query, history.turns))
+
+async def aclassify_query(user_query, history):
+    response = await llm.ainvoke(build_relevance_prompt(user_query, history.turns))
+    return response.content
+
+def reply_type(relevance_response):
+    """Stream frame type for messages answered without retrieval, None for relevant ones."""
+    if "GREETING" in relevance_response.upper():
+        return 'greeting'
+    if "INAPPROPRIATE" in relevance_response.upper():
+        return 'inappropriate'
+    if "NOT RELEVANT" in relevance_response.upper():
+        return 'not_relevant'
+    return None
+
+REPLY_PROMPTS = {
+    'greeting': """
                 The following message is a greeting or casual message. Please provide a friendly and engaging response.
-                Message: {user_query}
+                Message: {query}
                 Response:
-                """
-                greeting_response = llm.predict(greeting_prompt)
-                yield json.dumps({
-                    'response': greeting_response,
-                    'type': 'greeting',
-                    'done': True
-                }) + '\n'
-                return
-
-            if "INAPPROPRIATE" in relevance_response.upper():
-                inappropriate_prompt = f"""
+                """,
+    'inappropriate': """
                 The following message is inappropriate or related to harmful activities. Please provide a polite and firm response indicating the limitations of the assistant.
-                Message: {user_query}
+                Message: {query}
                 Response:
-                """
-                inappropriate_response = llm.predict(inappropriate_prompt)
-                yield json.dumps({
-                    'response': inappropriate_response,
-                    'type': 'inappropriate',
-                    'done': True
-                }) + '\n'
-                return
-
-            if "NOT RELEVANT" in relevance_response.upper():
-                not_relevant_prompt = f"""
+                """,
+    'not_relevant': """
                 The following question is not directly related to woodworking or the assistant's expertise. Provide a direct response that:
                 1. Politely acknowledges the question
                 2. Explains that you are specialized in woodworking and Jason Bent's content
                 3. Asks them to rephrase their question to relate to woodworking topics
-                Question: {user_query}
+                Question: {query}
                 Response (start directly with your message):
                 """
-                not_relevant_response = llm.predict(not_relevant_prompt)
-                yield json.dumps({
-                    'response': not_relevant_response.strip(),
-                    'type': 'not_relevant',
-                    'done': True
-                }) + '\n'
+}
+
+def format_chat_history(chat_history):
+    """Pair the flat [human, ai, human, ai, ...] list from the client into turns."""
+    formatted_history = []
+    for i in range(0, len(chat_history) - 1, 2):
+        human = chat_history[i]
+        ai = chat_history[i + 1] if i + 1 < len(chat_history) else ""
+        formatted_history.append((human, ai))
+    return formatted_history
+
+generation_prompt = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(SYSTEM_INSTRUCTIONS),
+    HumanMessagePromptTemplate.from_template(
+        "Context: {context}\n\nChat History: {chat_history}\n\nQuestion: {question}\n\n"
+        "Instruction: Only use the provided context to generate the answer."
+    )
+])
+
+# Keyword rules and example centroids settle confident cases before classify_query
+intent_classifier = IntentClassifier(get_embeddings, classify_query, aclassify_query)
+
+@app.route('/')
+@app.route('/database')
+def serve_spa():
+    return render_template('index.html')
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    try:
+        data = request.json
+        user_query = data['message'].strip()
+        chat_history = data.get('chat_history', [])
+        encoder = stream_encoder(data.get('stream_version'))
+
+        # Format chat history; older turns are summarized to keep prompts a steady size
+        formatted_history = format_chat_history(chat_history)
+        history = history_manager.session(formatted_history)
+
+        def generate_response(timings):
+            greeting_response = intent_classifier.greeting_reply(user_query)
+            if greeting_response:
+                yield reply_frame('greeting', greeting_response, timings.breakdown())
                 return
 
-            # For relevant queries, proceed with normal processing
-            rewritten_query = rewrite_query(user_query, formatted_history)
+            # Classify and rewrite concurrently while retrieving speculatively on the raw query
             retriever = CustomNeonRetriever(table_name="bents")
-            
+            pre_retrieval = PreRetrieval(
+                user_query,
+                history,
+                classify=intent_classifier.classify,
+                rewrite=rewrite_query,
+                embed=get_embeddings,
+                retrieve=retriever.documents_for_query
+            )
+            relevance_response = pre_retrieval.relevance()
+            frame = reply_type(relevance_response)
+            if frame:
+                # No retrieval needed; drop the rewrite and speculative search
+                pre_retrieval.cancel()
+                with stage('reply'):
+                    reply = llm.predict(REPLY_PROMPTS[frame].format(query=user_query))
+                yield reply_frame(frame, reply, timings.breakdown())
+                return
+
+            # For relevant queries, proceed with normal processing
+            rewritten_query = pre_retrieval.rewritten_query()
+
+            # Replay a stored answer for a near-identical rewritten question
+            query_embedding = pre_retrieval.rewritten_embedding() if ANSWER_CACHE_ENABLED else None
+            cached = answer_cache.lookup(query_embedding) if query_embedding is not None else None
+            if cached:
+                logging.debug(f"Answer cache hit ({cached['similarity']:.3f}) for: {rewritten_query}")
+                yield from encoder.replay(cached, timings.breakdown())
+                return
+
             # Initialize response accumulator
             accumulated_response = ""
+            parser = StreamingMarkerParser(description_service, combine_url_and_timestamp)
+            related_products = []
             
-            # Create streaming prompt
-            prompt = ChatPromptTemplate.from_messages([
-                SystemMessagePromptTemplate.from_template(SYSTEM_INSTRUCTIONS),
-                HumanMessagePromptTemplate.from_template(
-                    "Context: {context}\n\nChat History: {chat_history}\n\nQuestion: {question}\n\n"
-                    "Instruction: Only use the provided context to generate the answer."
-                )
-            ])
-
-            # Get relevant documents
-            docs = retriever.get_relevant_documents(rewritten_query)
+            # Get relevant documents and fit them to the context token budget
+            docs = pre_retrieval.documents()
+            context, _ = pack_context(docs)
             
-            # Stream the response
-            for chunk in llm.stream(prompt.format(
-                context="\n\n".join(doc.page_content for doc in docs),
-                chat_history=formatted_history,
+            # Stream the response, timing the first token and the rest of the stream
+            for chunk in metered_tokens(llm.stream(generation_prompt.format(
+                context=context,
+                chat_history=history.render(),
                 question=rewritten_query
-            )):
+            ))):
                 chunk_text = chunk.content
                 accumulated_response += chunk_text
                 
-                # Process the accumulated response
-                processed_answer, video_dict = process_answer(accumulated_response, [], docs)
+                # Strip markers from the new text and pick up citations that just closed
+                clean_chunk, new_citations = parser.feed(chunk_text)
+                if new_citations:
+                    related_products = get_all_related_products(parser.video_dict)
                 
-                yield json.dumps({
-                    'response': chunk_text,
-                    'type': 'chunk',
-                    'done': False,
+                yield from encoder.chunk(clean_chunk, new_citations, parser.video_dict, related_products)
+
+            # Flush text held back at the end and resolve any remaining citations
+            clean_chunk, new_citations = parser.finish()
+            if new_citations:
+                related_products = get_all_related_products(parser.video_dict)
+            yield from encoder.tail(clean_chunk, new_citations, parser.video_dict, related_products)
+            processed_answer, video_dict = parser.clean_text, parser.video_dict
+
+            # Send final message with the per-stage timing breakdown
+            yield from encoder.final(accumulated_response, video_dict, related_products, timings.breakdown())
+
+            if query_embedding is not None and accumulated_response:
+                answer_cache.store(query_embedding, {
+                    'response': accumulated_response,
+                    'processed_answer': processed_answer,
                     'video_links': video_dict,
-                    'related_products': get_all_related_products(video_dict)
-                }) + '\n'
-
-            # Send final message
-            yield json.dumps({
-                'response': accumulated_response,
-                'type': 'final',
-                'done': True,
-                'video_links': video_dict,
-                'related_products': get_all_related_products(video_dict)
-            }) + '\n'
+                    'related_products': related_products
+                })
 
-        return Response(generate_response(), mimetype='text/event-stream')
+        return Response(metered_stream(generate_response), mimetype='text/event-stream')
 
     except Exception as e:
         logging.error(f"Error in chat route: {str(e)}", exc_info=True)
@@ -619,14 +658,34 @@ def get_user_data(user_id):
         logging.error(f"Error fetching user data: {str(e)}", exc_info=True)
         return jsonify({'error': 'An error occurred fetching user data'}), 500
 
+@app.route('/pool_stats', methods=['GET'])
+def pool_stats():
+    return jsonify(db_pool.get_pool().stats())
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'embeddings': embedding_cache.stats(),
+        'answers': answer_cache.stats(),
+        'descriptions': description_service.stats(),
+        'history_summaries': history_manager.stats()
+    })
+
+@app.route('/intent_stats', methods=['GET'])
+def intent_stats():
+    return jsonify(intent_classifier.stats())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/documents')
 def get_documents():
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM products")
-            documents = cur.fetchall()
-        conn.close()
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM products")
+                documents = cur.fetchall()
         return jsonify(documents)
     except Exception as e:
         print(f"Error in get_documents: {str(e)}")
@@ -636,15 +695,23 @@ def get_documents():
 def add_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "INSERT INTO products (title, tags, link) VALUES (%s, %s, %s) RETURNING id",
-                (data['title'], ','.join(data['tags']), data['link'])
-            )
-            product_id = cur.fetchone()['id']
-        conn.commit()
-        conn.close()
+        ensure_version_table(db_pool.connection)
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "INSERT INTO products (title, tags, link) VALUES (%s, %s, %s) RETURNING id",
+                    (data['title'], ','.join(data['tags']), data['link'])
+                )
+                product_id = cur.fetchone()['id']
+            bump_version(conn, 'products')
+            conn.commit()
+        product_index.upsert({
+            'id': product_id,
+            'title': data['title'],
+            'tags': ','.join(data['tags']),
+            'link': data['link']
+        })
+        answer_cache.invalidate()
         return jsonify({'success': True, 'product_id': product_id})
     except Exception as e:
         print(f"Error in add_document: {str(e)}")
@@ -654,11 +721,14 @@ def add_document():
 def delete_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM products WHERE id = %s", (data['id'],))
-        conn.commit()
-        conn.close()
+        ensure_version_table(db_pool.connection)
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM products WHERE id = %s", (data['id'],))
+            bump_version(conn, 'products')
+            conn.commit()
+        product_index.remove(data['id'])
+        answer_cache.invalidate()
         return jsonify({'success': True})
     except Exception as e:
         print(f"Error in delete_document: {str(e)}")
@@ -668,14 +738,22 @@ def delete_document():
 def update_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE products SET title = %s, tags = %s, link = %s WHERE id = %s",
-                (data['title'], ','.join(data['tags']), data['link'], data['id'])
-            )
-        conn.commit()
-        conn.close()
+        ensure_version_table(db_pool.connection)
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE products SET title = %s, tags = %s, link = %s WHERE id = %s",
+                    (data['title'], ','.join(data['tags']), data['link'], data['id'])
+                )
+            bump_version(conn, 'products')
+            conn.commit()
+        product_index.upsert({
+            'id': data['id'],
+            'title': data['title'],
+            'tags': ','.join(data['tags']),
+            'link': data['link']
+        })
+        answer_cache.invalidate()
         return jsonify({'success': True})
     except Exception as e:
         print(f"Error in update_document: {str(e)}")
@@ -690,11 +768,19 @@ def search():
         if not query:
             return jsonify({'error': 'Query is required'}), 400
 
-        # Generate embeddings for the query
-        query_embedding = get_embeddings(query)
-        
-        # Get raw results from database
-        results = search_neon_db(query_embedding)
+        # 'lexical' answers from the BM25 index alone, without an embedding call
+        mode = data.get('mode', 'dense')
+        if mode == 'lexical':
+            results = lexical_search(query)
+        else:
+            # Generate embeddings for the query
+            query_embedding = get_embeddings(query)
+            
+            # Get raw results from database
+            if mode == 'hybrid':
+                results = hybrid_search(query, query_embedding)
+            else:
+                results = search_neon_db(query_embedding)
         
         # Return only the database results
         return jsonify({
@@ -715,52 +801,34 @@ def upload_document():
     if file.filename == '':
         return jsonify({'success': False, 'message': 'No selected file'})
     
-    table_name = "bents"
-    
     if file and file.filename.endswith('.docx'):
         try:
-            filename = secure_filename(file.filename)
-            file_path = os.path.join('/tmp', filename)
-            file.save(file_path)
-            
-            transcript_text = extract_text_from_docx(file_path)
-            metadata = extract_metadata_from_text(transcript_text)
-            
-            # Generate embeddings for the text
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            chunks = text_splitter.split_text(transcript_text)
-            
-            conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-            with conn.cursor() as cur:
-                for i, chunk in enumerate(chunks):
-                    chunk_embedding = embeddings.embed_query(chunk)
-                    chunk_id = f"{metadata['title']}_chunk_{i}"
-                    
-                    cur.execute(f"""
-                        INSERT INTO {table_name} (text, title, url, chunk_id, vector)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (chunk_id) DO UPDATE
-                        SET text = EXCLUDED.text, vector = EXCLUDED.vector
-                    """, (
-                        chunk,
-                        metadata.get('title', 'Unknown Video'),
-                        metadata.get('url', ''),
-                        chunk_id,
-                        str(chunk_embedding)
-                    ))
-            
-            conn.commit()
-            conn.close()
-            os.remove(file_path)
-            
-            return jsonify({'success': True, 'message': 'File uploaded and processed successfully'})
+            # Queue the upload straight from memory; poll /jobs/<job_id> for progress
+            job_id = ingest_jobs.enqueue(secure_filename(file.filename), file.read())
+            return jsonify({
+                'success': True,
+                'message': 'File uploaded and queued for processing',
+                'job_id': job_id,
+                'status_url': f'/jobs/{job_id}'
+            }), 202
             
         except Exception as e:
-            logging.error(f"Error processing document: {str(e)}")
-            return jsonify({'success': False, 'message': f'Error processing document: {str(e)}'})
+            logging.error(f"Error queueing document: {str(e)}")
+            return jsonify({'success': False, 'message': f'Error queueing document: {str(e)}'})
     else:
         return jsonify({'success': False, 'message': 'Invalid file format'})
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        job = ingest_jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+    except Exception as e:
+        logging.error(f"Error fetching job {job_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 if __name__ == '__main__':
     verify_database()
     app.run(debug=True, port=5000)
@@ -0,0 +1,148 @@
+"""
+Async serving mode. /chat runs on the event loop with the async OpenAI and
+asyncpg clients, so a stream waiting on the model holds no worker thread;
+every other route is the Flask app, mounted as WSGI.
+
+    uvicorn asgi_app:app --port 5000
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Mount, Route, request_response
+
+import async_db
+from app import (
+    ANSWER_CACHE_ENABLED, CORS_ORIGINS, INGEST_JOBS_AT_STARTUP, REPLY_PROMPTS, CustomNeonRetriever, aget_embeddings,
+    answer_cache, app as flask_app, arewrite_query, combine_url_and_timestamp, description_service,
+    format_chat_history, generation_prompt, get_all_related_products, history_manager, intent_classifier, llm,
+    reply_type, start_ingest_jobs
+)
+from marker_parser import StreamingMarkerParser
+from metrics import ametered_stream, ametered_tokens, stage
+from context_packer import pack_context
+from pipeline import AsyncPreRetrieval
+from stream_protocol import reply_frame, stream_encoder
+
+
+async def generate_response(user_query, history, encoder, timings):
+    """The Flask generate_response flow on the event loop; emits the same frames."""
+    greeting_response = intent_classifier.greeting_reply(user_query)
+    if greeting_response:
+        yield reply_frame('greeting', greeting_response, timings.breakdown())
+        return
+
+    retriever = CustomNeonRetriever(table_name="bents")
+    pre_retrieval = AsyncPreRetrieval(
+        user_query,
+        history,
+        classify=intent_classifier.aclassify,
+        rewrite=arewrite_query,
+        embed=aget_embeddings,
+        retrieve=retriever.adocuments_for_query
+    )
+    relevance_response = await pre_retrieval.relevance()
+    frame = reply_type(relevance_response)
+    if frame:
+        pre_retrieval.cancel()
+        with stage('reply'):
+            response = await llm.ainvoke(REPLY_PROMPTS[frame].format(query=user_query))
+        yield reply_frame(frame, response.content, timings.breakdown())
+        return
+
+    rewritten_query = await pre_retrieval.rewritten_query()
+
+    query_embedding = await pre_retrieval.rewritten_embedding() if ANSWER_CACHE_ENABLED else None
+    # Lookups re-read the corpus versions from Postgres every few seconds, so keep them off the event loop
+    cached = await asyncio.to_thread(answer_cache.lookup, query_embedding) if query_embedding is not None else None
+    if cached:
+        logging.debug(f"Answer cache hit ({cached['similarity']:.3f}) for: {rewritten_query}")
+        for line in encoder.replay(cached, timings.breakdown()):
+            yield line
+        return
+
+    accumulated_response = ""
+    parser = StreamingMarkerParser(description_service, combine_url_and_timestamp)
+    related_products = []
+
+    docs = await pre_retrieval.documents()
+    context, _ = pack_context(docs)
+
+    async for chunk in ametered_tokens(llm.astream(generation_prompt.format(
+        context=context,
+        chat_history=await history.arender(),
+        question=rewritten_query
+    ))):
+        chunk_text = chunk.content
+        accumulated_response += chunk_text
+
+        clean_chunk, new_citations = parser.feed(chunk_text)
+        if new_citations:
+            # The product index may reload from the database, so keep it off the loop
+            related_products = await asyncio.to_thread(get_all_related_products, parser.video_dict)
+
+        for line in encoder.chunk(clean_chunk, new_citations, parser.video_dict, related_products):
+            yield line
+
+    clean_chunk, new_citations = await parser.afinish()
+    if new_citations:
+        related_products = await asyncio.to_thread(get_all_related_products, parser.video_dict)
+    for line in encoder.tail(clean_chunk, new_citations, parser.video_dict, related_products):
+        yield line
+    processed_answer, video_dict = parser.clean_text, parser.video_dict
+
+    for line in encoder.final(accumulated_response, video_dict, related_products, timings.breakdown()):
+        yield line
+
+    if query_embedding is not None and accumulated_response:
+        await asyncio.to_thread(answer_cache.store, query_embedding, {
+            'response': accumulated_response,
+            'processed_answer': processed_answer,
+            'video_links': video_dict,
+            'related_products': related_products
+        })
+
+
+async def chat(request):
+    if request.method != 'POST':
+        return PlainTextResponse('Method Not Allowed', status_code=405)
+    try:
+        data = await request.json()
+        user_query = data['message'].strip()
+        history = history_manager.session(format_chat_history(data.get('chat_history', [])))
+        encoder = stream_encoder(data.get('stream_version'))
+        return StreamingResponse(ametered_stream(generate_response, user_query, history, encoder),
+                                 media_type='text/event-stream')
+    except Exception as e:
+        logging.error(f"Error in chat route: {str(e)}", exc_info=True)
+        return JSONResponse({'error': 'An error occurred processing your request'}, status_code=500)
+
+
+async def async_pool_stats(request):
+    return JSONResponse(async_db.stats())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Importing app already started the workers; this retries if the database was down then
+    if INGEST_JOBS_AT_STARTUP:
+        await asyncio.to_thread(start_ingest_jobs)
+    yield
+    await async_db.close()
+
+
+app = Starlette(
+    routes=[
+        # CORS for the Flask routes comes from flask-cors; only the native routes need it here
+        Route('/chat', CORSMiddleware(
+            request_response(chat), allow_origins=CORS_ORIGINS, allow_methods=['POST'], allow_headers=['*']
+        )),
+        Route('/async_pool_stats', async_pool_stats),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,58 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+try:
+    import asyncpg
+except ImportError:  # Only needed by the async server
+    asyncpg = None
+
+from db_pool import DB_POOL_MAX, DB_POOL_MIN, DB_POOL_TIMEOUT
+
+_pool = None
+_pool_lock = None
+
+
+async def get_pool():
+    """The event loop's asyncpg pool, sized like the psycopg2 pool in db_pool."""
+    global _pool, _pool_lock
+    if asyncpg is None:
+        raise RuntimeError("asyncpg is required for the async server (pip install asyncpg)")
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                os.getenv("POSTGRES_URL"),
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX,
+                # Neon's pooler runs in transaction mode, which cannot use prepared statements
+                statement_cache_size=0
+            )
+        return _pool
+
+
+@asynccontextmanager
+async def connection():
+    """Check out a connection from the shared async pool."""
+    pool = await get_pool()
+    async with pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+        yield conn
+
+
+def stats():
+    if _pool is None:
+        return {'open': 0, 'idle': 0, 'min_size': DB_POOL_MIN, 'max_size': DB_POOL_MAX}
+    return {
+        'open': _pool.get_size(),
+        'idle': _pool.get_idle_size(),
+        'min_size': _pool.get_min_size(),
+        'max_size': _pool.get_max_size()
+    }
+
+
+async def close():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
@@ -0,0 +1,428 @@
+"""
+Offline micro-benchmarks for the per-request hot paths: retrieval
+(search_neon_db per backend, BM25), cosine_similarity, process_answer and the
+streaming marker parser, combine_url_and_timestamp, get_all_related_products
+and transcript chunking.
+
+Nothing touches the network. Embeddings are deterministic fakes, the bents
+and products tables are synthetic and served from a SQLite file standing in
+for Postgres, and answers are generated with many citation markers.
+
+    python benchmark.py --sizes 1000,10000,100000 --output bench_results/run.json
+    python benchmark.py --compare bench_results/before.json bench_results/after.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# app.py builds its OpenAI clients at import; none of them are called here
+os.environ.setdefault("OPENAI_API_KEY", "benchmark-offline")
+os.environ.setdefault("LANGSMITH_API_KEY", "benchmark-offline")
+os.environ.setdefault("DESCRIPTION_MODE", "extractive")
+os.environ.setdefault("INTENT_FAST_PATH", "false")
+# No ingestion workers polling the job table while measuring
+os.environ.setdefault("INGEST_JOBS_AT_STARTUP", "false")
+
+import numpy as np
+
+import app
+import lexical_index
+import retrieval_backends
+import vector_index
+from ingest import split_transcript
+from lexical_index import BM25Index
+from marker_parser import StreamingMarkerParser
+from product_index import ProductIndex
+from vector_index import VECTOR_STORAGE, VectorIndex, encode_vector, vector_column
+
+WORDS = (
+    "saw blade fence sled router table jig clamp glue board plywood walnut maple oak sanding finish "
+    "domino festool track cut miter dado rabbet joint drawer cabinet bench vise chisel plane dust "
+    "collector hose cart storage cleat french wall shop layout outfeed crosscut rip kerf square"
+).split()
+TOOLS = ["Festool Domino", "TS-55 Track Saw", "MFT Table", "Router Lift", "Dust Collector", "Miter Saw Station",
+         "Crosscut Sled", "Drill Press", "Random Orbit Sander", "Bandsaw", "Planer", "Jointer"]
+
+
+def fake_embedding(text, dimension):
+    """Deterministic unit vector for a text, standing in for the OpenAI embedding."""
+    seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class SyntheticCorpus:
+    """
+    Chunks grouped into videos. Each video has a topic direction and its
+    chunks scatter around it, so queries near a topic have real neighbours.
+    """
+
+    def __init__(self, size, dimension, chunks_per_video=40, seed=7):
+        self.size = size
+        self.dimension = dimension
+        self.rng = np.random.default_rng(seed)
+        self.videos = max(1, size // chunks_per_video)
+        self.topics = self._unit(self.rng.standard_normal((self.videos, dimension), dtype=np.float32))
+        self.titles = [f"{TOOLS[v % len(TOOLS)]} Build Part {v}" for v in range(self.videos)]
+        self.urls = [f"https://www.youtube.com/watch?v=bench{v:07d}" for v in range(self.videos)]
+        self.chunks_per_video = chunks_per_video
+
+    @staticmethod
+    def _unit(matrix):
+        return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    def video_of(self, i):
+        return min(i // self.chunks_per_video, self.videos - 1)
+
+    def rows(self, batch=5000):
+        words = np.array(WORDS)
+        for start in range(0, self.size, batch):
+            count = min(batch, self.size - start)
+            videos = np.array([self.video_of(i) for i in range(start, start + count)])
+            noise = self.rng.standard_normal((count, self.dimension), dtype=np.float32)
+            vectors = self._unit(self.topics[videos] + 0.6 * noise / np.sqrt(self.dimension) * 8)
+            for offset in range(count):
+                i = start + offset
+                video = videos[offset]
+                text = f"[Timestamp: 00:{(i % 60):02d}:{(i * 7) % 60:02d}] " + ' '.join(
+                    self.rng.choice(words, 150))
+                position = i - video * self.chunks_per_video
+                yield (i + 1, text, self.titles[video], self.urls[video],
+                       f"{self.titles[video]}_chunk_{position}", vectors[offset])
+
+    def query(self, rng):
+        video = int(rng.integers(self.videos))
+        noise = rng.standard_normal(self.dimension).astype(np.float32)
+        return self._unit((self.topics[video] + 0.8 * noise / np.sqrt(self.dimension) * 8)[None, :])[0]
+
+
+class SQLiteCursor:
+    def __init__(self, conn, as_dicts):
+        self._cursor = conn.cursor()
+        self._as_dicts = as_dicts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(sql.replace('%s', '?'), params)
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        if not self._as_dicts:
+            return rows
+        names = [column[0] for column in self._cursor.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+
+class SQLiteConnection:
+    """The slice of the psycopg2 connection API the indexes use, over sqlite3."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, cursor_factory=None):
+        return SQLiteCursor(self._conn, cursor_factory is not None)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+
+def build_database(path, corpus, products):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE bents (id INTEGER PRIMARY KEY, text TEXT, title TEXT, url TEXT,
+                            chunk_id TEXT UNIQUE, vector TEXT, vector_bin BLOB)
+    """)
+    # Product ids are UUID strings, as the Express server writes them
+    conn.execute("CREATE TABLE products (id TEXT PRIMARY KEY, title TEXT, tags TEXT, link TEXT)")
+    # The indexes read corpus versions on load; the table is only created once per process
+    conn.execute("CREATE TABLE corpus_versions (table_name TEXT PRIMARY KEY, version BIGINT NOT NULL)")
+    column = vector_column()
+    conn.executemany(
+        f"INSERT INTO bents (id, text, title, url, chunk_id, {column}) VALUES (?, ?, ?, ?, ?, ?)",
+        ((row_id, text, title, url, chunk_id, encode_vector(vector))
+         for row_id, text, title, url, chunk_id, vector in corpus.rows())
+    )
+    rng = random.Random(11)
+    conn.executemany("INSERT INTO products (id, title, tags, link) VALUES (?, ?, ?, ?)", [
+        (str(uuid.UUID(int=rng.getrandbits(128), version=4)), f"Product {i}",
+         ','.join(rng.sample(corpus.titles, min(3, len(corpus.titles))) + rng.sample(WORDS, 3)),
+         f"https://example.com/product/{i}")
+        for i in range(products)
+    ])
+    conn.commit()
+    conn.close()
+
+
+def use_database(path):
+    """Point the retrieval registries and the product index at the stand-in database."""
+    shared = SQLiteConnection(path)
+
+    @contextmanager
+    def connection():
+        yield shared
+
+    with retrieval_backends._backends_lock:
+        retrieval_backends._backends.clear()
+        for name in ('memory', 'scan'):
+            retrieval_backends._backends[(name, 'bents')] = retrieval_backends.BACKENDS[name]('bents', connection)
+    with vector_index._indexes_lock:
+        vector_index._indexes.clear()
+        vector_index._indexes['bents'] = VectorIndex('bents', connection)
+    with lexical_index._indexes_lock:
+        lexical_index._indexes.clear()
+        lexical_index._indexes['bents'] = BM25Index('bents', connection)
+    app.product_index = ProductIndex(connection)
+    return connection
+
+
+def synthetic_answer(corpus, citations, rng):
+    sections = []
+    for i in range(citations):
+        video = rng.randrange(corpus.videos)
+        bullet = ' '.join(rng.choice(WORDS) for _ in range(40))
+        sections.append(
+            f"### {i + 1}. **{corpus.titles[video]} technique**\n"
+            f"    - {bullet.capitalize()}. Set the fence and check it against the blade before cutting. "
+            f"{{timestamp:{rng.randrange(60):02d}:{rng.randrange(60):02d}}}"
+            f"{{title:{corpus.titles[video]}}}{{url:{corpus.urls[video]}}} [video {i + 1}]\n"
+        )
+    return "Here is how Jason Bent approaches it.\n\n" + "\n".join(sections)
+
+
+def synthetic_transcript(rng, minutes=45):
+    lines = [TOOLS[rng.randrange(len(TOOLS))] + " Build"]
+    for second in range(0, minutes * 60, 20):
+        words = ' '.join(rng.choice(WORDS) for _ in range(45))
+        lines.append(f"[Timestamp: {second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}] {words}.")
+    return "\n".join(lines)
+
+
+def tokens(text, size=4):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def measure(name, size, fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    # Peak memory is measured on a separate call so tracing does not skew the timings
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    result = {
+        'function': name,
+        'size': size,
+        'iterations': iterations,
+        'mean_ms': statistics.fmean(latencies),
+        'p50_ms': latencies[len(latencies) // 2],
+        'p90_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))],
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        'max_ms': latencies[-1],
+        'ops_per_sec': iterations / elapsed if elapsed else 0.0,
+        'peak_memory_kb': peak / 1024
+    }
+    print(f"{name:<42} {str(size):>8} p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  "
+          f"{result['ops_per_sec']:10.1f} ops/s  peak {result['peak_memory_kb']:10.1f} KB", flush=True)
+    return result
+
+
+def once(name, size, fn):
+    """Time a one-off step (index loads) and its peak memory."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn()
+    elapsed = (time.perf_counter() - started) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<42} {str(size):>8} once {elapsed:9.1f} ms  peak {peak / 1024:10.1f} KB", flush=True)
+    return {'function': name, 'size': size, 'iterations': 1, 'mean_ms': elapsed, 'p50_ms': elapsed,
+            'p90_ms': elapsed, 'p99_ms': elapsed, 'max_ms': elapsed, 'ops_per_sec': 1000 / elapsed if elapsed else 0.0,
+            'peak_memory_kb': peak / 1024}
+
+
+def bench_retrieval(corpus, iterations, scan_limit, top_k):
+    results = []
+    rng = np.random.default_rng(3)
+    queries = [corpus.query(rng) for _ in range(64)]
+    words = random.Random(5)
+    text_queries = [f"{TOOLS[words.randrange(len(TOOLS))]} {words.choice(WORDS)}" for _ in range(64)]
+    counter = iter(range(10 ** 12))
+
+    def next_query():
+        return queries[next(counter) % len(queries)]
+
+    def next_text():
+        return text_queries[next(counter) % len(text_queries)]
+
+    size = corpus.size
+    results.append(once('vector_index.load', size, vector_index._indexes['bents'].load))
+    results.append(once('bm25_index.load', size, lexical_index._indexes['bents'].load))
+    results.append(measure('search_neon_db[memory]', size,
+                           lambda: app.search_neon_db(next_query(), top_k=top_k, backend='memory'), iterations))
+    if size <= scan_limit:
+        results.append(measure('search_neon_db[scan]', size,
+                               lambda: app.search_neon_db(next_query(), top_k=top_k, backend='scan'),
+                               max(3, iterations // 20)))
+    with tempfile.TemporaryDirectory() as snapshots:
+        connection = vector_index._indexes['bents']._connection
+        building = VectorIndex('bents', connection, snapshot_dir=snapshots, quantization='int8')
+        results.append(once('vector_index.load[int8 build]', size, building.load))
+        # A second worker maps the snapshot the first one wrote
+        quantized = VectorIndex('bents', connection, snapshot_dir=snapshots, quantization='int8')
+        results.append(once('vector_index.load[int8 mapped]', size, quantized.load))
+        results.append(measure('vector_index.search[int8]', size, lambda: quantized.search(next_query(), top_k),
+                               iterations))
+    routed = vector_index._indexes['bents']
+    results.append(once('video_router.build', size, routed.video_router))
+    results.append(measure('vector_index.search[nprobe=8]', size,
+                           lambda: routed.search(next_query(), top_k, nprobe=8), iterations))
+    results.append(measure('lexical_search', size, lambda: app.lexical_search(next_text(), top_k=top_k), iterations))
+    results.append(measure('hybrid_search', size,
+                           lambda: app.hybrid_search(next_text(), next_query(), top_k=top_k, backend='memory'),
+                           iterations))
+    return results
+
+
+def bench_post_processing(corpus, iterations, citations):
+    rng = random.Random(17)
+    results = []
+    dimension = corpus.dimension
+    a, b = fake_embedding("a", dimension), fake_embedding("b", dimension)
+    results.append(measure('cosine_similarity', dimension, lambda: app.cosine_similarity(a, b), iterations * 10))
+
+    stamps = [f"{rng.randrange(3)}:{rng.randrange(60):02d}:{rng.randrange(60):02d}" for _ in range(100)]
+    urls = [corpus.urls[rng.randrange(corpus.videos)] for _ in range(100)]
+    pairs = iter(range(10 ** 12))
+
+    def combine():
+        i = next(pairs) % 100
+        return app.combine_url_and_timestamp(urls[i], stamps[i])
+    results.append(measure('combine_url_and_timestamp', 1, combine, iterations * 10))
+
+    answer = synthetic_answer(corpus, citations, rng)
+    results.append(measure('process_answer', citations, lambda: app.process_answer(answer, [], []), iterations))
+
+    pieces = tokens(answer)
+
+    def stream():
+        parser = StreamingMarkerParser(app.description_service, app.combine_url_and_timestamp)
+        for piece in pieces:
+            parser.feed(piece)
+        return parser.finish()
+    results.append(measure('StreamingMarkerParser', citations, stream, iterations))
+
+    _, video_dict = app.process_answer(answer, [], [])
+    app.product_index.load()
+    results.append(measure('get_all_related_products', citations,
+                           lambda: app.get_all_related_products(video_dict), iterations))
+
+    transcript = synthetic_transcript(rng)
+    results.append(measure('split_transcript', len(transcript), lambda: split_transcript(transcript),
+                           max(3, iterations // 10)))
+    return results
+
+
+def run(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    # Citation descriptions would otherwise be served from the cache after the first call
+    app.description_service.max_entries = 0
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'vector_storage': VECTOR_STORAGE,
+        'dimension': args.dimension,
+        'results': []
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for i, size in enumerate(sizes):
+            corpus = SyntheticCorpus(size, args.dimension)
+            path = os.path.join(directory, f"bents_{size}.sqlite")
+            started = time.perf_counter()
+            build_database(path, corpus, args.products)
+            print(f"Built synthetic corpus of {size} chunks in {time.perf_counter() - started:.1f}s", flush=True)
+            use_database(path)
+            report['results'].extend(bench_retrieval(corpus, args.iterations, args.scan_limit, args.top_k))
+            if i == 0:
+                report['results'].extend(bench_post_processing(corpus, args.iterations, args.citations))
+            os.remove(path)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+    return report
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {(r['function'], r['size']): r for r in json.load(f)['results']}
+    with open(after_path) as f:
+        after = {(r['function'], r['size']): r for r in json.load(f)['results']}
+    print(f"{'function':<42} {'size':>8} {'p50 before':>12} {'p50 after':>12} {'speedup':>8} {'memory':>8}")
+    for key in sorted(set(before) & set(after), key=lambda key: (key[0], str(key[1]))):
+        old, new = before[key], after[key]
+        speedup = old['p50_ms'] / new['p50_ms'] if new['p50_ms'] else float('inf')
+        memory = new['peak_memory_kb'] / old['peak_memory_kb'] if old['peak_memory_kb'] else float('nan')
+        print(f"{key[0]:<42} {str(key[1]):>8} {old['p50_ms']:10.3f}ms {new['p50_ms']:10.3f}ms "
+              f"{speedup:7.2f}x {memory:7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the chat server's hot paths")
+    parser.add_argument("--sizes", default="1000,10000", help="Comma-separated corpus sizes in chunks")
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--citations", type=int, default=12, help="Citation markers per synthetic answer")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--scan-limit", type=int, default=20000,
+                        help="Largest corpus the per-row scan backend is run against")
+    parser.add_argument("--output", default=f"bench_results/bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two saved runs")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Bulk transcript ingestion. Walks a directory of .docx transcripts, parses
+and splits them in a process pool, embeds in batches with a bounded number
+of embedding calls in flight and bulk-writes every batch to the chunk
+table. Files already in the table are diffed chunk by chunk, so only new or
+changed chunks are embedded. Each fully written file is recorded in a
+checkpoint file with a hash of its contents, so an interrupted run resumes
+without re-embedding the files it finished, and edited files are picked up
+again.
+
+    python bulk_ingest.py transcripts/ --workers 4 --concurrency 4
+
+Running servers need no restart: their vector and BM25 indexes and their
+answer cache check the corpus version every few seconds (the
+VECTOR_SNAPSHOT_CHECK_SECONDS and ANSWER_CACHE_CHECK_SECONDS settings)
+and reload once this run's writes bump it.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from context_packer import count_tokens
+from ingest import (
+    EMBED_BATCH_SIZE, build_chunk_rows, embed_and_write, extract_metadata_from_text, extract_text_from_docx,
+    finish_transcript, plan_transcript, split_transcript
+)
+
+CHECKPOINT_FILE = ".ingest-checkpoint.json"
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_file(path):
+    """Process pool worker: chunk rows and their token counts for one transcript."""
+    with open(path, 'rb') as f:
+        transcript_text = extract_text_from_docx(io.BytesIO(f.read()))
+    metadata = extract_metadata_from_text(transcript_text)
+    chunks = split_transcript(transcript_text)
+    return build_chunk_rows(chunks, metadata), [count_tokens(chunk) for chunk in chunks]
+
+
+class Checkpoint:
+    """Files already ingested, keyed by path relative to the directory, with their content hash."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._files = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._files = json.load(f).get('files', {})
+
+    def done(self, name, digest):
+        entry = self._files.get(name)
+        return entry is not None and entry['sha1'] == digest
+
+    def mark(self, name, digest, chunks):
+        with self._lock:
+            self._files[name] = {'sha1': digest, 'chunks': chunks, 'ingested': time.time()}
+            # Write-then-rename so an interrupted run never leaves a truncated checkpoint
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump({'files': self._files}, f, indent=1)
+            os.replace(temporary, self.path)
+
+
+class Throughput:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.chunks = 0
+        self.tokens = 0
+        self.files = 0
+        self.reused = 0
+        self.deleted = 0
+
+    def add(self, chunks, tokens):
+        with self._lock:
+            self.chunks += chunks
+            self.tokens += tokens
+
+    def line(self, total_files):
+        elapsed = time.perf_counter() - self.started
+        return (f"{self.files}/{total_files} files, {self.chunks} chunks embedded in {elapsed:.1f}s "
+                f"({self.reused} reused, {self.deleted} deleted): "
+                f"{self.chunks / elapsed:.1f} chunks/s, {self.tokens / elapsed:.0f} tokens/s")
+
+
+def find_transcripts(directory):
+    paths = []
+    for root, _, files in os.walk(directory):
+        # Skip Word's ~$ lock files
+        paths.extend(os.path.join(root, name) for name in files if name.endswith('.docx') and not name.startswith('~$'))
+    return sorted(paths)
+
+
+def ingest_directory(directory, embeddings, table_name="bents", batch_size=EMBED_BATCH_SIZE, workers=None,
+                     concurrency=4, checkpoint_path=None):
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(directory, CHECKPOINT_FILE))
+    pending = []
+    skipped = 0
+    for path in find_transcripts(directory):
+        name = os.path.relpath(path, directory)
+        digest = file_digest(path)
+        if checkpoint.done(name, digest):
+            skipped += 1
+        else:
+            pending.append((path, name, digest))
+    print(f"{len(pending)} transcripts to ingest, {skipped} already done", flush=True)
+
+    throughput = Throughput()
+    failed = []
+    lock = threading.Lock()
+    # Bounds the batches embedded or queued at once, and with them memory and OpenAI concurrency
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def finish_file(state):
+        if not state['failed']:
+            try:
+                finish_transcript(state['plan'], table_name)
+                checkpoint.mark(state['name'], state['digest'], state['chunks'])
+            except Exception as e:
+                logging.error(f"Error finishing {state['name']}: {str(e)}")
+                state['failed'] = True
+                with lock:
+                    failed.append(state['name'])
+        with lock:
+            throughput.files += 1
+            throughput.reused += state['plan']['reused']
+            throughput.deleted += len(state['plan']['stale'])
+        print(throughput.line(len(pending)), flush=True)
+
+    def run_batch(state, batch, tokens):
+        try:
+            if not state['failed']:
+                embed_and_write(batch, embeddings, table_name)
+                throughput.add(len(batch), tokens)
+        except Exception as e:
+            logging.error(f"Error ingesting a batch of {state['name']}: {str(e)}")
+            with lock:
+                if not state['failed']:
+                    failed.append(state['name'])
+                state['failed'] = True
+        finally:
+            slots.release()
+            with lock:
+                state['remaining'] -= 1
+                finished = state['remaining'] == 0
+            if finished:
+                finish_file(state)
+
+    with ProcessPoolExecutor(max_workers=workers) as parse_pool, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-ingest") as embed_pool:
+        futures = {parse_pool.submit(parse_file, path): (name, digest) for path, name, digest in pending}
+        for future in as_completed(futures):
+            name, digest = futures[future]
+            try:
+                rows, tokens = future.result()
+                plan = plan_transcript(rows, table_name)
+            except Exception as e:
+                logging.error(f"Error preparing {name}: {str(e)}")
+                with lock:
+                    failed.append(name)
+                continue
+
+            tokens = dict(zip((row['chunk_id'] for row in rows), tokens))
+            rows = plan['embed']
+            state = {'name': name, 'digest': digest, 'chunks': len(tokens), 'plan': plan, 'failed': False,
+                     'remaining': (len(rows) + batch_size - 1) // batch_size}
+            if not rows:
+                finish_file(state)
+                continue
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                slots.acquire()
+                embed_pool.submit(run_batch, state, batch, sum(tokens[row['chunk_id']] for row in batch))
+
+    print(f"Done: {throughput.line(len(pending))}", flush=True)
+    if failed:
+        print(f"{len(failed)} transcripts failed and will be retried on the next run: {', '.join(failed)}")
+    return {
+        'files': len(pending),
+        'skipped': skipped,
+        'failed': failed,
+        'chunks': throughput.chunks,
+        'tokens': throughput.tokens,
+        'reused': throughput.reused,
+        'deleted': throughput.deleted,
+        'seconds': round(time.perf_counter() - throughput.started, 3)
+    }
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from langchain_openai import OpenAIEmbeddings
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Ingest a directory of .docx transcripts")
+    parser.add_argument("directory")
+    parser.add_argument("--table", default="bents")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=None, help="Parsing processes (default: CPU count)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Embedding batches in flight")
+    parser.add_argument("--checkpoint", default=None, help=f"Checkpoint file (default: <directory>/{CHECKPOINT_FILE})")
+    args = parser.parse_args()
+
+    report = ingest_directory(
+        args.directory,
+        OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY")),
+        table_name=args.table,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        checkpoint_path=args.checkpoint
+    )
+    sys.exit(1 if report['failed'] else 0)
@@ -0,0 +1,124 @@
+import logging
+import os
+from functools import lru_cache
+
+import metrics
+
+try:
+    import tiktoken
+except ImportError:  # Falls back to a characters-per-token estimate
+    tiktoken = None
+
+# Tokens of retrieved transcript text allowed into the generation prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Results below this cosine similarity, or this far below the best result, are dropped
+CONTEXT_MIN_SIMILARITY = float(os.getenv("CONTEXT_MIN_SIMILARITY", "0.70"))
+CONTEXT_MAX_SCORE_GAP = float(os.getenv("CONTEXT_MAX_SCORE_GAP", "0.15"))
+TOKENIZER_MODEL = os.getenv("TOKENIZER_MODEL", "gpt-4o")
+# Shortest suffix/prefix match treated as splitter overlap between adjacent chunks
+MIN_OVERLAP = 20
+MAX_OVERLAP = 400
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except Exception:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text):
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, budget):
+    encoding = _encoding()
+    if encoding is None:
+        return text[:budget * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:budget])
+
+
+def chunk_position(chunk_id):
+    """(video title, chunk number) from chunk ids like 'Title_chunk_3'."""
+    title, _, number = (chunk_id or '').rpartition('_chunk_')
+    return (title, int(number)) if title and number.isdigit() else (chunk_id, None)
+
+
+def strip_overlap(previous, following):
+    """following without the text it repeats from the end of previous."""
+    for size in range(min(len(previous), len(following), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if previous.endswith(following[:size]):
+            return following[size:]
+    return following
+
+
+@metrics.timed('context_packing')
+def pack_context(docs, budget=CONTEXT_TOKEN_BUDGET, min_similarity=CONTEXT_MIN_SIMILARITY,
+                 max_gap=CONTEXT_MAX_SCORE_GAP):
+    """
+    Build the generation prompt's context from ranked documents. Weak results
+    are dropped, consecutive chunks of the same video are merged with the
+    splitter's overlap removed, and merged passages are added best-first until
+    the token budget is spent. Returns the context and a report of the savings.
+    """
+    naive = "\n\n".join(doc.page_content for doc in docs)
+    report = {'documents': len(docs), 'naive_tokens': count_tokens(naive)}
+
+    scores = [doc.metadata.get('similarity_score') for doc in docs]
+    best = max((score for score in scores if score is not None), default=None)
+    kept = [
+        (rank, doc) for rank, (doc, score) in enumerate(zip(docs, scores))
+        if rank == 0 or score is None or (score >= min_similarity and best - score <= max_gap)
+    ]
+    report['dropped'] = len(docs) - len(kept)
+
+    # Merge runs of consecutive chunks from the same video into one passage
+    by_video = {}
+    for rank, doc in kept:
+        title, number = chunk_position(doc.metadata.get('chunk_id'))
+        by_video.setdefault(title, []).append((number, rank, doc))
+    passages = []
+    for chunks in by_video.values():
+        chunks.sort(key=lambda chunk: (chunk[0] is None, chunk[0] or 0, chunk[1]))
+        run = None
+        for number, rank, doc in chunks:
+            if run is not None and number is not None and run['last'] is not None and number == run['last'] + 1:
+                run['text'] += strip_overlap(run['text'], doc.page_content)
+                run['last'] = number
+                run['rank'] = min(run['rank'], rank)
+                continue
+            run = {'text': doc.page_content, 'last': number, 'rank': rank}
+            passages.append(run)
+    passages.sort(key=lambda passage: passage['rank'])
+    report['passages'] = len(passages)
+
+    parts = []
+    used = 0
+    for passage in passages:
+        tokens = count_tokens(passage['text'])
+        remaining = budget - used
+        if tokens > remaining:
+            if parts:
+                continue
+            # Always send something: the best passage, cut to the budget
+            passage = dict(passage, text=truncate_tokens(passage['text'], remaining))
+            tokens = remaining
+        parts.append(passage['text'])
+        used += tokens
+
+    context = "\n\n".join(parts)
+    report['context_tokens'] = count_tokens(context)
+    report['saved_tokens'] = report['naive_tokens'] - report['context_tokens']
+    metrics.count('context_packing', 'tokens', report['context_tokens'])
+    logging.info(
+        f"Packed {report['documents']} documents into {report['passages']} passages: "
+        f"{report['context_tokens']} tokens, saved {report['saved_tokens']} "
+        f"({report['dropped']} dropped below the similarity floor)"
+    )
+    return context, report
@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Connections idle longer than this are pinged with SELECT 1 before being handed out
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Process-wide, thread-safe Postgres pool. Use it through connection():
+
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                ...
+            conn.commit()
+
+    Uncommitted work is rolled back when the connection goes back, and broken
+    connections are discarded instead of being returned to the pool.
+    """
+
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 timeout=DB_POOL_TIMEOUT, ping_after=DB_POOL_PING_AFTER):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._pool = None
+        self._init_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats_lock = threading.Lock()
+        self._last_used = {}
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'in_use': 0,
+            'peak_in_use': 0,
+            'health_check_failures': 0,
+            'discarded': 0,
+            'wait_seconds_total': 0.0
+        }
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._init_lock:
+                if self._pool is None:
+                    self._pool = pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+        return self._pool
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._stats['waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._stats_lock:
+                    self._stats['timeouts'] += 1
+                raise PoolTimeout(f"No database connection available after {self.timeout}s")
+
+        try:
+            db_pool = self._get_pool()
+            conn = db_pool.getconn()
+            if not self._healthy(conn):
+                logging.warning("Discarding unhealthy pooled database connection")
+                with self._stats_lock:
+                    self._stats['health_check_failures'] += 1
+                db_pool.putconn(conn, close=True)
+                conn = db_pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._stats['in_use'])
+            self._stats['wait_seconds_total'] += time.monotonic() - started
+        return conn
+
+    def putconn(self, conn):
+        close = conn.closed != 0
+        if not close and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._get_pool().putconn(conn, close=close)
+        finally:
+            if close:
+                self._last_used.pop(id(conn), None)
+            with self._stats_lock:
+                self._stats['in_use'] -= 1
+                if close:
+                    self._stats['discarded'] += 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        pooled = self._pool
+        stats['min_size'] = self.minconn
+        stats['max_size'] = self.maxconn
+        stats['idle'] = len(pooled._pool) if pooled is not None else 0
+        stats['open'] = stats['idle'] + stats['in_use']
+        stats['utilization'] = stats['in_use'] / self.maxconn if self.maxconn else 0.0
+        return stats
+
+    def closeall(self):
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(os.getenv("POSTGRES_URL"))
+        return _pool
+
+
+def connection():
+    """Check out a connection from the shared pool (context manager)."""
+    return get_pool().connection()
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import List
+
+from pydantic import BaseModel, Field
+
+import metrics
+
+# 'llm' asks the model for descriptions, 'extractive' builds them locally with no LLM call
+DESCRIPTION_MODE = os.getenv("DESCRIPTION_MODE", "llm")
+DESCRIPTION_CACHE_SIZE = int(os.getenv("DESCRIPTION_CACHE_SIZE", "2048"))
+MAX_DESCRIPTION_WORDS = 8
+
+MARKER_PATTERN = re.compile(r'\{(?:timestamp|title|url):[^\}]*\}?')
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|\n+')
+LEADING_NOISE = re.compile(r'^[\s#\-\*\d\.\)]+')
+
+
+class CitationDescription(BaseModel):
+    index: int = Field(..., description="Number of the citation being described")
+    description: str = Field(..., description="Action phrase of 6-8 words starting with a verb")
+
+
+class CitationDescriptions(BaseModel):
+    descriptions: List[CitationDescription]
+
+
+def extractive_description(context, offset=None):
+    """
+    Build a description locally from the sentence the citation is attached to:
+    the last sentence before the marker, or the first one after it.
+    """
+    offset = len(context) // 2 if offset is None else offset
+    before = MARKER_PATTERN.sub('', context[:offset])
+    after = MARKER_PATTERN.sub('', context[offset:])
+    sentences = [s for s in SENTENCE_END.split(before) if s.strip()]
+    sentence = sentences[-1] if sentences else next((s for s in SENTENCE_END.split(after) if s.strip()), '')
+    words = LEADING_NOISE.sub('', sentence).replace('**', '').split()
+    return ' '.join(words[:MAX_DESCRIPTION_WORDS])
+
+
+class DescriptionService:
+    """
+    Citation descriptions keyed by (video title, timestamp, context hash) in an
+    LRU. describe_many() answers everything it can from the cache and asks the
+    LLM for the rest in a single structured-output call.
+    """
+
+    def __init__(self, llm, mode=DESCRIPTION_MODE, max_entries=DESCRIPTION_CACHE_SIZE):
+        self.llm = llm
+        self.mode = mode
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'llm_calls': 0, 'llm_errors': 0, 'extractive': 0}
+
+    @staticmethod
+    def key(item):
+        context_hash = hashlib.sha1(item['context'].encode('utf-8')).hexdigest()
+        return item.get('title'), item['timestamp'], context_hash
+
+    def cached(self, item):
+        key = self.key(item)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def preview(self, item):
+        """A description available without an LLM call: cached, else extractive."""
+        return self.cached(item) or extractive_description(item['context'], item.get('offset'))
+
+    def describe(self, context, timestamp, title=None, offset=None):
+        return self.describe_many([{'context': context, 'timestamp': timestamp, 'title': title, 'offset': offset}])[0]
+
+    @metrics.timed('descriptions')
+    def describe_many(self, items):
+        descriptions, missing = self._from_cache(items)
+        if missing:
+            self._fill(items, descriptions, missing, self._generate([items[i] for i in missing]))
+        return descriptions
+
+    @metrics.timed('descriptions')
+    async def adescribe_many(self, items):
+        descriptions, missing = self._from_cache(items)
+        if missing:
+            self._fill(items, descriptions, missing, await self._agenerate([items[i] for i in missing]))
+        return descriptions
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['mode'] = self.mode
+        return stats
+
+    def _from_cache(self, items):
+        descriptions = [None] * len(items)
+        missing = []
+        for i, item in enumerate(items):
+            description = self.cached(item)
+            if description is None:
+                missing.append(i)
+            else:
+                descriptions[i] = description
+        with self._lock:
+            self._stats['hits'] += len(items) - len(missing)
+            self._stats['misses'] += len(missing)
+        return descriptions, missing
+
+    def _fill(self, items, descriptions, missing, generated):
+        for i, description in zip(missing, generated):
+            if description:
+                descriptions[i] = description
+                self._remember(self.key(items[i]), description)
+            else:
+                # Same fallback as before batching; not cached so it gets retried
+                descriptions[i] = ' '.join(items[i]['context'].split()[:6])
+
+    def _generate(self, items):
+        if self.mode == 'extractive':
+            return self._extractive(items)
+        try:
+            with self._lock:
+                self._stats['llm_calls'] += 1
+            result = self.llm.with_structured_output(CitationDescriptions).invoke(self._prompt(items))
+        except Exception as e:
+            result = self._failed(e)
+        return self._parse(result, len(items))
+
+    async def _agenerate(self, items):
+        if self.mode == 'extractive':
+            return self._extractive(items)
+        try:
+            with self._lock:
+                self._stats['llm_calls'] += 1
+            result = await self.llm.with_structured_output(CitationDescriptions).ainvoke(self._prompt(items))
+        except Exception as e:
+            result = self._failed(e)
+        return self._parse(result, len(items))
+
+    def _extractive(self, items):
+        with self._lock:
+            self._stats['extractive'] += len(items)
+        return [extractive_description(item['context'], item.get('offset')) for item in items]
+
+    def _failed(self, error):
+        logging.error(f"Error generating descriptions: {str(error)}")
+        metrics.count('descriptions', 'errors')
+        with self._lock:
+            self._stats['llm_errors'] += 1
+        return None
+
+    @staticmethod
+    def _prompt(items):
+        citations = "\n\n".join(
+            f"{i + 1}. Video: {item.get('title') or 'Unknown'} at {item['timestamp']}\n   Context: {item['context']}"
+            for i, item in enumerate(items)
+        )
+        return f"""
+        For each woodworking video citation below, create an extremely concise action phrase (max 6-8 words).
+
+        Rules:
+        1. Start with an action verb
+        2. Name the specific tool/technique
+        3. Must be 6-8 words only
+        4. Focus on the single main action
+        5. Be direct and clear
+
+        Example formats:
+        - "Demonstrates table saw fence alignment technique"
+        - "Installs dust collection system components"
+        - "Shows track saw cutting method"
+
+        Citations:
+        {citations}
+
+        Return one description per citation, using the citation number as index."""
+
+    @staticmethod
+    def _parse(result, count):
+        by_index = {entry.index: entry.description for entry in result.descriptions} if result else {}
+        descriptions = []
+        for i in range(count):
+            description = by_index.get(i + 1, '').strip().strip('"')
+            descriptions.append(' '.join(description.split()[:MAX_DESCRIPTION_WORDS]) or None)
+        return descriptions
+
+    def _remember(self, key, description):
+        with self._lock:
+            self._entries[key] = description
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
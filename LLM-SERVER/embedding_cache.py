@@ -0,0 +1,138 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+# Optional SQLite file that keeps cached embeddings across restarts
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+
+
+def normalize_query(text):
+    return re.sub(r'\s+', ' ', text.strip().lower())
+
+
+class EmbeddingCache:
+    """
+    Memoizes query embeddings by (model, normalized text). A bounded in-memory
+    LRU with TTL sits in front of an optional SQLite store, so recurring
+    rewritten questions skip the OpenAI round-trip, even after a restart.
+    """
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL, path=EMBEDDING_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("""
+                    CREATE TABLE IF NOT EXISTS embeddings (
+                        model TEXT NOT NULL,
+                        query TEXT NOT NULL,
+                        vector BLOB NOT NULL,
+                        created REAL NOT NULL,
+                        PRIMARY KEY (model, query)
+                    )
+                """)
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Embedding cache disk store disabled: {str(e)}")
+                self._db = None
+
+    def get(self, text, model):
+        key = (model, normalize_query(text))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, created = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return list(vector)
+                del self._entries[key]
+                self._stats['expired'] += 1
+
+            vector = self._load(key, now)
+            if vector is not None:
+                self._stats['disk_hits'] += 1
+                return list(vector)
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, text, model, vector):
+        key = (model, normalize_query(text))
+        now = time.time()
+        vector = tuple(float(x) for x in vector)
+        with self._lock:
+            self._remember(key, vector, now)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO embeddings (model, query, vector, created) VALUES (?, ?, ?, ?)",
+                        (key[0], key[1], np.asarray(vector, dtype=np.float64).tobytes(), now)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logging.error(f"Error writing embedding cache: {str(e)}")
+
+    def get_or_compute(self, text, model, compute):
+        vector = self.get(text, model)
+        if vector is None:
+            vector = compute()
+            self.put(text, model, vector)
+        return vector
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['persistent'] = self._db is not None
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def _remember(self, key, vector, created):
+        self._entries[key] = (vector, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _load(self, key, now):
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT vector, created FROM embeddings WHERE model = ? AND query = ?", key
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading embedding cache: {str(e)}")
+            return None
+        if row is None or now - row[1] > self.ttl:
+            return None
+        vector = tuple(np.frombuffer(row[0], dtype=np.float64).tolist())
+        self._remember(key, vector, row[1])
+        return vector
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from context_packer import count_tokens
+
+# Tokens of recent turns sent verbatim; older turns are folded into the summary
+HISTORY_TOKEN_WINDOW = int(os.getenv("HISTORY_TOKEN_WINDOW", "1500"))
+HISTORY_SUMMARY_WORDS = int(os.getenv("HISTORY_SUMMARY_WORDS", "150"))
+HISTORY_SUMMARY_CACHE_SIZE = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "1024"))
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+
+def prefix_keys(turns):
+    """Rolling hash per history prefix: keys[i] identifies turns[:i + 1]."""
+    keys = []
+    digest = b''
+    for human, ai in turns:
+        digest = hashlib.sha1(digest + json.dumps([human, ai]).encode('utf-8')).digest()
+        keys.append(digest.hex())
+    return keys
+
+
+def render_turns(turns):
+    return "\n".join(f"User: {human}\nAssistant: {ai}" for human, ai in turns)
+
+
+class HistoryManager:
+    """
+    Keeps the chat history sent to the model roughly constant in size. The
+    most recent turns that fit in HISTORY_TOKEN_WINDOW go verbatim; everything
+    older is represented by a rolling summary. Summaries are cached by a hash
+    of the turns they cover, so a conversation is recognised from its history
+    alone and each turn that leaves the window is summarized once, in the
+    background, by folding it into the previous summary.
+    """
+
+    def __init__(self, llm, window=HISTORY_TOKEN_WINDOW, summary_words=HISTORY_SUMMARY_WORDS,
+                 max_entries=HISTORY_SUMMARY_CACHE_SIZE):
+        self.llm = llm
+        self.window = window
+        self.summary_words = summary_words
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._summaries = OrderedDict()
+        self._in_flight = set()
+        self._stats = {'requests': 0, 'summary_hits': 0, 'summaries_built': 0, 'blocking_summaries': 0,
+                       'summary_errors': 0}
+
+    def session(self, turns):
+        return CompactHistory(self, turns)
+
+    def compact(self, turns):
+        """(summary or None, recent turns) for the (human, ai) turn list."""
+        with self._lock:
+            self._stats['requests'] += 1
+        recent_start = len(turns)
+        used = 0
+        while recent_start > 0:
+            tokens = count_tokens(render_turns(turns[recent_start - 1:recent_start]))
+            if used + tokens > self.window and recent_start < len(turns):
+                break
+            used += tokens
+            recent_start -= 1
+        if recent_start == 0:
+            return None, list(turns)
+
+        older = turns[:recent_start]
+        keys = prefix_keys(older)
+        covered, summary = self._best_summary(keys)
+        if covered == len(older):
+            with self._lock:
+                self._stats['summary_hits'] += 1
+            return summary, list(turns[recent_start:])
+
+        gap = older[covered:]
+        if used + count_tokens(render_turns(gap)) <= self.window * 2:
+            # Send the few turns not summarized yet verbatim and fold them in off the request path
+            self._schedule(summary, gap, keys[-1])
+            return summary, list(turns[covered:])
+
+        # Too much unsummarized history (e.g. after a restart): summarize now
+        with self._lock:
+            self._stats['blocking_summaries'] += 1
+        updated = self._summarize(summary, gap, keys[-1])
+        if updated is None:
+            return summary, list(turns[covered:])
+        return updated, list(turns[recent_start:])
+
+    def render(self, summary, recent):
+        if summary is None and not recent:
+            return '[]'
+        parts = []
+        if summary:
+            parts.append(f"Summary of earlier conversation: {summary}")
+        if recent:
+            parts.append(render_turns(recent))
+        return "\n".join(parts)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_summaries'] = len(self._summaries)
+        stats['window_tokens'] = self.window
+        return stats
+
+    def _best_summary(self, keys):
+        with self._lock:
+            for covered in range(len(keys), 0, -1):
+                summary = self._summaries.get(keys[covered - 1])
+                if summary is not None:
+                    self._summaries.move_to_end(keys[covered - 1])
+                    return covered, summary
+        return 0, None
+
+    def _schedule(self, summary, turns, key):
+        with self._lock:
+            if key in self._in_flight:
+                return
+            self._in_flight.add(key)
+        _executor.submit(self._summarize, summary, turns, key)
+
+    def _summarize(self, summary, turns, key):
+        prompt = f"""Update the running summary of a conversation between a user and Jason Bent's woodworking assistant.
+        Keep the projects, tools, materials, measurements, preferences and open questions the user mentioned, and what was already answered.
+        Use at most {self.summary_words} words. Only return the updated summary.
+
+        Current summary: {summary or 'None yet'}
+
+        New turns:
+        {render_turns(turns)}
+
+        Updated summary:"""
+        try:
+            updated = self.llm.predict(prompt).strip()
+            with self._lock:
+                self._stats['summaries_built'] += 1
+                self._summaries[key] = updated
+                self._summaries.move_to_end(key)
+                while len(self._summaries) > self.max_entries:
+                    self._summaries.popitem(last=False)
+            return updated
+        except Exception as e:
+            logging.error(f"Error summarizing chat history: {str(e)}")
+            with self._lock:
+                self._stats['summary_errors'] += 1
+            return None
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+
+class CompactHistory:
+    """One request's history, compacted on first use and shared by the rewrite and generation prompts."""
+
+    def __init__(self, manager, turns):
+        self._manager = manager
+        self.turns = turns
+        self._lock = threading.Lock()
+        self._text = None
+
+    def render(self):
+        with self._lock:
+            if self._text is None:
+                self._text = self._manager.render(*self._manager.compact(self.turns))
+            return self._text
+
+    async def arender(self):
+        if self._text is not None:
+            return self._text
+        # Compaction only calls the model when a long history arrives unsummarized
+        return await asyncio.to_thread(self.render)
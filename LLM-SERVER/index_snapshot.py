@@ -0,0 +1,257 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# Directory holding one snapshot file per table; unset keeps every worker loading from the database
+VECTOR_SNAPSHOT_DIR = os.getenv("VECTOR_SNAPSHOT_DIR")
+# How often a worker checks in the background whether the corpus moved past its loaded index
+VECTOR_SNAPSHOT_CHECK_SECONDS = float(os.getenv("VECTOR_SNAPSHOT_CHECK_SECONDS", "30"))
+
+MAGIC = b'BVSNAP02'
+# magic, corpus version, rows, dimension, then (offset, size) of the matrix, norms, offsets, metadata,
+# int8 codes and int8 scales sections; the last two are empty when the index is not quantized
+HEADER = struct.Struct('<8s64sQI4xQQQQQQQQQQQQ')
+ALIGNMENT = 64
+
+_version_table_ready = threading.Event()
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def snapshot_path(directory, table_name):
+    return os.path.join(directory, f"{table_name}.snapshot")
+
+
+def ensure_version_table(connection):
+    """
+    Create corpus_versions on a connection of its own, so a caller's open
+    transaction is never committed halfway. Call it before bump_version or
+    corpus_version.
+    """
+    if _version_table_ready.is_set():
+        return
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS corpus_versions (
+                    table_name text PRIMARY KEY,
+                    version bigint NOT NULL
+                )
+            """)
+        conn.commit()
+    _version_table_ready.set()
+
+
+def bump_version(conn, table_name):
+    """Mark table_name as changed; call inside the transaction that writes or deletes its rows."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO corpus_versions (table_name, version) VALUES (%s, 1)
+            ON CONFLICT (table_name) DO UPDATE SET version = corpus_versions.version + 1
+        """, (table_name,))
+
+
+def corpus_version(conn, table_name):
+    """
+    Version of a chunk table: the ingest counter plus the row count, so rows
+    added or removed by writers that do not bump the counter are noticed too.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM corpus_versions WHERE table_name = %s", (table_name,))
+        row = cur.fetchone()
+        cur.execute(f"SELECT COUNT(*) FROM {table_name}")
+        count = cur.fetchone()[0]
+    return f"{row[0] if row else 0}:{count}"
+
+
+class SnapshotMetadata:
+    """Chunk metadata decoded from the mapped file one row at a time, on access."""
+
+    def __init__(self, buffer, offsets):
+        self._buffer = buffer
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(bytes(self._buffer[int(self._offsets[i]):int(self._offsets[i + 1])]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class Snapshot:
+    """
+    A read-only, memory-mapped index snapshot. Every process mapping the same
+    file shares one copy of it in the page cache. codes and scales are None
+    unless the snapshot was written with int8 codes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, rows, dimension, matrix_offset, matrix_size, norms_offset, norms_size,
+             offsets_offset, offsets_size, meta_offset, meta_size, codes_offset, codes_size,
+             scales_offset, scales_size) = HEADER.unpack_from(self._mmap)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an index snapshot")
+            buffer = memoryview(self._mmap)
+            self.version = version.rstrip(b'\x00').decode('utf-8')
+            self.matrix = np.frombuffer(buffer, dtype='<f4', count=rows * dimension,
+                                        offset=matrix_offset).reshape(rows, dimension)
+            self.matrix_offset = matrix_offset
+            self.norms = np.frombuffer(buffer, dtype='<f4', count=rows, offset=norms_offset)
+            offsets = np.frombuffer(buffer, dtype='<u8', count=rows + 1, offset=offsets_offset)
+            self.metadata = SnapshotMetadata(buffer[meta_offset:meta_offset + meta_size], offsets)
+            self.codes = self.scales = None
+            if codes_size:
+                self.codes = np.frombuffer(buffer, dtype='i1', count=rows * dimension,
+                                           offset=codes_offset).reshape(rows, dimension)
+                self.scales = np.frombuffer(buffer, dtype='<f4', count=dimension, offset=scales_offset)
+        except Exception:
+            self._mmap.close()
+            raise
+
+
+class SnapshotRows:
+    """
+    The float32 rows of a snapshot, read with pread when indexed rather than
+    mapped, so a process holds none of them beyond the rows it asked for.
+    Rows replaced or added after the snapshot was written are kept in memory;
+    updated() and select() return new objects, leaving this one unchanged.
+    """
+
+    def __init__(self, snapshot):
+        self._file = open(snapshot.path, 'rb')
+        self._offset = snapshot.matrix_offset
+        self.shape = snapshot.matrix.shape
+        # Per position: the snapshot row it is read from, or -1 - i for row i of _extra
+        self._source = np.arange(self.shape[0], dtype=np.int64)
+        self._extra = np.zeros((0, self.shape[1]), dtype=np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, positions):
+        single = np.ndim(positions) == 0
+        sources = self._source[np.atleast_1d(positions)]
+        rows = np.empty((len(sources), self.shape[1]), dtype=np.float32)
+        width = self.shape[1] * 4
+        for i, source in enumerate(sources):
+            if source < 0:
+                rows[i] = self._extra[-1 - source]
+            else:
+                data = os.pread(self._file.fileno(), width, self._offset + int(source) * width)
+                rows[i] = np.frombuffer(data, dtype='<f4')
+        return rows[0] if single else rows
+
+    def _derive(self, source, extra):
+        rows = SnapshotRows.__new__(SnapshotRows)
+        rows._file = self._file
+        rows._offset = self._offset
+        rows._source = source
+        rows._extra = extra
+        rows.shape = (len(source), self.shape[1])
+        return rows
+
+    def updated(self, replaced, appended):
+        """Rows with replaced ({position: row}) overwritten and appended rows added at the end."""
+        source = self._source.copy()
+        added = [replaced[position] for position in replaced]
+        for i, position in enumerate(replaced):
+            source[position] = -1 - (len(self._extra) + i)
+        if len(appended):
+            first = len(self._extra) + len(added)
+            source = np.concatenate([source, -1 - np.arange(first, first + len(appended))])
+            added.extend(appended)
+        extra = np.vstack([self._extra, np.asarray(added, dtype=np.float32)]) if added else self._extra
+        return self._derive(source, extra)
+
+    def select(self, keep):
+        return self._derive(self._source[keep], self._extra)
+
+
+def open_snapshot(path):
+    """The snapshot at path, or None if there is none or it cannot be read."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return Snapshot(path)
+    except Exception as e:
+        logging.error(f"Ignoring unreadable index snapshot {path}: {str(e)}")
+        return None
+
+
+def write_snapshot(path, version, matrix, norms, meta, codes=None, scales=None):
+    """
+    Write a snapshot next to path and rename it into place, so readers see the
+    old file or the new one, never a partial write. Processes that mapped the
+    old file keep reading it until they reopen. codes and scales are the int8
+    quantization of matrix, if any.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype='<f4')
+    norms = np.ascontiguousarray(norms, dtype='<f4')
+    codes = np.ascontiguousarray(codes if codes is not None else np.zeros(0), dtype='i1')
+    scales = np.ascontiguousarray(scales if scales is not None else np.zeros(0), dtype='<f4')
+    rows, dimension = matrix.shape if matrix.size else (len(meta), 0)
+    encoded = [json.dumps(entry, separators=(',', ':')).encode('utf-8') for entry in meta]
+    offsets = np.zeros(rows + 1, dtype='<u8')
+    np.cumsum([len(entry) for entry in encoded], out=offsets[1:])
+
+    matrix_offset = _aligned(HEADER.size)
+    norms_offset = _aligned(matrix_offset + matrix.nbytes)
+    offsets_offset = _aligned(norms_offset + norms.nbytes)
+    meta_offset = _aligned(offsets_offset + offsets.nbytes)
+    codes_offset = _aligned(meta_offset + int(offsets[-1]))
+    scales_offset = _aligned(codes_offset + codes.nbytes)
+    header = HEADER.pack(MAGIC, version.encode('utf-8'), rows, dimension, matrix_offset, matrix.nbytes,
+                         norms_offset, norms.nbytes, offsets_offset, offsets.nbytes, meta_offset, int(offsets[-1]),
+                         codes_offset, codes.nbytes, scales_offset, scales.nbytes)
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        for offset, data in ((0, header), (matrix_offset, matrix.tobytes()), (norms_offset, norms.tobytes()),
+                             (offsets_offset, offsets.tobytes())):
+            f.seek(offset)
+            f.write(data)
+        f.seek(meta_offset)
+        for entry in encoded:
+            f.write(entry)
+        for offset, data in ((codes_offset, codes.tobytes()), (scales_offset, scales.tobytes())):
+            f.seek(offset)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    logging.info(f"Wrote index snapshot {path} ({rows} vectors, version {version})")
+
+
+@contextmanager
+def rebuild_lock(path):
+    """Exclusive lock so one worker rebuilds a stale snapshot while the others wait for it."""
+    with open(f"{path}.lock", 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,247 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from docx import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from psycopg2.extras import execute_values
+
+import db_pool
+from index_snapshot import bump_version, ensure_version_table
+from retrieval_backends import notify_delete, notify_upsert
+from vector_index import storage_value, vector_column
+
+# Chunks sent to OpenAI per embed_documents call and written per bulk upsert
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
+_hash_columns = set()
+_hash_columns_lock = threading.Lock()
+
+
+def extract_text_from_docx(file):
+    doc = Document(file)
+    text = "\n".join([para.text for para in doc.paragraphs])
+    return text
+
+
+def extract_metadata_from_text(text):
+    title = text.split('\n')[0] if text else "Untitled Video"
+    return {"title": title}
+
+
+def split_transcript(transcript_text):
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    return text_splitter.split_text(transcript_text)
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def build_chunk_rows(chunks, metadata):
+    title = metadata.get('title', 'Unknown Video')
+    return [
+        {
+            'text': chunk,
+            'title': title,
+            'url': metadata.get('url', ''),
+            'chunk_id': f"{metadata['title']}_chunk_{i}",
+            'content_hash': content_hash(chunk)
+        }
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+def ensure_hash_column(table_name):
+    """
+    Add the content_hash column on first use, on a connection of its own; rows
+    written before it get theirs on re-upload.
+    """
+    with _hash_columns_lock:
+        if table_name in _hash_columns:
+            return
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS content_hash text")
+        conn.commit()
+    with _hash_columns_lock:
+        _hash_columns.add(table_name)
+
+
+def bulk_upsert(conn, table_name, rows):
+    """Upsert a batch of embedded chunk rows in one statement; returns the stored ids."""
+    ensure_hash_column(table_name)
+    ensure_version_table(db_pool.connection)
+    column = vector_column()
+    with conn.cursor() as cur:
+        stored = execute_values(cur, f"""
+            INSERT INTO {table_name} (text, title, url, chunk_id, content_hash, {column})
+            VALUES %s
+            ON CONFLICT (chunk_id) DO UPDATE
+            SET text = EXCLUDED.text, content_hash = EXCLUDED.content_hash, {column} = EXCLUDED.{column}
+            RETURNING chunk_id, id, title, url
+        """, [
+            (row['text'], row['title'], row['url'], row['chunk_id'], row.get('content_hash') or content_hash(row['text']),
+             storage_value(row['vector']))
+            for row in rows
+        ], page_size=len(rows), fetch=True)
+    bump_version(conn, table_name)
+    return {chunk_id: (row_id, title, url) for chunk_id, row_id, title, url in stored}
+
+
+def plan_transcript(rows, table_name="bents"):
+    """
+    Diff a transcript's chunk rows against the chunks stored for its video.
+    Only new chunks and chunks whose content hash changed need embedding;
+    stored chunk_ids missing from rows (the transcript got shorter) are stale.
+    Rows stored before content hashes existed are compared by their text, and
+    rows with nothing in the configured vector column (written before a
+    VECTOR_STORAGE switch) are re-embedded as changed.
+    """
+    plan = {'embed': [], 'reused': 0, 'changed': 0, 'added': 0, 'stale': [], 'backfill': []}
+    if not rows:
+        return plan
+
+    column = vector_column()
+    ensure_hash_column(table_name)
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT chunk_id, content_hash, CASE WHEN content_hash IS NULL THEN text END, {column} IS NULL
+                FROM {table_name}
+                WHERE title = %s
+            """, (rows[0]['title'],))
+            stored = {}
+            unhashed = set()
+            unembedded = set()
+            for chunk_id, stored_hash, text, missing_vector in cur.fetchall():
+                if stored_hash is None:
+                    stored_hash = content_hash(text or '')
+                    unhashed.add(chunk_id)
+                if missing_vector:
+                    unembedded.add(chunk_id)
+                stored[chunk_id] = stored_hash
+
+    for row in rows:
+        stored_hash = stored.get(row['chunk_id'])
+        if stored_hash is None:
+            plan['added'] += 1
+            plan['embed'].append(row)
+        elif stored_hash != row['content_hash'] or row['chunk_id'] in unembedded:
+            plan['changed'] += 1
+            plan['embed'].append(row)
+        else:
+            plan['reused'] += 1
+            if row['chunk_id'] in unhashed:
+                plan['backfill'].append((row['content_hash'], row['chunk_id']))
+    chunk_ids = {row['chunk_id'] for row in rows}
+    plan['stale'] = sorted(chunk_id for chunk_id in stored if chunk_id not in chunk_ids)
+    return plan
+
+
+def finish_transcript(plan, table_name="bents"):
+    """After the plan's chunks are written: record hashes of reused chunks and delete stale ones."""
+    ensure_version_table(db_pool.connection)
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            if plan['backfill']:
+                execute_values(cur, f"""
+                    UPDATE {table_name} AS t SET content_hash = v.content_hash
+                    FROM (VALUES %s) AS v (content_hash, chunk_id)
+                    WHERE t.chunk_id = v.chunk_id AND t.content_hash IS NULL
+                """, plan['backfill'])
+            if plan['stale']:
+                cur.execute(f"DELETE FROM {table_name} WHERE chunk_id = ANY(%s)", (plan['stale'],))
+        if plan['stale']:
+            bump_version(conn, table_name)
+        conn.commit()
+    if plan['stale']:
+        notify_delete(table_name, plan['stale'])
+
+
+def embed_and_write(batch, embeddings, table_name="bents"):
+    """
+    One embed_documents call and one committed bulk upsert for a batch of chunk
+    rows. Returns the stored records (with id and vector) and the batch timings.
+    """
+    embed_started = time.perf_counter()
+    vectors = embeddings.embed_documents([row['text'] for row in batch])
+    embed_seconds = time.perf_counter() - embed_started
+
+    batch = [dict(row, vector=vector) for row, vector in zip(batch, vectors)]
+    write_started = time.perf_counter()
+    with db_pool.connection() as conn:
+        stored = bulk_upsert(conn, table_name, batch)
+        conn.commit()
+    write_seconds = time.perf_counter() - write_started
+
+    records = []
+    for row in batch:
+        row_id, title, url = stored[row['chunk_id']]
+        records.append(dict(row, id=row_id, title=title, url=url))
+    return records, {
+        'chunks': len(batch),
+        'embed_seconds': round(embed_seconds, 3),
+        'write_seconds': round(write_seconds, 3)
+    }
+
+
+def ingest_chunks(rows, embeddings, table_name="bents", batch_size=EMBED_BATCH_SIZE, progress=None):
+    """
+    Embed and write chunk rows batch by batch: one embed_documents call and one
+    bulk upsert per batch, committed per batch. Returns per-batch timings.
+    progress(done, total) is called after each batch.
+    """
+    started = time.perf_counter()
+    batches = []
+    records = []
+    for start in range(0, len(rows), batch_size):
+        stored, timing = embed_and_write(rows[start:start + batch_size], embeddings, table_name)
+        records.extend(stored)
+        batches.append(dict(batch=len(batches), **timing))
+        logging.debug(f"Ingested batch {len(batches)} ({timing['chunks']} chunks): "
+                      f"embed {timing['embed_seconds']:.2f}s, write {timing['write_seconds']:.2f}s")
+        if progress is not None:
+            progress(len(records), len(rows))
+
+    notify_upsert(table_name, records)
+    return {
+        'chunks': len(rows),
+        'batch_size': batch_size,
+        'batches': batches,
+        'total_seconds': round(time.perf_counter() - started, 3)
+    }
+
+
+def ingest_transcript(rows, embeddings, table_name="bents", batch_size=EMBED_BATCH_SIZE, progress=None):
+    """
+    Ingest one transcript's chunk rows incrementally: embed only new or
+    changed chunks, keep the rest as stored and delete chunks the new version
+    no longer has. Reports reused, changed, added and deleted counts.
+    progress(done, total) counts reused chunks as done.
+    """
+    started = time.perf_counter()
+    plan = plan_transcript(rows, table_name)
+    embedded = None
+    if progress is not None:
+        progress(plan['reused'], len(rows))
+
+        def embedded(done, total):
+            progress(plan['reused'] + done, len(rows))
+    report = ingest_chunks(plan['embed'], embeddings, table_name, batch_size, embedded)
+    finish_transcript(plan, table_name)
+    report.update({
+        'chunks': len(rows),
+        'embedded': len(plan['embed']),
+        'reused': plan['reused'],
+        'changed': plan['changed'],
+        'added': plan['added'],
+        'deleted': len(plan['stale']),
+        'total_seconds': round(time.perf_counter() - started, 3)
+    })
+    logging.info(f"Ingested {len(rows)} chunks of {rows[0]['title'] if rows else 'an empty transcript'}: "
+                 f"{plan['reused']} reused, {plan['changed']} changed, {plan['added']} added, "
+                 f"{len(plan['stale'])} deleted")
+    return report
@@ -0,0 +1,279 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+
+from metrics import timed
+
+INTENT_FAST_PATH = os.getenv("INTENT_FAST_PATH", "true").lower() == "true"
+# Nearest-centroid decisions need this cosine to the winning label and this lead over the runner-up
+INTENT_MIN_SIMILARITY = float(os.getenv("INTENT_MIN_SIMILARITY", "0.85"))
+INTENT_MARGIN = float(os.getenv("INTENT_MARGIN", "0.03"))
+# Labels the local classifier may decide on its own; everything else goes to the LLM
+INTENT_LOCAL_LABELS = set(os.getenv("INTENT_LOCAL_LABELS", "GREETING,RELEVANT").upper().split(','))
+
+WORD = re.compile(r"[a-z0-9']+")
+
+GREETING_PHRASES = {
+    'hello': {'hi', 'hii', 'hey', 'heya', 'hello', 'hello there', 'hi there', 'hey there', 'yo', 'howdy',
+              'good morning', 'good afternoon', 'good evening', 'hey jason', 'hi jason', 'hello jason',
+              'how are you', 'how are you doing', "what's up", 'whats up', 'sup'},
+    'thanks': {'thanks', 'thank you', 'thankyou', 'thanks a lot', 'thank you so much', 'thanks so much',
+               'thx', 'ty', 'much appreciated', 'appreciate it', 'great thanks', 'ok thanks', 'okay thanks',
+               'awesome thanks', 'perfect thanks', 'cool thanks', 'got it thanks'},
+    'bye': {'bye', 'goodbye', 'good bye', 'bye bye', 'see you', 'see ya', 'later', 'cya', 'take care',
+            'have a good day', 'have a nice day', 'good night', 'thanks bye', 'thank you bye'},
+}
+
+GREETING_TEMPLATES = {
+    'hello': [
+        "Hey there! Welcome to Bent's Woodworking. What are you working on in the shop today?",
+        "Hi! Happy to help with anything woodworking, from tool choices to shop setup. What's on your mind?",
+        "Hello! Ask me about tools, techniques or projects from Jason Bent's videos and I'll point you in the right direction.",
+    ],
+    'thanks': [
+        "You're welcome! If anything else comes up in the shop, just ask.",
+        "Glad that helped! Let me know if you have any other woodworking questions.",
+        "Anytime! Enjoy the project, and feel free to come back with more questions.",
+    ],
+    'bye': [
+        "Take care, and enjoy your time in the shop!",
+        "Goodbye! Come back anytime you have a woodworking question.",
+        "See you later! Happy building.",
+    ],
+}
+
+# Only words that rarely mean anything outside woodworking: everyday words such as cut, shop,
+# build, project, tool, video or storage, and words like router or cherry, leave the call to the LLM
+WOODWORKING_TERMS = {
+    'woodworking', 'woodworker', 'woodshop', 'tablesaw', 'bandsaw', 'miter', 'mitre', 'jig', 'jigs',
+    'chisel', 'chisels', 'planer', 'jointer', 'lathe', 'sander', 'sandpaper', 'joinery', 'dovetail',
+    'dovetails', 'mortise', 'tenon', 'festool', 'kreg', 'mft', 'workbench', 'plywood', 'lumber', 'hardwood',
+    'kerf', 'tracksaw', 'nailer', 'dado', 'rabbet', 'veneer', 'cnc', 'crosscut', 'bents',
+}
+
+# Anything touching these always gets the LLM's judgement, even alongside woodworking terms
+GUARD_TERMS = {
+    'kill', 'killing', 'hurt', 'harm', 'weapon', 'weapons', 'gun', 'guns', 'bomb', 'explosive', 'poison',
+    'suicide', 'attack', 'murder', 'steal', 'hack', 'drugs', 'sex', 'nude', 'revenge',
+}
+
+LABELED_EXAMPLES = {
+    'GREETING': [
+        "hi", "hello there", "hey, how's it going?", "good morning!", "thanks for the help",
+        "thank you so much, that was useful", "goodbye", "see you later", "have a great day",
+        "hey jason, love the channel", "appreciate it, bye",
+    ],
+    'RELEVANT': [
+        "how do I set up a crosscut sled for my table saw?",
+        "what router bits does Jason Bent recommend?",
+        "how do I build a workbench with an mft style top?",
+        "best way to finish a walnut table",
+        "which dust collector should I buy for a small shop?",
+        "how to use the festool domino for joinery",
+        "what track saw does bent's woodworking use?",
+        "how should I organize my garage workshop?",
+        "tips for gluing up a cutting board",
+        "what sander grit should I start with on plywood?",
+        "can you explain that last step again?",
+        "what was the tool you mentioned for that?",
+    ],
+    'NOT RELEVANT': [
+        "what's the weather in paris tomorrow?",
+        "who won the football game last night?",
+        "write me a poem about the ocean",
+        "what is the capital of australia?",
+        "help me with my calculus homework",
+        "recommend a good movie to watch",
+    ],
+    'INAPPROPRIATE': [
+        "how do I make a weapon to hurt someone",
+        "how can I build a bomb",
+        "tell me how to steal tools from a store",
+    ],
+}
+
+LABELS = ('GREETING', 'RELEVANT', 'INAPPROPRIATE', 'NOT RELEVANT')
+
+
+def normalize_message(text):
+    return ' '.join(WORD.findall(text.lower().replace('’', "'")))
+
+
+def greeting_kind(text):
+    """'hello', 'thanks' or 'bye' when the whole message is a stock greeting or send-off."""
+    message = normalize_message(text)
+    for kind, phrases in GREETING_PHRASES.items():
+        if message in phrases:
+            return kind
+    return None
+
+
+class IntentClassifier:
+    """
+    Local first stage in front of the LLM relevance check. Keyword rules settle
+    stock greetings and clear woodworking questions without any call at all;
+    otherwise the message embedding is compared with per-label centroids of
+    the labeled examples. Only a confident centroid decision for a label in
+    INTENT_LOCAL_LABELS is taken; anything else falls back to the LLM.
+    """
+
+    def __init__(self, embed, fallback, afallback=None, enabled=INTENT_FAST_PATH,
+                 min_similarity=INTENT_MIN_SIMILARITY, margin=INTENT_MARGIN, local_labels=INTENT_LOCAL_LABELS):
+        self._embed = embed
+        self._fallback = fallback
+        self._afallback = afallback
+        self.enabled = enabled
+        self.min_similarity = min_similarity
+        self.margin = margin
+        self.local_labels = local_labels
+        self._lock = threading.Lock()
+        self._centroids = None
+        self._loading = False
+        self._stats = {'rule': 0, 'centroid': 0, 'llm': 0, 'centroid_errors': 0, 'greeting_template': 0}
+        self._labels = {label: 0 for label in LABELS}
+
+    @timed('classify')
+    def classify(self, query, history=None, embed_query=None):
+        """
+        Label for the message. embed_query is an optional zero-argument callable
+        returning the message embedding, so a caller that is embedding the raw
+        query anyway can share it.
+        """
+        label = self._classify_locally(query, embed_query or (lambda: self._embed(query)))
+        if label is not None:
+            return label
+        return self._count_llm(self._fallback(query, history))
+
+    @timed('classify')
+    async def aclassify(self, query, history=None, embed_query=None):
+        """classify() for the async server; embed_query is a coroutine function here."""
+        embedding = None
+        if self.enabled and embed_query is not None and self._centroids is not None and self._rule(query) is None:
+            try:
+                embedding = await embed_query()
+            except Exception as e:
+                logging.error(f"Local intent classification failed: {str(e)}")
+                with self._lock:
+                    self._stats['centroid_errors'] += 1
+        label = self._classify_locally(query, lambda: embedding)
+        if label is not None:
+            return label
+        return self._count_llm(await self._afallback(query, history))
+
+    def greeting_reply(self, query):
+        """
+        A canned reply when the whole message is a stock greeting or send-off,
+        else None. Checked before any other work for the message is started.
+        """
+        kind = greeting_kind(query) if self.enabled else None
+        if kind is None:
+            return None
+        self._count('rule', 'GREETING')
+        with self._lock:
+            self._stats['greeting_template'] += 1
+        templates = GREETING_TEMPLATES[kind]
+        # Stable per message, so the same message always gets the same reply
+        digest = hashlib.sha1(normalize_message(query).encode('utf-8')).digest()
+        return templates[digest[0] % len(templates)]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['labels'] = dict(self._labels)
+        stats['centroids_loaded'] = self._centroids is not None
+        decided = stats['rule'] + stats['centroid'] + stats['llm']
+        stats['llm_skipped_rate'] = (stats['rule'] + stats['centroid']) / decided if decided else 0.0
+        stats['enabled'] = self.enabled
+        return stats
+
+    def _classify_locally(self, query, embed_query):
+        if not self.enabled:
+            return None
+        label = self._rule(query)
+        source = 'rule'
+        if label is None:
+            label = self._nearest_centroid(embed_query)
+            source = 'centroid'
+        if label is not None:
+            self._count(source, label)
+            logging.debug(f"Intent {label} decided locally by {source}")
+        return label
+
+    def _count_llm(self, response):
+        self._count('llm', next((label for label in reversed(LABELS) if label in response.upper()), None))
+        return response
+
+    def _rule(self, query):
+        if greeting_kind(query):
+            return 'GREETING'
+        words = set(normalize_message(query).split())
+        if words & GUARD_TERMS:
+            return None
+        if 'RELEVANT' in self.local_labels and len(words & WOODWORKING_TERMS) >= 2:
+            return 'RELEVANT'
+        return None
+
+    def _nearest_centroid(self, embed_query):
+        centroids = self._centroids
+        if centroids is None:
+            # Embedding the examples takes a few dozen calls; defer to the LLM until that is done
+            self._start_loading()
+            return None
+        try:
+            query = embed_query()
+        except Exception as e:
+            logging.error(f"Local intent classification failed: {str(e)}")
+            with self._lock:
+                self._stats['centroid_errors'] += 1
+            return None
+        if query is None:
+            return None
+        query = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return None
+        labels, matrix = centroids
+        scores = matrix @ (query / norm)
+        order = np.argsort(-scores)
+        best, runner_up = scores[order[0]], scores[order[1]]
+        label = labels[order[0]]
+        if label in self.local_labels and best >= self.min_similarity and best - runner_up >= self.margin:
+            return label
+        return None
+
+    def _start_loading(self):
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+        threading.Thread(target=self._load_centroids, name="intent-centroids", daemon=True).start()
+
+    def _load_centroids(self):
+        try:
+            labels = []
+            rows = []
+            for label, examples in LABELED_EXAMPLES.items():
+                vectors = np.asarray([self._embed(example) for example in examples], dtype=np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                centroid = vectors.mean(axis=0)
+                labels.append(label)
+                rows.append(centroid / np.linalg.norm(centroid))
+            self._centroids = (labels, np.vstack(rows))
+            logging.info(f"Loaded intent centroids for {len(labels)} labels")
+        except Exception as e:
+            logging.error(f"Error loading intent centroids: {str(e)}")
+            with self._lock:
+                self._stats['centroid_errors'] += 1
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def _count(self, source, label):
+        with self._lock:
+            self._stats[source] += 1
+            if label is not None:
+                self._labels[label] += 1
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import threading
+import uuid
+
+from psycopg2 import Binary
+from psycopg2.extras import RealDictCursor
+
+JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "2"))
+# Idle workers look for jobs queued by other processes this often
+JOB_POLL_SECONDS = float(os.getenv("INGEST_JOB_POLL_SECONDS", "2"))
+# A running job not updated for this long is assumed lost with its process and claimed again
+JOB_STALE_SECONDS = float(os.getenv("INGEST_JOB_STALE_SECONDS", "900"))
+JOB_MAX_ATTEMPTS = int(os.getenv("INGEST_JOB_MAX_ATTEMPTS", "3"))
+
+
+class JobQueue:
+    """
+    Postgres-backed queue for ingestion jobs. The uploaded file is stored in
+    the job row and a pool of worker threads claims jobs with FOR UPDATE SKIP
+    LOCKED, so every server process can run workers against the same table
+    without taking a job twice. handler(job, progress) does the work and
+    returns a JSON-serializable report; progress(done, total) records the
+    job's chunk counts.
+    """
+
+    def __init__(self, connection, handler, table_name="ingest_jobs", workers=JOB_WORKERS,
+                 poll_seconds=JOB_POLL_SECONDS, stale_seconds=JOB_STALE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self._connection = connection
+        self._handler = handler
+        self.table_name = table_name
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._threads = []
+        self._stats = {'enqueued': 0, 'completed': 0, 'failed': 0}
+
+    def start(self):
+        """Create the job table and start the workers; later calls do nothing."""
+        with self._lock:
+            if self._threads:
+                return
+            self._create_table()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"ingest-job-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, filename, payload):
+        self.start()
+        job_id = uuid.uuid4().hex
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"INSERT INTO {self.table_name} (id, filename, payload) VALUES (%s, %s, %s)",
+                    (job_id, filename, Binary(payload))
+                )
+            conn.commit()
+        with self._lock:
+            self._stats['enqueued'] += 1
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        self.start()
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    SELECT id, filename, status, chunks_done, chunks_total, attempts, error, report,
+                           created_at, started_at, finished_at,
+                           EXTRACT(EPOCH FROM started_at - created_at) AS queued_seconds,
+                           EXTRACT(EPOCH FROM COALESCE(finished_at, now()) - started_at) AS run_seconds
+                    FROM {self.table_name}
+                    WHERE id = %s
+                """, (job_id,))
+                job = cur.fetchone()
+        if job is None:
+            return None
+        return {
+            'id': job['id'],
+            'filename': job['filename'],
+            'status': job['status'],
+            'progress': {'chunks_done': job['chunks_done'], 'chunks_total': job['chunks_total']},
+            'attempts': job['attempts'],
+            'error': job['error'],
+            'report': json.loads(job['report']) if job['report'] else None,
+            'timing': {
+                'created_at': job['created_at'].isoformat(),
+                'started_at': job['started_at'].isoformat() if job['started_at'] else None,
+                'finished_at': job['finished_at'].isoformat() if job['finished_at'] else None,
+                'queued_seconds': float(job['queued_seconds']) if job['queued_seconds'] is not None else None,
+                'run_seconds': float(job['run_seconds']) if job['run_seconds'] is not None else None
+            }
+        }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = len(self._threads)
+        return stats
+
+    def _create_table(self):
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {self.table_name} (
+                        id text PRIMARY KEY,
+                        filename text NOT NULL,
+                        payload bytea,
+                        status text NOT NULL DEFAULT 'queued',
+                        chunks_done integer NOT NULL DEFAULT 0,
+                        chunks_total integer,
+                        attempts integer NOT NULL DEFAULT 0,
+                        error text,
+                        report text,
+                        created_at timestamptz NOT NULL DEFAULT now(),
+                        started_at timestamptz,
+                        updated_at timestamptz,
+                        finished_at timestamptz
+                    )
+                """)
+                cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS {self.table_name}_pending_idx
+                    ON {self.table_name} (created_at) WHERE status IN ('queued', 'running')
+                """)
+            conn.commit()
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logging.error(f"Error claiming an ingestion job: {str(e)}")
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _claim(self):
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Jobs whose worker died mid-run are retried until they run out of attempts
+                cur.execute(f"""
+                    UPDATE {self.table_name}
+                    SET status = 'failed', finished_at = now(), payload = NULL,
+                        error = COALESCE(error, 'Worker stopped before the job finished')
+                    WHERE status = 'running' AND updated_at < now() - %s * interval '1 second'
+                      AND attempts >= %s
+                """, (self.stale_seconds, self.max_attempts))
+                cur.execute(f"""
+                    UPDATE {self.table_name}
+                    SET status = 'running', started_at = now(), updated_at = now(), attempts = attempts + 1
+                    WHERE id = (
+                        SELECT id FROM {self.table_name}
+                        WHERE status = 'queued'
+                           OR (status = 'running' AND updated_at < now() - %s * interval '1 second')
+                        ORDER BY created_at
+                        FOR UPDATE SKIP LOCKED
+                        LIMIT 1
+                    )
+                    RETURNING id, filename, payload
+                """, (self.stale_seconds,))
+                job = cur.fetchone()
+            conn.commit()
+        if job is not None:
+            job['payload'] = bytes(job['payload'])
+        return job
+
+    def _run(self, job):
+        def progress(done, total):
+            self._update(job['id'], "chunks_done = %s, chunks_total = %s, updated_at = now()", (done, total))
+
+        try:
+            report = self._handler(job, progress)
+        except Exception as e:
+            logging.error(f"Ingestion job {job['id']} ({job['filename']}) failed: {str(e)}", exc_info=True)
+            self._update(job['id'], "status = 'failed', error = %s, payload = NULL, finished_at = now()", (str(e),))
+            with self._lock:
+                self._stats['failed'] += 1
+            return
+        self._update(job['id'], "status = 'done', report = %s, payload = NULL, finished_at = now()",
+                     (json.dumps(report),))
+        with self._lock:
+            self._stats['completed'] += 1
+
+    def _update(self, job_id, assignments, params):
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"UPDATE {self.table_name} SET {assignments} WHERE id = %s", (*params, job_id))
+                conn.commit()
+        except Exception as e:
+            logging.error(f"Error updating ingestion job {job_id}: {str(e)}")
@@ -0,0 +1,277 @@
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from psycopg2.extras import RealDictCursor
+
+import metrics
+from index_snapshot import VECTOR_SNAPSHOT_CHECK_SECONDS, corpus_version, ensure_version_table
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# How chat retrieval ranks chunks: 'dense' (embeddings), 'lexical' (BM25) or 'hybrid' (both, fused)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+# Results taken from each ranking before hybrid fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+# Reciprocal rank fusion constant; larger values flatten the difference between ranks
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Model numbers like "TS-55" or "DF500" stay searchable whether or not the hyphen is typed
+TOKEN = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'does', 'for', 'from', 'how',
+    'i', 'if', 'in', 'is', 'it', 'its', 'me', 'my', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to',
+    'was', 'what', 'when', 'which', 'with', 'you', 'your',
+}
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if '-' in token:
+            tokens.append(token.replace('-', ''))
+            tokens.extend(part for part in token.split('-') if part not in STOPWORDS)
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings, top_k=5, k=RRF_K):
+    """
+    Fuse ranked result lists (best first) by summing 1 / (k + rank) per
+    chunk. The first list's copy of each result is kept, with rrf_score added.
+    """
+    scores = {}
+    results = {}
+    for ranking in rankings:
+        for rank, result in enumerate(ranking, start=1):
+            chunk_id = result['chunk_id']
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+            results.setdefault(chunk_id, result)
+    fused = sorted(scores, key=lambda chunk_id: -scores[chunk_id])[:top_k]
+    return [dict(results[chunk_id], rrf_score=scores[chunk_id]) for chunk_id in fused]
+
+
+class BM25Index:
+    """
+    In-memory inverted index with BM25 scoring over a chunk table's title and
+    text. Kept current by upsert() from ingestion, like the vector index, so
+    keyword queries (tool names, model numbers) need no embedding call. Like
+    the vector index, it checks the corpus version every check_seconds and
+    reloads when another process changed the table.
+    """
+
+    def __init__(self, table_name, connection, k1=BM25_K1, b=BM25_B, check_seconds=VECTOR_SNAPSHOT_CHECK_SECONDS):
+        self.table_name = table_name
+        self._connection = connection
+        self.k1 = k1
+        self.b = b
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._meta = []
+        self._lengths = []
+        self._positions = {}
+        self._postings = {}
+        self._total_length = 0
+        self._norms = None
+        self._loaded = False
+        self.version = None
+        self._checked_at = 0.0
+        self._checking = False
+
+    def __len__(self):
+        return len(self._positions)
+
+    @metrics.timed('index_load')
+    def load(self):
+        # Read the version first, so a write landing during the fetch is picked up by the next check
+        version = self._corpus_version()
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"SELECT id, text, title, url, chunk_id FROM {self.table_name}")
+                rows = cur.fetchall()
+
+        # Built aside and swapped in, so searches keep using the old index during a reload
+        fresh = BM25Index(self.table_name, self._connection, self.k1, self.b)
+        for row in rows:
+            fresh._add(row)
+        with self._lock:
+            self._meta = fresh._meta
+            self._lengths = fresh._lengths
+            self._positions = fresh._positions
+            self._postings = fresh._postings
+            self._total_length = fresh._total_length
+            self._norms = None
+            self._loaded = True
+        self.version = version
+        self._checked_at = time.monotonic()
+        metrics.count('index_load', 'rows_scanned', len(rows))
+        logging.info(f"Loaded {len(rows)} chunks from {self.table_name} into the BM25 index")
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            # Concurrent first searches wait for one load instead of each building the index
+            with self._load_lock:
+                if not self._loaded:
+                    self.load()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+    def upsert(self, records):
+        """Insert or replace chunks keyed by chunk_id; records need id, text, title, url and chunk_id."""
+        if not self._loaded:
+            return
+        with self._lock:
+            for record in records:
+                self._add(record)
+
+    def remove(self, chunk_ids):
+        """Drop deleted chunks. Their slots stay behind, empty, until the next load."""
+        if not self._loaded:
+            return
+        with self._lock:
+            for chunk_id in chunk_ids:
+                position = self._positions.pop(chunk_id, None)
+                if position is None:
+                    continue
+                for term in set(self._terms(self._meta[position])):
+                    self._postings[term].pop(position, None)
+                self._total_length -= self._lengths[position]
+                self._lengths[position] = 0
+                self._norms = None
+
+    def search(self, query, top_k=5):
+        self.ensure_loaded()
+        self._check_version()
+        with metrics.stage('lexical'):
+            return self._search(query, top_k)
+
+    def _search(self, query, top_k):
+        terms = Counter(tokenize(query))
+        with self._lock:
+            count = len(self._positions)
+            if not count or not terms:
+                return []
+            norms = self._length_norms()
+            scores = np.zeros(len(self._meta), dtype=np.float32)
+            for term, repeats in terms.items():
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                positions = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+                frequencies = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+                scores[positions] += repeats * idf * frequencies * (self.k1 + 1) / (frequencies + norms[positions])
+            meta = self._meta
+
+        matched = np.flatnonzero(scores)
+        metrics.count('lexical', 'rows_scanned', len(matched))
+        if not len(matched):
+            return []
+        k = min(top_k, len(matched))
+        candidates = matched[np.argpartition(-scores[matched], k - 1)[:k]] if k < len(matched) else matched
+        top = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [dict(meta[i], bm25_score=float(scores[i])) for i in top]
+
+    def _check_version(self):
+        """Look for a newer corpus version in the background every check_seconds."""
+        if time.monotonic() - self._checked_at < self.check_seconds:
+            return
+        with self._lock:
+            if self._checking:
+                return
+            self._checking = True
+            self._checked_at = time.monotonic()
+        threading.Thread(target=self._refresh, name=f"bm25-check-{self.table_name}", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            version = self._corpus_version()
+            if version != self.version:
+                logging.info(f"{self.table_name} changed ({self.version} -> {version}); reloading the BM25 index")
+                with self._load_lock:
+                    self.load()
+        except Exception as e:
+            logging.error(f"Error checking the corpus version of {self.table_name}: {str(e)}")
+        finally:
+            with self._lock:
+                self._checking = False
+
+    def _corpus_version(self):
+        ensure_version_table(self._connection)
+        with self._connection() as conn:
+            return corpus_version(conn, self.table_name)
+
+    def _length_norms(self):
+        # The per-document length term of BM25; rebuilt only after the corpus changes
+        if self._norms is None:
+            lengths = np.asarray(self._lengths, dtype=np.float32)
+            average = self._total_length / (len(self._positions) or 1) or 1.0
+            self._norms = self.k1 * (1 - self.b + self.b * lengths / average)
+        return self._norms
+
+    def _add(self, row):
+        entry = {
+            'id': row['id'],
+            'text': row['text'],
+            'title': row['title'],
+            'url': row['url'],
+            'chunk_id': row['chunk_id']
+        }
+        position = self._positions.get(entry['chunk_id'])
+        if position is None:
+            position = len(self._meta)
+            self._positions[entry['chunk_id']] = position
+            self._meta.append(entry)
+            self._lengths.append(0)
+        else:
+            # Replaced chunk: take its old terms out first
+            for term in set(self._terms(self._meta[position])):
+                self._postings[term].pop(position, None)
+            self._total_length -= self._lengths[position]
+            self._meta[position] = entry
+
+        terms = self._terms(entry)
+        for term, frequency in Counter(terms).items():
+            self._postings.setdefault(term, {})[position] = frequency
+        self._lengths[position] = len(terms)
+        self._total_length += len(terms)
+        self._norms = None
+
+    @staticmethod
+    def _terms(entry):
+        return tokenize(f"{entry['title'] or ''} {entry['text'] or ''}")
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(table_name, connection):
+    with _indexes_lock:
+        if table_name not in _indexes:
+            _indexes[table_name] = BM25Index(table_name, connection)
+        return _indexes[table_name]
+
+
+def notify_upsert(table_name, records):
+    with _indexes_lock:
+        index = _indexes.get(table_name)
+    if index is not None:
+        index.upsert(records)
+
+
+def notify_delete(table_name, chunk_ids):
+    with _indexes_lock:
+        index = _indexes.get(table_name)
+    if index is not None:
+        index.remove(chunk_ids)
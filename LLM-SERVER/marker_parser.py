@@ -0,0 +1,174 @@
+import re
+
+MARKER_PATTERNS = {
+    'timestamp': re.compile(r'\{timestamp:([^\}]+)\}'),
+    'title': re.compile(r'\{title:([^\}]+)\}'),
+    'url': re.compile(r'\{url:([^\}]+)\}'),
+}
+MARKER_STARTS = {kind: '{' + kind + ':' for kind in MARKER_PATTERNS}
+CLEANUP_PATTERNS = [
+    re.compile(r'\{timestamp:[^\}]+\}'),
+    re.compile(r'\{title:[^\}]+\}'),
+    re.compile(r'\{url:[^\}]+\}'),
+    re.compile(r'\[?video\s*\d+\]?', re.IGNORECASE),
+]
+# Text at the end of the buffer that could still grow into a "[video 3]" reference
+PARTIAL_VIDEO_REF = re.compile(r'\[?(?:v(?:i(?:d(?:e(?:o\s*\d*)?)?)?)?)?$', re.IGNORECASE)
+CONTEXT_WINDOW = 150
+
+
+def clean_text(text):
+    for pattern in CLEANUP_PATTERNS:
+        text = pattern.sub('', text)
+    return text
+
+
+class StreamingMarkerParser:
+    """
+    Incremental version of process_answer for streamed answers.
+
+    feed() takes each new chunk, returns the chunk's text with citation markers
+    stripped, and the citations that became complete with it. A citation is
+    complete once its timestamp and title are closed, its url (the first
+    {url:} at or after the timestamp) is known, and the description context
+    window around it has fully arrived. Every pass only looks at text that has
+    not been resolved yet, so the work per chunk does not grow with the answer.
+
+    Completed citations carry the describer's preview (cached or extractive)
+    description; finish() fetches the real descriptions for all of them in one
+    describe_many() call and returns the citations it updated. After finish(),
+    video_dict has the same entries process_answer builds for the whole answer.
+    """
+
+    def __init__(self, describer, combine_url):
+        self.describer = describer
+        self.combine_url = combine_url
+        self.raw_text = ''
+        self.clean_text = ''
+        self.video_dict = {}
+        self._matches = {kind: [] for kind in MARKER_PATTERNS}
+        self._scan_pos = {kind: 0 for kind in MARKER_PATTERNS}
+        self._url_cursor = 0
+        self._emitted_raw = 0
+        self._pending = []
+
+    def feed(self, chunk):
+        self.raw_text += chunk
+        self._scan_markers()
+        text = self._flush_text(final=False)
+        return text, self._complete_citations(final=False)
+
+    def finish(self):
+        text, completed = self._drain()
+        if self._pending:
+            descriptions = self.describer.describe_many([item for _, item in self._pending])
+            self._apply_descriptions(descriptions, completed)
+        return text, completed
+
+    async def afinish(self):
+        """finish() with the describer's adescribe_many, for the async server."""
+        text, completed = self._drain()
+        if self._pending:
+            descriptions = await self.describer.adescribe_many([item for _, item in self._pending])
+            self._apply_descriptions(descriptions, completed)
+        return text, completed
+
+    def _drain(self):
+        self._scan_markers()
+        text = self._flush_text(final=True)
+        return text, self._complete_citations(final=True)
+
+    def _apply_descriptions(self, descriptions, completed):
+        for (key, _), description in zip(self._pending, descriptions):
+            if self.video_dict[key]['description'] != description:
+                self.video_dict[key]['description'] = description
+                completed[key] = self.video_dict[key]
+        self._pending = []
+
+    def _scan_markers(self):
+        for kind, pattern in MARKER_PATTERNS.items():
+            pos = self._scan_pos[kind]
+            for match in pattern.finditer(self.raw_text, pos):
+                self._matches[kind].append((match.start(), match.group(1)))
+                pos = match.end()
+
+            # Resume next time from the earliest marker that is still open
+            start = MARKER_STARTS[kind]
+            while True:
+                index = self.raw_text.find(start, pos)
+                if index == -1:
+                    pos = max(pos, len(self.raw_text) - len(start) + 1)
+                    break
+                if self.raw_text.find('}', index) == -1:
+                    pos = index
+                    break
+                # Closed but not a valid marker (e.g. empty); skip past it
+                pos = index + 1
+            self._scan_pos[kind] = pos
+
+    def _flush_text(self, final):
+        buffer = self.raw_text[self._emitted_raw:]
+        cut = len(buffer) if final else self._safe_cut(buffer)
+        text = clean_text(buffer[:cut])
+        self._emitted_raw += cut
+        self.clean_text += text
+        return text
+
+    @staticmethod
+    def _safe_cut(buffer):
+        """Length of the buffer prefix that no marker or video reference can straddle."""
+        cut = len(buffer)
+        for start in MARKER_STARTS.values():
+            index = buffer.find(start)
+            while index != -1:
+                if buffer.find('}', index) == -1:
+                    cut = min(cut, index)
+                    break
+                index = buffer.find(start, index + 1)
+        brace = buffer.rfind('{')
+        if brace != -1 and '}' not in buffer[brace:]:
+            tail = buffer[brace:]
+            if any(start.startswith(tail) for start in MARKER_STARTS.values()):
+                cut = min(cut, brace)
+        partial = PARTIAL_VIDEO_REF.search(buffer)
+        if partial and partial.start() < len(buffer):
+            cut = min(cut, partial.start())
+        return cut
+
+    def _complete_citations(self, final):
+        timestamps = self._matches['timestamp']
+        titles = self._matches['title']
+        urls = self._matches['url']
+        completed = {}
+        while len(self.video_dict) < min(len(timestamps), len(titles)):
+            i = len(self.video_dict)
+            position, timestamp = timestamps[i]
+
+            while self._url_cursor < len(urls) and urls[self._url_cursor][0] < position:
+                self._url_cursor += 1
+            url = urls[self._url_cursor][1] if self._url_cursor < len(urls) else None
+            context_ready = len(self.raw_text) >= position + CONTEXT_WINDOW
+            if not final and (url is None or not context_ready):
+                break
+
+            start = max(0, position - CONTEXT_WINDOW)
+            end = min(len(self.raw_text), position + CONTEXT_WINDOW)
+            window = self.raw_text[start:end]
+            context = window.strip()
+            item = {
+                'title': titles[i][1],
+                'timestamp': timestamp,
+                'context': context,
+                'offset': position - start - (len(window) - len(window.lstrip()))
+            }
+
+            entry = {
+                'urls': [self.combine_url(url, timestamp)] if url else [],
+                'timestamp': timestamp,
+                'description': self.describer.preview(item),
+                'video_title': titles[i][1]
+            }
+            self.video_dict[str(i)] = entry
+            self._pending.append((str(i), item))
+            completed[str(i)] = entry
+        return completed
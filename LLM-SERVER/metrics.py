@@ -0,0 +1,224 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the stage latency histogram buckets
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNTERS = {
+    'calls': "Times each /chat stage ran.",
+    'errors': "Times each /chat stage failed.",
+    'bytes': "Bytes produced by each /chat stage.",
+    'rows_scanned': "Chunk rows fetched or scored by each retrieval stage.",
+    'tokens': "Tokens handled by each /chat stage.",
+}
+
+
+class StageMetrics:
+    """
+    Process-wide latency histograms and counters per /chat stage, rendered in
+    the Prometheus text format for /metrics. Each gunicorn worker keeps its
+    own; Prometheus sums them per instance.
+    """
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {name: {} for name in COUNTERS}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            self._counters['calls'][stage] = self._counters['calls'].get(stage, 0) + 1
+
+    def count(self, stage, counter, amount=1):
+        with self._lock:
+            values = self._counters[counter]
+            values[stage] = values.get(stage, 0) + amount
+
+    def render(self):
+        with self._lock:
+            histograms = {stage: dict(h, buckets=list(h['buckets'])) for stage, h in self._histograms.items()}
+            counters = {name: dict(values) for name, values in self._counters.items()}
+
+        lines = [
+            "# HELP chat_stage_seconds Wall time spent in each /chat stage.",
+            "# TYPE chat_stage_seconds histogram",
+        ]
+        for stage in sorted(histograms):
+            histogram = histograms[stage]
+            cumulative = 0
+            for bound, observed in zip(self.buckets, histogram['buckets']):
+                cumulative += observed
+                lines.append(f'chat_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'chat_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'chat_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+            lines.append(f'chat_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        for name, description in COUNTERS.items():
+            lines.append(f"# HELP chat_stage_{name}_total {description}")
+            lines.append(f"# TYPE chat_stage_{name}_total counter")
+            for stage in sorted(counters[name]):
+                lines.append(f'chat_stage_{name}_total{{stage="{stage}"}} {counters[name][stage]}')
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    """Per-request time by stage, sent in the final stream frame. Concurrent stages overlap."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0.0) + seconds
+
+    def breakdown(self):
+        with self._lock:
+            stages = {stage: round(seconds * 1000, 1) for stage, seconds in self._stages.items()}
+        return {'total_ms': round((time.perf_counter() - self.started) * 1000, 1), 'stages': stages}
+
+
+metrics = StageMetrics()
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request():
+    """Begin timing a request in the current context; worker threads inherit it via copy_context()."""
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def record(stage, seconds):
+    metrics.observe(stage, seconds)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+def count(stage, counter, amount=1):
+    metrics.count(stage, counter, amount)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.count(name, 'errors')
+        raise
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """Decorator recording each call of a function or coroutine function as stage name."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def metered_stream(generate, *args):
+    """
+    Run a /chat frame generator under a fresh RequestTimings, counting the
+    bytes sent and recording the whole stream as the 'total' stage.
+    generate is called with the timings after args.
+    """
+    timings = start_request()
+    with stage('total'):
+        for line in generate(*args, timings):
+            metrics.count('stream', 'bytes', len(line.encode('utf-8')))
+            yield line
+
+
+async def ametered_stream(generate, *args):
+    timings = start_request()
+    with stage('total'):
+        async for line in generate(*args, timings):
+            metrics.count('stream', 'bytes', len(line.encode('utf-8')))
+            yield line
+
+
+def metered_tokens(chunks):
+    """
+    Pass an LLM stream through, recording the time to the first chunk as
+    'llm_first_token' and the time spent waiting on the rest as 'llm_stream'.
+    OpenAI streams about one token per chunk, so chunks are counted as tokens.
+    """
+    iterator = iter(chunks)
+    started = time.perf_counter()
+    waited = 0.0
+    tokens = 0
+    try:
+        while True:
+            before = time.perf_counter()
+            chunk = next(iterator, None)
+            if tokens == 0:
+                record('llm_first_token', time.perf_counter() - started)
+            else:
+                waited += time.perf_counter() - before
+            if chunk is None:
+                break
+            tokens += 1
+            metrics.count('llm_stream', 'bytes', len(chunk.content.encode('utf-8')))
+            yield chunk
+    except Exception:
+        metrics.count('llm_stream', 'errors')
+        raise
+    finally:
+        metrics.count('llm_stream', 'tokens', tokens)
+        record('llm_stream', waited)
+
+
+async def ametered_tokens(chunks):
+    iterator = chunks.__aiter__()
+    started = time.perf_counter()
+    waited = 0.0
+    tokens = 0
+    try:
+        while True:
+            before = time.perf_counter()
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            if tokens == 0:
+                record('llm_first_token', time.perf_counter() - started)
+            else:
+                waited += time.perf_counter() - before
+            if chunk is None:
+                break
+            tokens += 1
+            metrics.count('llm_stream', 'bytes', len(chunk.content.encode('utf-8')))
+            yield chunk
+    except Exception:
+        metrics.count('llm_stream', 'errors')
+        raise
+    finally:
+        metrics.count('llm_stream', 'tokens', tokens)
+        record('llm_stream', waited)
@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "16"))
+# Embed and retrieve on the raw query while classification and rewriting run
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+# Reuse the speculative documents when raw and rewritten queries are at least this similar
+SPECULATIVE_REUSE_THRESHOLD = float(os.getenv("SPECULATIVE_REUSE_THRESHOLD", "0.95"))
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pre-retrieval")
+
+
+def _submit(fn, *args):
+    # Each task runs in a copy of the caller's context so stage timings reach the request
+    return _executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def cosine(v1, v2):
+    v1 = np.asarray(v1, dtype=np.float32)
+    v2 = np.asarray(v2, dtype=np.float32)
+    denominator = np.linalg.norm(v1) * np.linalg.norm(v2)
+    return float(np.dot(v1, v2) / denominator) if denominator else 0.0
+
+
+class PreRetrieval:
+    """
+    The work between receiving a chat message and generating the answer:
+    relevance classification, query rewriting and retrieval. Classification
+    and rewriting are started together, and retrieval on the raw query runs
+    speculatively next to them. classify is passed a callable for the raw
+    query's embedding, so a local classifier can share it. Callers read the
+    pieces in the order they need them; cancel() drops whatever is still
+    outstanding when the message turns out not to need retrieval.
+    """
+
+    def __init__(self, query, history, classify, rewrite, embed, retrieve):
+        self.query = query
+        self._embed = embed
+        self._retrieve = retrieve
+        self._raw_embedding = _submit(embed, query) if SPECULATIVE_RETRIEVAL else None
+        self._relevance = _submit(classify, query, history, self.raw_embedding)
+        self._rewrite = _submit(rewrite, query, history)
+        self._speculative = _submit(self._retrieve_raw) if SPECULATIVE_RETRIEVAL else None
+        self._rewritten_embedding = None
+        self.reused_speculative = False
+
+    def _retrieve_raw(self):
+        embedding = self.raw_embedding()
+        return embedding, self._retrieve(self.query, embedding)
+
+    def raw_embedding(self):
+        """Embedding of the query as typed, shared by classification and speculative retrieval."""
+        if self._raw_embedding is None:
+            # Not started speculatively; embed in the calling thread rather than queue behind the pool
+            return self._embed(self.query)
+        return self._raw_embedding.result()
+
+    def relevance(self):
+        return self._relevance.result()
+
+    def rewritten_query(self):
+        return self._rewrite.result()
+
+    def rewritten_embedding(self):
+        if self._rewritten_embedding is None:
+            self._rewritten_embedding = self._embed(self.rewritten_query())
+        return self._rewritten_embedding
+
+    def documents(self):
+        """Retrieved documents for the rewritten query, reusing the speculative ones if close enough."""
+        embedding = self.rewritten_embedding()
+        if self._speculative is not None:
+            try:
+                raw_embedding, documents = self._speculative.result()
+                similarity = cosine(raw_embedding, embedding)
+                if similarity >= SPECULATIVE_REUSE_THRESHOLD:
+                    self.reused_speculative = True
+                    logging.debug(f"Reusing speculative retrieval (similarity {similarity:.3f})")
+                    return documents
+            except Exception as e:
+                logging.error(f"Speculative retrieval failed: {str(e)}")
+        return self._retrieve(self.rewritten_query(), embedding)
+
+    def cancel(self):
+        for future in (self._rewrite, self._speculative, self._raw_embedding):
+            if future is not None:
+                future.cancel()
+
+
+class AsyncPreRetrieval:
+    """
+    PreRetrieval for the async server: the same stages as asyncio tasks, with
+    coroutine functions for classify, rewrite, embed and retrieve.
+    """
+
+    def __init__(self, query, history, classify, rewrite, embed, retrieve):
+        self.query = query
+        self._embed = embed
+        self._retrieve = retrieve
+        self._raw_embedding = asyncio.ensure_future(embed(query)) if SPECULATIVE_RETRIEVAL else None
+        self._relevance = asyncio.ensure_future(classify(query, history, self.raw_embedding))
+        self._rewrite = asyncio.ensure_future(rewrite(query, history))
+        self._speculative = asyncio.ensure_future(self._retrieve_raw()) if SPECULATIVE_RETRIEVAL else None
+        self._rewritten_embedding = None
+        self.reused_speculative = False
+
+    async def _retrieve_raw(self):
+        embedding = await self.raw_embedding()
+        return embedding, await self._retrieve(self.query, embedding)
+
+    async def raw_embedding(self):
+        if self._raw_embedding is None:
+            return await self._embed(self.query)
+        # shield() so one waiter being cancelled does not cancel the shared embedding
+        return await asyncio.shield(self._raw_embedding)
+
+    async def relevance(self):
+        return await self._relevance
+
+    async def rewritten_query(self):
+        return await self._rewrite
+
+    async def rewritten_embedding(self):
+        if self._rewritten_embedding is None:
+            self._rewritten_embedding = await self._embed(await self.rewritten_query())
+        return self._rewritten_embedding
+
+    async def documents(self):
+        embedding = await self.rewritten_embedding()
+        if self._speculative is not None:
+            try:
+                raw_embedding, documents = await self._speculative
+                similarity = cosine(raw_embedding, embedding)
+                if similarity >= SPECULATIVE_REUSE_THRESHOLD:
+                    self.reused_speculative = True
+                    logging.debug(f"Reusing speculative retrieval (similarity {similarity:.3f})")
+                    return documents
+            except Exception as e:
+                logging.error(f"Speculative retrieval failed: {str(e)}")
+        return await self._retrieve(await self.rewritten_query(), embedding)
+
+    def cancel(self):
+        for task in (self._rewrite, self._speculative, self._raw_embedding):
+            if task is not None:
+                task.cancel()
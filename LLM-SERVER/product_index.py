@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import time
+
+from psycopg2.extras import RealDictCursor
+
+from index_snapshot import corpus_version, ensure_version_table
+
+# Seconds between checks of the products version, which every product write bumps
+# (the Express server's included); the table is only re-read when it changed
+PRODUCT_INDEX_TTL = float(os.getenv("PRODUCT_INDEX_TTL", "30"))
+GRAM = 3
+
+
+def grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def split_tags(tags):
+    return tags.split(',') if tags else []
+
+
+class ProductIndex:
+    """
+    In-memory copy of the products table for matching video titles to products.
+    A title matches a product when it occurs in the product's tags string,
+    case-insensitively, which is what LOWER(tags) LIKE LOWER('%title%') did.
+    Candidates come from a trigram inverted index over the lowercased tags and
+    are then confirmed with a substring check, so a lookup never scans every
+    product.
+    """
+
+    def __init__(self, connection, ttl=PRODUCT_INDEX_TTL):
+        self._connection = connection
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Serializes reloads, so an expired TTL sends one query to the database, not one per request
+        self._load_lock = threading.Lock()
+        self._products = {}
+        self._haystacks = {}
+        self._postings = {}
+        self._loaded_at = None
+        self.version = None
+
+    def load(self):
+        version = self._corpus_version()
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT id, title, tags, link FROM products ORDER BY id")
+                rows = cur.fetchall()
+
+        products = {}
+        haystacks = {}
+        postings = {}
+        for row in rows:
+            self._add(products, haystacks, postings, row)
+        with self._lock:
+            self._products = products
+            self._haystacks = haystacks
+            self._postings = postings
+            self._loaded_at = time.monotonic()
+            self.version = version
+        logging.info(f"Loaded {len(products)} products into the product index")
+
+    def ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at <= self.ttl:
+            return
+        if self._loaded_at is None:
+            with self._load_lock:
+                if self._loaded_at is None:
+                    self.load()
+            return
+        # Requests arriving while another one refreshes keep matching against the loaded products
+        if not self._load_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._loaded_at > self.ttl:
+                self._refresh()
+        finally:
+            self._load_lock.release()
+
+    def upsert(self, product):
+        """product: dict with id, title, link and tags as a comma-joined string."""
+        if self._loaded_at is None:
+            return
+        with self._lock:
+            products = dict(self._products)
+            haystacks = dict(self._haystacks)
+            postings = {gram: set(ids) for gram, ids in self._postings.items()}
+            self._discard(products, haystacks, postings, product['id'])
+            self._add(products, haystacks, postings, product)
+            self._products, self._haystacks, self._postings = products, haystacks, postings
+
+    def remove(self, product_id):
+        if self._loaded_at is None:
+            return
+        with self._lock:
+            products = dict(self._products)
+            haystacks = dict(self._haystacks)
+            postings = {gram: set(ids) for gram, ids in self._postings.items()}
+            self._discard(products, haystacks, postings, product_id)
+            self._products, self._haystacks, self._postings = products, haystacks, postings
+
+    def match(self, video_title):
+        return self.match_all([video_title])
+
+    def match_all(self, video_titles):
+        """Products matching any of the titles, deduplicated, in product id order."""
+        self.ensure_loaded()
+        with self._lock:
+            products, haystacks, postings = self._products, self._haystacks, self._postings
+
+        matched = set()
+        for title in video_titles:
+            if not title:
+                continue
+            needle = title.lower()
+            if len(needle) < GRAM:
+                candidates = haystacks.keys()
+            else:
+                candidates = None
+                for gram in sorted(grams(needle), key=lambda g: len(postings.get(g, ()))):
+                    ids = postings.get(gram)
+                    if not ids:
+                        candidates = set()
+                        break
+                    candidates = set(ids) if candidates is None else candidates & ids
+                    if not candidates:
+                        break
+            matched.update(product_id for product_id in candidates
+                           if product_id not in matched and needle in haystacks[product_id])
+
+        return [products[product_id] for product_id in sorted(matched)]
+
+    def _refresh(self):
+        try:
+            if self._corpus_version() != self.version:
+                self.load()
+        except Exception as e:
+            logging.error(f"Error refreshing the product index: {str(e)}")
+        # Unchanged or unreachable, the loaded products serve until the next check
+        with self._lock:
+            self._loaded_at = time.monotonic()
+
+    def _corpus_version(self):
+        ensure_version_table(self._connection)
+        with self._connection() as conn:
+            return corpus_version(conn, 'products')
+
+    @staticmethod
+    def _add(products, haystacks, postings, row):
+        products[row['id']] = {
+            'id': row['id'],
+            'title': row['title'],
+            'tags': split_tags(row['tags']),
+            'link': row['link']
+        }
+        haystack = (row['tags'] or '').lower()
+        haystacks[row['id']] = haystack
+        for gram in grams(haystack):
+            postings.setdefault(gram, set()).add(row['id'])
+
+    @staticmethod
+    def _discard(products, haystacks, postings, product_id):
+        if product_id not in products:
+            return
+        for gram in grams(haystacks[product_id]):
+            ids = postings.get(gram)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del postings[gram]
+        del products[product_id]
+        del haystacks[product_id]
@@ -0,0 +1,136 @@
+"""
+Int8 scalar quantization for the resident vector index, and a report of
+what it costs in recall.
+
+    python quantization.py --table bents --queries 200 --snapshot-dir /var/lib/bents/snapshots
+
+prints recall@5 against exact float32 search, latency and scanned size for
+several QUANTIZED_RERANK settings. Quantized search scans 4x fewer bytes but
+is not faster than a float32 BLAS scan, since numpy has no int8 kernel; use
+it to cut memory, and VIDEO_NPROBE to cut latency.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+# 'int8' ranks the index on per-dimension int8 codes stored in its snapshot and re-ranks the
+# shortlist in float32; needs VECTOR_SNAPSHOT_DIR
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none")
+# Candidates from the int8 ranking re-scored against the float vectors
+QUANTIZED_RERANK = int(os.getenv("QUANTIZED_RERANK", "200"))
+# Rows widened to float32 per step while scoring; small enough to stay in cache
+SCORE_BLOCK_ROWS = 256
+
+
+class Int8Quantizer:
+    """
+    Symmetric per-dimension scalar quantization: each dimension is scaled so
+    its largest magnitude maps to 127. Queries stay in float32 with the scales
+    folded in, so a score is one dot product with the codes.
+    """
+
+    def __init__(self, scales):
+        self.scales = np.asarray(scales, dtype=np.float32)
+
+    @classmethod
+    def fit(cls, matrix):
+        peaks = np.zeros(matrix.shape[1], dtype=np.float32)
+        for start in range(0, len(matrix), 65536):
+            np.maximum(peaks, np.abs(matrix[start:start + 65536]).max(axis=0), out=peaks)
+        return cls(np.where(peaks > 0, peaks / 127, 1.0))
+
+    def encode(self, matrix):
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        for start in range(0, len(matrix), 65536):
+            block = np.rint(matrix[start:start + 65536] / self.scales)
+            codes[start:start + len(block)] = np.clip(block, -127, 127)
+        return codes
+
+    def scores(self, codes, query):
+        """Approximate dot products of every coded row with a float32 query."""
+        weights = (np.asarray(query, dtype=np.float32) * self.scales).astype(np.float32)
+        scores = np.empty(len(codes), dtype=np.float32)
+        # numpy has no int8 matrix product, so codes are widened a cache-sized block at a time
+        buffer = np.empty((SCORE_BLOCK_ROWS, codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK_ROWS):
+            block = codes[start:start + SCORE_BLOCK_ROWS]
+            widened = buffer[:len(block)]
+            np.copyto(widened, block, casting='unsafe')
+            np.dot(widened, weights, out=scores[start:start + len(block)])
+        return scores
+
+
+def recall_report(index, queries, top_k=5, reranks=(5, 50, 100, 200, 500, 1000)):
+    """
+    recall@top_k of quantized search against exact float32 search over the
+    same index, with mean latency per setting. A rerank of top_k means the
+    int8 ranking alone. Video routing is turned off, so the loss measured is
+    the quantization's alone.
+    """
+    index.ensure_loaded()
+    # The quantized index reads float rows from disk on demand; read them all once for the baseline
+    matrix = index._matrix[np.arange(len(index))]
+    queries = np.asarray(queries, dtype=np.float32)
+    exact = []
+    # Touch the whole matrix once so the exact baseline is not charged for page faults
+    matrix @ (queries[0] / np.linalg.norm(queries[0]))
+    started = time.perf_counter()
+    for query in queries:
+        scores = matrix @ (query / np.linalg.norm(query))
+        exact.append(set(np.argpartition(-scores, top_k - 1)[:top_k].tolist()))
+    report = [{
+        'rerank': None,
+        'recall': 1.0,
+        'mean_ms': (time.perf_counter() - started) * 1000 / len(queries)
+    }]
+
+    positions = {entry['chunk_id']: i for i, entry in enumerate(index._meta)}
+    for rerank in reranks:
+        hits = 0
+        started = time.perf_counter()
+        for query, expected in zip(queries, exact):
+            found = index.search(query, top_k, rerank=max(rerank, top_k), nprobe=0)
+            hits += len(expected & {positions[result['chunk_id']] for result in found})
+        report.append({
+            'rerank': rerank,
+            'recall': hits / (top_k * len(queries)),
+            'mean_ms': (time.perf_counter() - started) * 1000 / len(queries)
+        })
+    return report
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    import db_pool
+    from index_snapshot import VECTOR_SNAPSHOT_DIR
+    from vector_index import VectorIndex
+
+    parser = argparse.ArgumentParser(description="Recall and latency of int8 quantized retrieval")
+    parser.add_argument("--table", default="bents")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.5,
+                        help="Queries are stored vectors plus Gaussian noise of this norm")
+    parser.add_argument("--snapshot-dir", default=VECTOR_SNAPSHOT_DIR,
+                        help="Where the quantized snapshot is kept (default: VECTOR_SNAPSHOT_DIR)")
+    args = parser.parse_args()
+    if not args.snapshot_dir:
+        parser.error("int8 search needs a snapshot directory: pass --snapshot-dir or set VECTOR_SNAPSHOT_DIR")
+
+    index = VectorIndex(args.table, db_pool.connection, snapshot_dir=args.snapshot_dir, quantization='int8')
+    index.load()
+    rng = np.random.default_rng(0)
+    samples = index._matrix[rng.choice(len(index), size=min(args.queries, len(index)), replace=False)]
+    noise = rng.standard_normal(samples.shape).astype(np.float32)
+    queries = samples + args.noise * noise / np.linalg.norm(noise, axis=1, keepdims=True)
+
+    print(f"{len(index)} vectors: int8 codes {index._codes.nbytes / 2 ** 20:.1f} MiB scanned per query, "
+          f"float32 {len(index) * index.dimension * 4 / 2 ** 20:.1f} MiB left on disk")
+    print(f"{'rerank':>8} {'recall@' + str(args.top_k):>10} {'mean ms':>9}")
+    for row in recall_report(index, queries, args.top_k):
+        print(f"{'exact' if row['rerank'] is None else row['rerank']:>8} {row['recall']:10.3f} {row['mean_ms']:9.2f}")
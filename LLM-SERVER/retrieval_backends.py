@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import logging
+import os
+import threading
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+import async_db
+import lexical_index
+import metrics
+from vector_index import (
+    BINARY_FORMATS, VECTOR_STORAGE, decode_vector, encode_vector, get_vector_index, vector_column
+)
+
+DEFAULT_BACKEND = os.getenv("RETRIEVAL_BACKEND", "memory")
+EMBEDDING_DIMENSION = 1536
+
+
+def cosine_similarity(v1, v2):
+    return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
+
+
+def format_vector(vector):
+    """Render an embedding as a pgvector literal ('[0.1,0.2,...]')."""
+    return '[' + ','.join(str(float(x)) for x in vector) + ']'
+
+
+class RetrievalBackend:
+    """
+    Similarity search over a chunk table. Every backend returns the same
+    result dicts (id, text, title, url, chunk_id, similarity_score) ordered by
+    descending similarity.
+    """
+    name = None
+
+    def __init__(self, table_name, connection):
+        self.table_name = table_name
+        self._connection = connection
+
+    def search(self, query_embedding, top_k=5):
+        raise NotImplementedError
+
+    async def asearch(self, query_embedding, top_k=5):
+        """search() for the async server. In-process backends run in a worker thread."""
+        return await asyncio.to_thread(self.search, query_embedding, top_k)
+
+    def upsert(self, records):
+        """Called after chunks are written so resident state can follow the table."""
+        pass
+
+    def remove(self, chunk_ids):
+        """Called after chunks are deleted from the table."""
+        pass
+
+
+class MemoryBackend(RetrievalBackend):
+    """Brute-force search over the resident NumPy index."""
+    name = "memory"
+
+    def search(self, query_embedding, top_k=5):
+        return get_vector_index(self.table_name, self._connection).search(query_embedding, top_k)
+
+    def upsert(self, records):
+        get_vector_index(self.table_name, self._connection).upsert(records)
+
+    def remove(self, chunk_ids):
+        get_vector_index(self.table_name, self._connection).remove(chunk_ids)
+
+
+class ScanBackend(RetrievalBackend):
+    """Fetch and score every row per query. Kept as the reference implementation."""
+    name = "scan"
+
+    def search(self, query_embedding, top_k=5):
+        column = vector_column()
+        with metrics.stage('db_fetch'):
+            with self._connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(f"""
+                        SELECT id, {column} AS vector, text, title, url, chunk_id
+                        FROM {self.table_name}
+                        WHERE {column} IS NOT NULL
+                    """)
+                    rows = cur.fetchall()
+        metrics.count('db_fetch', 'rows_scanned', len(rows))
+
+        with metrics.stage('scoring'):
+            similarities = []
+            for row in rows:
+                try:
+                    vector = decode_vector(row['vector'])
+                    if len(vector) == len(query_embedding):
+                        similarity = cosine_similarity(query_embedding, vector)
+                        similarities.append((similarity, row))
+                except Exception as e:
+                    logging.error(f"Error processing vector for row {row['id']}: {str(e)}")
+                    continue
+
+            similarities.sort(reverse=True, key=lambda x: x[0])
+        metrics.count('scoring', 'rows_scanned', len(rows))
+        return [
+            {
+                'id': row['id'],
+                'text': row['text'],
+                'title': row['title'],
+                'url': row['url'],
+                'chunk_id': row['chunk_id'],
+                'similarity_score': float(sim)
+            }
+            for sim, row in similarities[:top_k]
+        ]
+
+
+class PgVectorBackend(RetrievalBackend):
+    """
+    Let Postgres rank the chunks. Requires the vector column to be a pgvector
+    column (see migrate_to_pgvector) so the ANN index serves ORDER BY ... LIMIT.
+    Not usable with binary VECTOR_STORAGE, which leaves bents.vector empty.
+    """
+    name = "pgvector"
+
+    def __init__(self, table_name, connection):
+        super().__init__(table_name, connection)
+        if VECTOR_STORAGE != 'text':
+            logging.warning(f"pgvector backend reads bents.vector but VECTOR_STORAGE is {VECTOR_STORAGE}")
+        self.ef_search = os.getenv("PGVECTOR_EF_SEARCH")
+        self.probes = os.getenv("PGVECTOR_PROBES")
+
+    @metrics.timed('db_fetch')
+    def search(self, query_embedding, top_k=5):
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if self.ef_search:
+                    cur.execute("SET LOCAL hnsw.ef_search = %s", (int(self.ef_search),))
+                if self.probes:
+                    cur.execute("SET LOCAL ivfflat.probes = %s", (int(self.probes),))
+                cur.execute(f"""
+                    SELECT id, text, title, url, chunk_id,
+                           1 - (vector <=> %s::vector) AS similarity_score
+                    FROM {self.table_name}
+                    WHERE vector IS NOT NULL
+                    ORDER BY vector <=> %s::vector
+                    LIMIT %s
+                """, (format_vector(query_embedding), format_vector(query_embedding), top_k))
+                rows = cur.fetchall()
+            conn.commit()
+
+        metrics.count('db_fetch', 'rows_scanned', len(rows))
+        return self._results(rows)
+
+    @metrics.timed('db_fetch')
+    async def asearch(self, query_embedding, top_k=5):
+        vector = format_vector(query_embedding)
+        async with async_db.connection() as conn:
+            async with conn.transaction():
+                if self.ef_search:
+                    await conn.execute(f"SET LOCAL hnsw.ef_search = {int(self.ef_search)}")
+                if self.probes:
+                    await conn.execute(f"SET LOCAL ivfflat.probes = {int(self.probes)}")
+                rows = await conn.fetch(f"""
+                    SELECT id, text, title, url, chunk_id,
+                           1 - (vector <=> $1::text::vector) AS similarity_score
+                    FROM {self.table_name}
+                    WHERE vector IS NOT NULL
+                    ORDER BY vector <=> $1::text::vector
+                    LIMIT $2
+                """, vector, top_k)
+        metrics.count('db_fetch', 'rows_scanned', len(rows))
+        return self._results(rows)
+
+    @staticmethod
+    def _results(rows):
+        return [
+            {
+                'id': row['id'],
+                'text': row['text'],
+                'title': row['title'],
+                'url': row['url'],
+                'chunk_id': row['chunk_id'],
+                'similarity_score': float(row['similarity_score'])
+            }
+            for row in rows
+        ]
+
+
+BACKENDS = {
+    MemoryBackend.name: MemoryBackend,
+    ScanBackend.name: ScanBackend,
+    PgVectorBackend.name: PgVectorBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_retrieval_backend(table_name, connection, name=None):
+    name = name or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown retrieval backend: {name}")
+    with _backends_lock:
+        key = (name, table_name)
+        if key not in _backends:
+            _backends[key] = BACKENDS[name](table_name, connection)
+        return _backends[key]
+
+
+def notify_upsert(table_name, records):
+    """Pass freshly written chunks to every live backend and the BM25 index serving table_name."""
+    with _backends_lock:
+        backends = [backend for (_, table), backend in _backends.items() if table == table_name]
+    for backend in backends:
+        backend.upsert(records)
+    lexical_index.notify_upsert(table_name, records)
+
+
+def notify_delete(table_name, chunk_ids):
+    """Drop deleted chunks from every live backend and the BM25 index serving table_name."""
+    with _backends_lock:
+        backends = [backend for (_, table), backend in _backends.items() if table == table_name]
+    for backend in backends:
+        backend.remove(chunk_ids)
+    lexical_index.notify_delete(table_name, chunk_ids)
+
+
+def migrate_to_pgvector(connect, table_name="bents", dimension=EMBEDDING_DIMENSION, index="hnsw", lists=100):
+    """
+    Convert the text-encoded vector column to vector(dimension) in place and
+    build a cosine ANN index on it. Text literals like '[0.1, 0.2]' cast
+    directly, and reads still come back as the same text form, so the memory
+    and scan backends keep working on the migrated table.
+    """
+    if index not in ("hnsw", "ivfflat"):
+        raise ValueError(f"Unknown index type: {index}")
+
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute("""
+                SELECT format_type(a.atttypid, a.atttypmod)
+                FROM pg_attribute a
+                WHERE a.attrelid = %s::regclass AND a.attname = 'vector'
+            """, (table_name,))
+            column_type = cur.fetchone()[0]
+            if not column_type.startswith('vector'):
+                logging.info(f"Converting {table_name}.vector from {column_type} to vector({dimension})")
+                cur.execute(f"""
+                    ALTER TABLE {table_name}
+                    ALTER COLUMN vector TYPE vector({dimension})
+                    USING vector::vector({dimension})
+                """)
+
+            index_name = f"{table_name}_vector_{index}_idx"
+            if index == "hnsw":
+                cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS {index_name}
+                    ON {table_name} USING hnsw (vector vector_cosine_ops)
+                """)
+            else:
+                cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS {index_name}
+                    ON {table_name} USING ivfflat (vector vector_cosine_ops)
+                    WITH (lists = %s)
+                """, (lists,))
+            cur.execute(f"ANALYZE {table_name}")
+        conn.commit()
+        logging.info(f"Migrated {table_name} to pgvector with {index} index {index_name}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def migrate_to_binary(connect, table_name="bents", storage="float32", batch_size=500, clear_text=False):
+    """
+    Add the vector_bin bytea column and fill it from the text vectors in
+    batches. With clear_text the text column is nulled afterwards to reclaim
+    the space; only do that once every reader runs with binary VECTOR_STORAGE.
+    """
+    if storage not in BINARY_FORMATS:
+        raise ValueError(f"Unknown binary storage: {storage}")
+
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS vector_bin bytea")
+        conn.commit()
+
+        converted = 0
+        last_id = None
+        while True:
+            # Page by id so rows that fail to convert are not fetched again
+            after = "" if last_id is None else "AND id > %(last_id)s"
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT id, vector::text FROM {table_name}
+                    WHERE vector IS NOT NULL AND vector_bin IS NULL {after}
+                    ORDER BY id
+                    LIMIT %(batch_size)s
+                """, {'last_id': last_id, 'batch_size': batch_size})
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                for row_id, value in rows:
+                    try:
+                        encoded = encode_vector(decode_vector(value), storage)
+                    except Exception as e:
+                        logging.error(f"Error converting vector for row {row_id}: {str(e)}")
+                        continue
+                    cur.execute(
+                        f"UPDATE {table_name} SET vector_bin = %s WHERE id = %s",
+                        (psycopg2.Binary(encoded), row_id)
+                    )
+                last_id = rows[-1][0]
+            conn.commit()
+            converted += len(rows)
+            logging.info(f"Converted {converted} vectors in {table_name} to {storage}")
+
+        if clear_text:
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE {table_name} SET vector = NULL WHERE vector_bin IS NOT NULL")
+            conn.commit()
+            logging.info(f"Cleared text vectors in {table_name}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Retrieval backend maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate-pgvector", help="Convert text vectors to a pgvector column with an ANN index")
+    migrate.add_argument("--table", default="bents")
+    migrate.add_argument("--dimension", type=int, default=EMBEDDING_DIMENSION)
+    migrate.add_argument("--index", choices=["hnsw", "ivfflat"], default="hnsw")
+    migrate.add_argument("--lists", type=int, default=100, help="ivfflat list count")
+    binary = subparsers.add_parser("migrate-binary", help="Copy text vectors into the vector_bin bytea column")
+    binary.add_argument("--table", default="bents")
+    binary.add_argument("--storage", choices=sorted(BINARY_FORMATS), default="float32")
+    binary.add_argument("--batch-size", type=int, default=500)
+    binary.add_argument("--clear-text", action="store_true", help="Null the text vectors once converted")
+    args = parser.parse_args()
+
+    if args.command == "migrate-pgvector":
+        migrate_to_pgvector(
+            lambda: psycopg2.connect(os.getenv("POSTGRES_URL")),
+            table_name=args.table,
+            dimension=args.dimension,
+            index=args.index,
+            lists=args.lists
+        )
+    elif args.command == "migrate-binary":
+        migrate_to_binary(
+            lambda: psycopg2.connect(os.getenv("POSTGRES_URL")),
+            table_name=args.table,
+            storage=args.storage,
+            batch_size=args.batch_size,
+            clear_text=args.clear_text
+        )
@@ -0,0 +1,156 @@
+import json
+import os
+import time
+
+# Clients send {"stream_version": 2} with the chat request to get delta frames
+DEFAULT_STREAM_VERSION = int(os.getenv("DEFAULT_STREAM_VERSION", "1"))
+STREAM_VERSIONS = (1, 2)
+# Version 2 holds text back until this many characters or milliseconds have built up
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", "64"))
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "50"))
+
+
+def frame(payload):
+    return json.dumps(payload) + '\n'
+
+
+def reply_frame(frame_type, response, timings=None):
+    # The not-relevant reply has always been sent stripped
+    payload = {
+        'response': response.strip() if frame_type == 'not_relevant' else response,
+        'type': frame_type,
+        'done': True
+    }
+    if timings is not None:
+        payload['timings'] = timings
+    return frame(payload)
+
+
+def answer_frame(response, frame_type, video_links, related_products, timings=None):
+    payload = {
+        'response': response,
+        'type': frame_type,
+        'done': frame_type == 'final',
+        'video_links': video_links,
+        'related_products': related_products
+    }
+    if timings is not None:
+        # Per-request stage breakdown, trailing the final frame
+        payload['timings'] = timings
+    return frame(payload)
+
+
+class FullStreamEncoder:
+    """
+    Version 1, what the current frontend reads: one frame per model token,
+    each carrying the new text plus the complete video_links and
+    related_products.
+    """
+    version = 1
+
+    def chunk(self, text, citations, video_links, related_products):
+        yield answer_frame(text, 'chunk', video_links, related_products)
+
+    def tail(self, text, citations, video_links, related_products):
+        if text:
+            yield answer_frame(text, 'chunk', video_links, related_products)
+
+    def final(self, response, video_links, related_products, timings=None):
+        yield answer_frame(response, 'final', video_links, related_products, timings)
+
+    def replay(self, cached, timings=None):
+        yield answer_frame(cached['processed_answer'], 'chunk', cached['video_links'], cached['related_products'])
+        yield answer_frame(cached['response'], 'final', cached['video_links'], cached['related_products'], timings)
+
+
+class DeltaStreamEncoder:
+    """
+    Version 2. Frames only carry what changed:
+
+        {"type": "text", "text": "..."}                    new answer text, coalesced
+        {"type": "citations", "video_links": {"0": ...}}   citations added or updated
+        {"type": "products", "related_products": [...]}    products not sent before
+        {"type": "final", "done": true, "response": ..., "video_links": ...,
+         "related_products": ..., "frames": n, "text_chars": n, "timings": {...}}
+
+    The final frame carries the raw answer and the complete citations and
+    products, like version 1, plus frame and character totals and the
+    request's per-stage timings.
+    """
+    version = 2
+
+    def __init__(self, coalesce_chars=STREAM_COALESCE_CHARS, coalesce_ms=STREAM_COALESCE_MS):
+        self.coalesce_chars = coalesce_chars
+        self.coalesce_seconds = coalesce_ms / 1000
+        self._buffer = ''
+        self._flushed_at = time.monotonic()
+        self._product_ids = set()
+        self.frames = 0
+        self.text_chars = 0
+
+    def chunk(self, text, citations, video_links, related_products):
+        self._buffer += text
+        changes = list(self._changes(citations, related_products))
+        if changes or len(self._buffer) >= self.coalesce_chars or \
+                time.monotonic() - self._flushed_at >= self.coalesce_seconds:
+            # Text goes first so citations never arrive ahead of the words they follow
+            yield from self._flush()
+        for change in changes:
+            yield self._frame(change)
+
+    def tail(self, text, citations, video_links, related_products):
+        self._buffer += text
+        yield from self._flush()
+        for change in self._changes(citations, related_products):
+            yield self._frame(change)
+
+    def final(self, response, video_links, related_products, timings=None):
+        yield from self._flush()
+        self.frames += 1
+        payload = {
+            'type': 'final',
+            'done': True,
+            'response': response,
+            'video_links': video_links,
+            'related_products': related_products,
+            'frames': self.frames,
+            'text_chars': self.text_chars
+        }
+        if timings is not None:
+            payload['timings'] = timings
+        yield frame(payload)
+
+    def replay(self, cached, timings=None):
+        yield from self.tail(cached['processed_answer'], cached['video_links'], cached['video_links'],
+                             cached['related_products'])
+        yield from self.final(cached['response'], cached['video_links'], cached['related_products'], timings)
+
+    def _changes(self, citations, related_products):
+        if citations:
+            yield {'type': 'citations', 'video_links': citations}
+        new_products = [product for product in related_products if product['id'] not in self._product_ids]
+        if new_products:
+            self._product_ids.update(product['id'] for product in new_products)
+            yield {'type': 'products', 'related_products': new_products}
+
+    def _flush(self):
+        self._flushed_at = time.monotonic()
+        if self._buffer:
+            text, self._buffer = self._buffer, ''
+            self.text_chars += len(text)
+            yield self._frame({'type': 'text', 'text': text})
+
+    def _frame(self, payload):
+        self.frames += 1
+        return frame(payload)
+
+
+def stream_encoder(version=None):
+    """Encoder for the requested protocol version; unknown versions get the default."""
+    try:
+        version = int(version)
+    except (TypeError, ValueError):
+        version = DEFAULT_STREAM_VERSION
+    if version not in STREAM_VERSIONS:
+        version = DEFAULT_STREAM_VERSION
+    return DeltaStreamEncoder() if version == 2 else FullStreamEncoder()
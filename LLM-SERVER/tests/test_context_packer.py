@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+from context_packer import chunk_position, pack_context, strip_overlap
+
+
+def doc(text, chunk_id, score):
+    return SimpleNamespace(page_content=text, metadata={'chunk_id': chunk_id, 'similarity_score': score})
+
+
+def test_similarity_floor_drops_weak_results():
+    docs = [doc("strong match", "A_chunk_0", 0.80), doc("weak match", "B_chunk_0", 0.69)]
+    context, report = pack_context(docs, budget=1000, min_similarity=0.70, max_gap=0.5)
+    assert context == "strong match"
+    assert report['dropped'] == 1
+
+
+def test_best_result_is_kept_below_the_floor():
+    context, report = pack_context([doc("only match", "A_chunk_0", 0.40)], budget=1000, min_similarity=0.70)
+    assert context == "only match"
+    assert report['dropped'] == 0
+
+
+def test_score_gap_drops_results_far_below_the_best():
+    docs = [doc("best", "A_chunk_0", 0.95), doc("close", "B_chunk_0", 0.85), doc("far", "C_chunk_0", 0.75)]
+    context, report = pack_context(docs, budget=1000, min_similarity=0.70, max_gap=0.15)
+    assert context == "best\n\nclose"
+    assert report['dropped'] == 1
+
+
+def test_consecutive_chunks_merge_without_the_overlap():
+    overlap = "the fence is square to the blade"
+    first = "Set the rip fence first so " + overlap
+    second = overlap + " and then lock it down."
+    docs = [doc(second, "Fence Setup_chunk_4", 0.90), doc(first, "Fence Setup_chunk_3", 0.88)]
+    context, report = pack_context(docs, budget=1000, min_similarity=0.70)
+    assert context == first + " and then lock it down."
+    assert report['passages'] == 1
+
+
+def test_chunks_with_a_gap_stay_separate_passages():
+    docs = [doc("chunk two", "Video_chunk_2", 0.90), doc("chunk five", "Video_chunk_5", 0.89)]
+    context, report = pack_context(docs, budget=1000, min_similarity=0.70)
+    assert report['passages'] == 2
+    assert context == "chunk two\n\nchunk five"
+
+
+def test_budget_truncates_only_the_first_passage():
+    docs = [doc("word " * 400, "A_chunk_0", 0.90), doc("short", "B_chunk_0", 0.89)]
+    context, report = pack_context(docs, budget=10, min_similarity=0.70)
+    assert report['context_tokens'] <= 10
+    assert "short" not in context
+
+
+def test_chunk_position_and_overlap_helpers():
+    assert chunk_position("My Video_chunk_12") == ("My Video", 12)
+    assert chunk_position("no number") == ("no number", None)
+    assert strip_overlap("abc", "abcdef") == "abcdef"
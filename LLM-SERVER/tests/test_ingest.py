@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip('docx')
+pytest.importorskip('langchain')
+
+import ingest
+from ingest import build_chunk_rows, content_hash, plan_transcript
+
+
+class Connection:
+    """Connection factory answering plan_transcript's query with fixed stored chunks."""
+
+    def __init__(self, stored):
+        self.stored = stored
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return list(self.stored)
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    """Set the rows stored for the video: (chunk_id, content_hash, text if unhashed, vector missing)."""
+    def install(rows):
+        monkeypatch.setattr(ingest, 'ensure_hash_column', lambda table_name: None)
+        monkeypatch.setattr(ingest.db_pool, 'connection', Connection(rows))
+    return install
+
+
+def rows(*chunks):
+    return build_chunk_rows(list(chunks), {'title': 'Sled'})
+
+
+def test_build_chunk_rows_hashes_each_chunk():
+    built = rows("first chunk", "second chunk")
+    assert [row['chunk_id'] for row in built] == ['Sled_chunk_0', 'Sled_chunk_1']
+    assert built[1]['content_hash'] == content_hash("second chunk")
+    assert content_hash("second chunk") != content_hash("second chunk ")
+
+
+def test_unchanged_chunks_are_reused(stored):
+    stored([('Sled_chunk_0', content_hash("a"), None, False), ('Sled_chunk_1', content_hash("b"), None, False)])
+    plan = plan_transcript(rows("a", "b"))
+    assert plan['embed'] == []
+    assert plan['reused'] == 2
+    assert plan['stale'] == []
+
+
+def test_changed_added_and_stale_chunks(stored):
+    stored([('Sled_chunk_0', content_hash("a"), None, False), ('Sled_chunk_1', content_hash("b"), None, False),
+            ('Sled_chunk_2', content_hash("c"), None, False)])
+    plan = plan_transcript(rows("a", "b edited"))
+    assert [row['chunk_id'] for row in plan['embed']] == ['Sled_chunk_1']
+    assert (plan['reused'], plan['changed'], plan['added']) == (1, 1, 0)
+    assert plan['stale'] == ['Sled_chunk_2']
+
+    stored([('Sled_chunk_0', content_hash("a"), None, False)])
+    plan = plan_transcript(rows("a", "new"))
+    assert [row['chunk_id'] for row in plan['embed']] == ['Sled_chunk_1']
+    assert plan['added'] == 1
+
+
+def test_unhashed_rows_compare_by_text_and_get_backfilled(stored):
+    stored([('Sled_chunk_0', None, "a", False), ('Sled_chunk_1', None, "old", False)])
+    plan = plan_transcript(rows("a", "new"))
+    assert [row['chunk_id'] for row in plan['embed']] == ['Sled_chunk_1']
+    assert plan['backfill'] == [(content_hash("a"), 'Sled_chunk_0')]
+
+
+def test_rows_without_a_vector_are_reembedded(stored):
+    stored([('Sled_chunk_0', content_hash("a"), None, True)])
+    plan = plan_transcript(rows("a"))
+    assert [row['chunk_id'] for row in plan['embed']] == ['Sled_chunk_0']
+    assert plan['changed'] == 1
+
+
+def test_empty_transcript_plans_nothing():
+    assert plan_transcript([])['embed'] == []
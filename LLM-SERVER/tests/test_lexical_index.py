@@ -0,0 +1,82 @@
+import pytest
+
+from lexical_index import BM25Index, reciprocal_rank_fusion, tokenize
+
+ROWS = [
+    {'id': 1, 'title': 'Track Saw Basics', 'text': 'The TS-55 track saw cuts sheet goods straight.', 'url': '',
+     'chunk_id': 'Track Saw Basics_chunk_0'},
+    {'id': 2, 'title': 'Dust Collection', 'text': 'A cyclone keeps the dust collector filter clean.', 'url': '',
+     'chunk_id': 'Dust Collection_chunk_0'},
+    {'id': 3, 'title': 'Shop Tour', 'text': 'The track saw hangs on the wall next to the dust collector hose. '
+     'Most of the shop is storage for clamps and sheet goods.', 'url': '', 'chunk_id': 'Shop Tour_chunk_0'},
+]
+
+
+class Connection:
+    """Connection factory answering the BM25 load query with fixed rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, cursor_factory=None):
+        return self
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+@pytest.fixture
+def index(monkeypatch):
+    monkeypatch.setattr(BM25Index, '_corpus_version', lambda self: '1:3')
+    index = BM25Index('bents', Connection(ROWS), check_seconds=3600)
+    index.load()
+    return index
+
+
+def test_tokenize_keeps_model_numbers_searchable():
+    assert tokenize("The TS-55 and DF500") == ['ts-55', 'ts55', 'ts', '55', 'df500']
+
+
+def test_focused_chunk_outranks_a_longer_one(index):
+    results = index.search("track saw", top_k=3)
+    assert [result['id'] for result in results] == [1, 3]
+    assert results[0]['bm25_score'] > results[1]['bm25_score']
+
+
+def test_model_number_matches_without_the_hyphen(index):
+    assert [result['id'] for result in index.search("ts55")] == [1]
+
+
+def test_upsert_replaces_and_remove_drops(index):
+    index.upsert([dict(ROWS[1], text='Nothing about that anymore.', title='Renamed')])
+    assert [result['id'] for result in index.search("cyclone")] == []
+    index.remove(['Shop Tour_chunk_0'])
+    assert [result['id'] for result in index.search("dust collector")] == []
+    assert len(index) == 2
+
+
+def test_rrf_rewards_agreement_between_rankings():
+    dense = [{'chunk_id': 'a', 'source': 'dense'}, {'chunk_id': 'b', 'source': 'dense'}]
+    lexical = [{'chunk_id': 'b', 'source': 'lexical'}, {'chunk_id': 'c', 'source': 'lexical'}]
+    fused = reciprocal_rank_fusion([dense, lexical], top_k=3, k=60)
+    assert [result['chunk_id'] for result in fused] == ['b', 'a', 'c']
+    # The first ranking's copy of a shared result is kept
+    assert fused[0]['source'] == 'dense'
+    assert fused[0]['rrf_score'] == pytest.approx(1 / 62 + 1 / 61)
+
+
+def test_rrf_truncates_to_top_k():
+    ranking = [{'chunk_id': str(i)} for i in range(10)]
+    assert [result['chunk_id'] for result in reciprocal_rank_fusion([ranking], top_k=2)] == ['0', '1']
@@ -0,0 +1,64 @@
+import pytest
+
+from marker_parser import StreamingMarkerParser
+
+
+class Describer:
+    def preview(self, item):
+        return 'preview'
+
+    def describe_many(self, items):
+        return [f"{item['title']} at {item['timestamp']}" for item in items]
+
+
+def parse(answer, step):
+    parser = StreamingMarkerParser(Describer(), lambda url, timestamp: f"{url}?t={timestamp}")
+    text = ''
+    for start in range(0, len(answer), step):
+        chunk_text, _ = parser.feed(answer[start:start + step])
+        text += chunk_text
+    tail, _ = parser.finish()
+    return text + tail, parser.video_dict
+
+
+def test_markers_are_stripped_and_cited():
+    answer = "Use a sled {timestamp:01:30}{title:Sled Video}{url:https://youtu.be/abc} for crosscuts [video 1]."
+    text, video_dict = parse(answer, len(answer))
+    assert text == "Use a sled  for crosscuts ."
+    assert video_dict == {
+        '0': {
+            'urls': ['https://youtu.be/abc?t=01:30'],
+            'timestamp': '01:30',
+            'description': 'Sled Video at 01:30',
+            'video_title': 'Sled Video'
+        }
+    }
+
+
+@pytest.mark.parametrize('answer', [
+    "Use a sled {timestamp:01:30}{title:Sled Video}{url:https://youtu.be/abc} for crosscuts [video 1].",
+    "First {timestamp:00:05}{title:A}{url:https://a} then Video 2 {timestamp:03:00}{title:B}{url:https://b} done",
+    "A long lead in. " * 20 + "{timestamp:10:00}{title:Late}{url:https://late}" + " trailing words." * 20,
+])
+def test_markers_split_across_chunks(answer):
+    # One character per chunk splits every marker and video reference somewhere
+    assert parse(answer, 1) == parse(answer, len(answer))
+    assert parse(answer, 3) == parse(answer, len(answer))
+
+
+def test_unclosed_marker_is_kept_as_text():
+    text, video_dict = parse("Clamp it {timestamp:02:00}{title:Glue", 1)
+    assert text == "Clamp it {title:Glue"
+    assert video_dict == {}
+
+
+def test_url_is_taken_from_after_the_timestamp():
+    text, video_dict = parse("{url:https://a}{timestamp:00:10}{title:T} no url after", 1)
+    assert text == " no url after"
+    assert video_dict['0']['urls'] == []
+
+
+def test_title_without_timestamp_is_not_cited():
+    text, video_dict = parse("See Video 2 and {title:Only title}", 1)
+    assert text == "See  and "
+    assert video_dict == {}
@@ -0,0 +1,71 @@
+import json
+
+from stream_protocol import DEFAULT_STREAM_VERSION, DeltaStreamEncoder, FullStreamEncoder, stream_encoder
+
+PRODUCT = {'id': 'p1', 'title': 'Clamp'}
+CITATION = {'0': {'urls': ['https://youtu.be/abc?t=90'], 'timestamp': '01:30'}}
+
+
+def decode(frames):
+    return [json.loads(line) for line in frames]
+
+
+def test_text_is_coalesced_until_the_character_threshold():
+    encoder = DeltaStreamEncoder(coalesce_chars=10, coalesce_ms=60000)
+    assert decode(encoder.chunk("Use ", {}, {}, [])) == []
+    assert decode(encoder.chunk("a ", {}, {}, [])) == []
+    assert decode(encoder.chunk("sled.", {}, {}, [])) == [{'type': 'text', 'text': "Use a sled."}]
+
+
+def test_text_is_flushed_after_the_time_threshold():
+    encoder = DeltaStreamEncoder(coalesce_chars=1000, coalesce_ms=0)
+    assert decode(encoder.chunk("Hi", {}, {}, [])) == [{'type': 'text', 'text': "Hi"}]
+
+
+def test_citations_and_new_products_are_sent_once_after_the_text():
+    encoder = DeltaStreamEncoder(coalesce_chars=1000, coalesce_ms=60000)
+    frames = decode(encoder.chunk("See this", CITATION, CITATION, [PRODUCT]))
+    assert frames == [
+        {'type': 'text', 'text': "See this"},
+        {'type': 'citations', 'video_links': CITATION},
+        {'type': 'products', 'related_products': [PRODUCT]},
+    ]
+    # The same products again carry nothing new
+    assert decode(encoder.chunk(" too", {}, CITATION, [PRODUCT])) == []
+
+
+def test_final_frame_flushes_and_counts():
+    encoder = DeltaStreamEncoder(coalesce_chars=1000, coalesce_ms=60000)
+    list(encoder.chunk("Hello", {}, {}, []))
+    frames = decode(encoder.final("Hello", CITATION, [PRODUCT], timings={'total_ms': 5}))
+    assert frames[0] == {'type': 'text', 'text': "Hello"}
+    assert frames[1] == {
+        'type': 'final',
+        'done': True,
+        'response': "Hello",
+        'video_links': CITATION,
+        'related_products': [PRODUCT],
+        'frames': 2,
+        'text_chars': 5,
+        'timings': {'total_ms': 5}
+    }
+
+
+def test_replay_sends_text_citations_products_and_final():
+    cached = {'processed_answer': "Cached", 'response': "Cached", 'video_links': CITATION,
+              'related_products': [PRODUCT]}
+    frames = decode(DeltaStreamEncoder().replay(cached))
+    assert [frame['type'] for frame in frames] == ['text', 'citations', 'products', 'final']
+
+
+def test_version_one_repeats_everything_per_chunk():
+    frames = decode(FullStreamEncoder().chunk("Hi", CITATION, CITATION, [PRODUCT]))
+    assert frames == [{'response': "Hi", 'type': 'chunk', 'done': False, 'video_links': CITATION,
+                       'related_products': [PRODUCT]}]
+
+
+def test_stream_encoder_falls_back_to_the_default():
+    assert stream_encoder(2).version == 2
+    assert stream_encoder("2").version == 2
+    assert stream_encoder("bogus").version == DEFAULT_STREAM_VERSION
+    assert stream_encoder(7).version == DEFAULT_STREAM_VERSION
@@ -0,0 +1,69 @@
+import numpy as np
+
+from video_routing import VideoRouter
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def assert_same_router(router, matrix, titles):
+    """router matches one built from scratch over matrix and titles."""
+    expected = VideoRouter.build(matrix, titles)
+    assert sorted(router._titles) == sorted(expected._titles)
+    for title in expected._titles:
+        assert router._groups[title] == expected._groups[title]
+        np.testing.assert_allclose(router._sums[router._rows[title]], expected._sums[expected._rows[title]],
+                                   atol=1e-6)
+
+
+def sample():
+    matrix = np.vstack([unit(1, 0, 0), unit(1, 0.1, 0), unit(0, 1, 0), unit(0, 0, 1)])
+    return matrix, ['Sled', 'Sled', 'Bench', 'Cart']
+
+
+def test_candidates_come_from_the_closest_videos():
+    matrix, titles = sample()
+    router = VideoRouter.build(matrix, titles)
+    assert len(router) == 3
+    assert router.candidates(unit(1, 0, 0), 1).tolist() == [0, 1]
+    assert router.candidates(unit(0, 1, 0.9), 2).tolist() == [2, 3]
+
+
+def test_add_to_a_new_and_an_existing_video():
+    matrix, titles = sample()
+    router = VideoRouter.build(matrix, titles)
+    added = [unit(0, 1, 0.2), unit(0.5, 0.5, 0.5)]
+    router.add(4, 'Bench', added[0])
+    router.add(5, 'Drawers', added[1])
+    assert_same_router(router, np.vstack([matrix] + added), titles + ['Bench', 'Drawers'])
+
+
+def test_replace_moves_the_centroid():
+    matrix, titles = sample()
+    router = VideoRouter.build(matrix, titles)
+    replacement = unit(1, 0, 0.2)
+    assert router.candidates(unit(1, 0, 0.3), 1).tolist() == [0, 1]
+    router.replace('Bench', matrix[2], replacement)
+    matrix[2] = replacement
+    assert_same_router(router, matrix, titles)
+    assert router.candidates(unit(1, 0, 0.3), 1).tolist() == [2]
+
+
+def test_remove_shifts_positions_and_drops_empty_videos():
+    matrix, titles = sample()
+    router = VideoRouter.build(matrix, titles)
+    router.remove({1: matrix[1], 2: matrix[2]}, len(matrix))
+    keep = [0, 3]
+    assert_same_router(router, matrix[keep], [titles[i] for i in keep])
+    assert len(router) == 2
+
+
+def test_copy_is_not_affected_by_later_updates():
+    matrix, titles = sample()
+    router = VideoRouter.build(matrix, titles)
+    before = router.copy()
+    router.add(4, 'Sled', unit(1, 1, 0))
+    router.remove({2: matrix[2]}, 5)
+    assert_same_router(before, matrix, titles)
@@ -0,0 +1,446 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from psycopg2 import Binary
+from psycopg2.extras import RealDictCursor
+
+import metrics
+from index_snapshot import (
+    VECTOR_SNAPSHOT_CHECK_SECONDS, VECTOR_SNAPSHOT_DIR, SnapshotRows, corpus_version, ensure_version_table,
+    open_snapshot, rebuild_lock, snapshot_path, write_snapshot
+)
+from quantization import QUANTIZED_RERANK, VECTOR_QUANTIZATION, Int8Quantizer
+from video_routing import VIDEO_NPROBE, VideoRouter
+
+# How embeddings are written: 'text' keeps the stringified list in bents.vector,
+# 'float32' / 'float16' write raw little-endian bytes to the bents.vector_bin bytea column
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "text")
+
+# Binary vectors carry a 4-byte format tag so float32 and float16 rows can coexist
+# and the payload stays 4-byte aligned for np.frombuffer
+BINARY_FORMATS = {
+    'float32': (b'F32\x00', np.dtype('<f4')),
+    'float16': (b'F16\x00', np.dtype('<f2')),
+}
+BINARY_TAGS = {tag: dtype for tag, dtype in BINARY_FORMATS.values()}
+TAG_SIZE = 4
+
+
+def parse_vector(value):
+    """Parse a stored vector ('[0.1, 0.2, ...]') into a float32 array."""
+    return np.array(value.strip('[]').split(','), dtype=np.float32)
+
+
+def encode_vector(vector, storage=None):
+    storage = storage or VECTOR_STORAGE
+    if storage == 'text':
+        return str([float(x) for x in vector])
+    tag, dtype = BINARY_FORMATS[storage]
+    return tag + np.asarray(vector, dtype=dtype).tobytes()
+
+
+def decode_vector(value):
+    """
+    Decode a stored vector. Binary values are wrapped with np.frombuffer, so the
+    returned array is a read-only view over the driver's buffer, not a copy.
+    Text values fall back to parse_vector.
+    """
+    if isinstance(value, str):
+        return parse_vector(value)
+    buffer = memoryview(value)
+    tag = bytes(buffer[:TAG_SIZE])
+    if tag not in BINARY_TAGS:
+        raise ValueError(f"Unknown vector format tag: {tag!r}")
+    return np.frombuffer(buffer, dtype=BINARY_TAGS[tag], offset=TAG_SIZE)
+
+
+def vector_column(storage=None):
+    return 'vector' if (storage or VECTOR_STORAGE) == 'text' else 'vector_bin'
+
+
+def storage_value(vector, storage=None):
+    """The query parameter to write for the configured vector column."""
+    storage = storage or VECTOR_STORAGE
+    if storage == 'text':
+        return encode_vector(vector, storage)
+    return Binary(encode_vector(vector, storage))
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex:
+    """
+    Resident copy of a chunk table: a contiguous, pre-normalized float32 matrix
+    plus a parallel list of chunk metadata. Top-k is one matrix-vector product
+    followed by argpartition instead of a per-row Python loop. Every
+    check_seconds a search looks up the corpus version in the background and
+    reloads when another process wrote to the table.
+
+    With snapshot_dir set, the matrix and metadata are memory-mapped from a
+    snapshot file shared by every worker process. The worker that finds the
+    snapshot behind the corpus version rebuilds it from the table; the others
+    wait for it and map the result. Chunks upserted in this process are kept
+    in private memory until the next snapshot is loaded.
+
+    With quantization='int8' (snapshots only), the snapshot also carries
+    per-dimension int8 codes of every row, and the codes are all this process
+    scans. Float32 rows are read from the snapshot file only for the best
+    rerank candidates, so the vectors a worker touches per query shrink 4x.
+    numpy has no int8 kernel, so this saves memory, not scan time.
+
+    With nprobe set, search first picks the nprobe videos whose chunk
+    centroid is closest to the query and scores only their chunks.
+    """
+
+    def __init__(self, table_name, connection, snapshot_dir=VECTOR_SNAPSHOT_DIR,
+                 check_seconds=VECTOR_SNAPSHOT_CHECK_SECONDS, quantization=VECTOR_QUANTIZATION,
+                 rerank=QUANTIZED_RERANK, nprobe=VIDEO_NPROBE):
+        self.table_name = table_name
+        self._connection = connection
+        self.snapshot_dir = snapshot_dir
+        self.check_seconds = check_seconds
+        self.quantization = quantization
+        if quantization == 'int8' and not snapshot_dir:
+            # Without a snapshot the codes would sit next to a resident float32 matrix, costing memory
+            logging.error(f"VECTOR_QUANTIZATION=int8 needs VECTOR_SNAPSHOT_DIR; searching {table_name} unquantized")
+            self.quantization = 'none'
+        self.rerank = rerank
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._matrix = None
+        self._meta = []
+        self._positions = {}
+        self._quantizer = None
+        self._codes = None
+        self._router = None
+        self._loaded = False
+        self.version = None
+        self._checked_at = 0.0
+        self._checking = False
+
+    def __len__(self):
+        return len(self._meta)
+
+    @property
+    def dimension(self):
+        return self._matrix.shape[1] if self._matrix is not None and self._matrix.size else None
+
+    @metrics.timed('index_load')
+    def load(self):
+        if self.snapshot_dir:
+            try:
+                self._load_snapshot()
+                return
+            except Exception as e:
+                logging.error(f"Index snapshot for {self.table_name} unavailable, loading from the database: {str(e)}")
+        # Read the version first, so a write landing during the fetch is picked up by the next check
+        version = self._corpus_version()
+        matrix, _, meta = self._fetch()
+        self._use(matrix, meta, {entry['chunk_id']: i for i, entry in enumerate(meta)})
+        self.version = version
+        self._checked_at = time.monotonic()
+        logging.info(f"Loaded {len(meta)} vectors from {self.table_name} into memory")
+
+    def _load_snapshot(self):
+        version = self._corpus_version()
+        path = snapshot_path(self.snapshot_dir, self.table_name)
+        quantized = self.quantization == 'int8'
+
+        def stale(snapshot):
+            return (snapshot is None or snapshot.version != version
+                    or (quantized and snapshot.codes is None and len(snapshot.metadata) > 0))
+
+        snapshot = open_snapshot(path)
+        if stale(snapshot):
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            with rebuild_lock(path):
+                # Another worker may have rebuilt it while this one waited for the lock
+                snapshot = open_snapshot(path)
+                if stale(snapshot):
+                    matrix, norms, meta = self._fetch()
+                    quantizer = Int8Quantizer.fit(matrix) if quantized and matrix.size else None
+                    write_snapshot(path, version, matrix, norms, meta,
+                                   quantizer.encode(matrix) if quantizer else None,
+                                   quantizer.scales if quantizer else None)
+                    snapshot = open_snapshot(path)
+        # Positions are built from the metadata only when an upsert or delete needs them
+        quantizer = Int8Quantizer(snapshot.scales) if quantized and snapshot.codes is not None else None
+        if quantizer:
+            self._use(SnapshotRows(snapshot), snapshot.metadata, None, quantizer, snapshot.codes)
+        else:
+            self._use(snapshot.matrix, snapshot.metadata, None)
+        self.version = snapshot.version
+        self._checked_at = time.monotonic()
+        logging.info(f"Mapped {len(snapshot.metadata)} vectors of {self.table_name} from {path}")
+
+    def _use(self, matrix, meta, positions, quantizer=None, codes=None):
+        with self._lock:
+            self._matrix = matrix
+            self._meta = meta
+            self._positions = positions
+            self._quantizer = quantizer
+            self._codes = codes
+            self._router = None
+            self._loaded = True
+
+    def _position_map(self):
+        # Call with self._lock held
+        if self._positions is None:
+            self._positions = {entry['chunk_id']: i for i, entry in enumerate(self._meta)}
+        return self._positions
+
+    def video_router(self):
+        """Per-video centroids of the loaded rows, built on first use and kept current by upsert and remove."""
+        self.ensure_loaded()
+        with self._lock:
+            if self._router is None and self._matrix.size:
+                self._router = VideoRouter.build(self._matrix, [entry['title'] for entry in self._meta])
+            return self._router
+
+    def _fetch(self):
+        """Read and decode the table: (normalized matrix, original norms, metadata list)."""
+        column = vector_column()
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    SELECT id, {column} AS vector, text, title, url, chunk_id
+                    FROM {self.table_name}
+                    WHERE {column} IS NOT NULL
+                """)
+                rows = cur.fetchall()
+
+        vectors = []
+        meta = []
+        dimension = None
+        for row in rows:
+            try:
+                vector = decode_vector(row['vector'])
+            except Exception as e:
+                logging.error(f"Error processing vector for row {row['id']}: {str(e)}")
+                continue
+            if dimension is None:
+                dimension = len(vector)
+            if len(vector) != dimension:
+                logging.error(f"Skipping row {row['id']}: vector has {len(vector)} dimensions, expected {dimension}")
+                continue
+            vectors.append(vector)
+            meta.append(self._metadata(row))
+
+        matrix = np.vstack(vectors).astype(np.float32) if vectors else np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1).astype(np.float32) if vectors else np.zeros(0, dtype=np.float32)
+        matrix = np.ascontiguousarray(normalize_rows(matrix), dtype=np.float32)
+        metrics.count('index_load', 'rows_scanned', len(rows))
+        return matrix, norms, meta
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            # Concurrent first searches wait for one load instead of each fetching the table
+            with self._load_lock:
+                if not self._loaded:
+                    self.load()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+    def upsert(self, records):
+        """
+        Insert or replace chunks in place, keyed by chunk_id. Each record needs
+        id, text, title, url, chunk_id and vector (list or array).
+        """
+        if not self._loaded:
+            # Nothing resident yet; the next search loads the fresh table.
+            return
+        with self._lock:
+            matrix = self._matrix
+            meta = list(self._meta)
+            positions = dict(self._position_map())
+            new_rows = []
+            new_titles = []
+            replaced = {}
+            for record in records:
+                vector = np.asarray(record['vector'], dtype=np.float32)
+                if matrix.size and len(vector) != matrix.shape[1]:
+                    logging.error(f"Skipping chunk {record['chunk_id']}: dimension mismatch")
+                    continue
+                entry = self._metadata(record)
+                if entry['chunk_id'] in positions:
+                    position = positions[entry['chunk_id']]
+                    meta[position] = entry
+                    replaced[position] = vector
+                else:
+                    positions[entry['chunk_id']] = len(meta)
+                    meta.append(entry)
+                    new_rows.append(vector)
+                    new_titles.append(entry['title'])
+
+            replaced = {position: normalize_rows(vector[None, :])[0] for position, vector in replaced.items()}
+            appended = normalize_rows(np.vstack(new_rows).astype(np.float32)) if new_rows else np.zeros((0, 0))
+
+            router = self._router.copy() if self._router is not None and (replaced or new_rows) else self._router
+            if router is not None:
+                for position, vector in replaced.items():
+                    router.replace(self._meta[position]['title'], matrix[position], vector)
+                for offset, (title, vector) in enumerate(zip(new_titles, appended)):
+                    router.add(len(matrix) + offset, title, vector)
+
+            codes = self._codes
+            if codes is not None:
+                # Changed rows reuse the fitted scales; values past them are clipped
+                codes = codes.copy() if replaced else codes
+                for position, vector in replaced.items():
+                    codes[position] = self._quantizer.encode(vector[None, :])[0]
+                if new_rows:
+                    codes = np.vstack([codes, self._quantizer.encode(appended)])
+
+            if isinstance(matrix, SnapshotRows):
+                matrix = matrix.updated(replaced, appended)
+            else:
+                matrix = matrix.copy() if replaced else matrix
+                for position, vector in replaced.items():
+                    matrix[position] = vector
+                if new_rows:
+                    matrix = appended if not matrix.size else np.vstack([matrix, appended])
+                matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+            self._matrix = matrix
+            self._codes = codes
+            self._router = router
+            self._meta = meta
+            self._positions = positions
+
+    def remove(self, chunk_ids):
+        """Drop chunks deleted from the table, keyed by chunk_id."""
+        if not self._loaded:
+            return
+        with self._lock:
+            positions = self._position_map()
+            dropped = {positions[chunk_id] for chunk_id in chunk_ids if chunk_id in positions}
+            if not dropped:
+                return
+            keep = [i for i in range(len(self._meta)) if i not in dropped]
+            if self._router is not None:
+                router = self._router.copy()
+                router.remove({position: self._matrix[position] for position in dropped}, len(self._meta))
+                self._router = router
+            if isinstance(self._matrix, SnapshotRows):
+                self._matrix = self._matrix.select(keep)
+            else:
+                self._matrix = np.ascontiguousarray(self._matrix[keep], dtype=np.float32)
+            if self._codes is not None:
+                self._codes = self._codes[keep]
+            self._meta = [self._meta[i] for i in keep]
+            self._positions = {entry['chunk_id']: i for i, entry in enumerate(self._meta)}
+
+    def search(self, query_embedding, top_k=5, rerank=None, nprobe=None):
+        self.ensure_loaded()
+        self._check_version()
+        nprobe = self.nprobe if nprobe is None else nprobe
+        if nprobe:
+            self.video_router()
+        with self._lock:
+            matrix = self._matrix
+            meta = self._meta
+            quantizer = self._quantizer
+            codes = self._codes
+            router = self._router if nprobe else None
+
+        if not meta:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if len(query) != matrix.shape[1]:
+            logging.error(f"Query has {len(query)} dimensions, index has {matrix.shape[1]}")
+            return []
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+        rerank = max(self.rerank if rerank is None else rerank, top_k)
+        with metrics.stage('scoring'):
+            shortlist = None
+            if router is not None and nprobe < len(router):
+                shortlist = router.candidates(query, nprobe)
+            scanned = len(meta) if shortlist is None else len(shortlist)
+            if codes is not None and rerank < scanned:
+                # Rank the rows on their int8 codes, then read and re-score the best exactly;
+                # sorted so the snapshot file is read front to back
+                subset = codes if shortlist is None else codes[shortlist]
+                best = np.sort(np.argpartition(-quantizer.scores(subset, query), rerank - 1)[:rerank])
+                shortlist = best if shortlist is None else shortlist[best]
+            elif codes is not None and shortlist is None:
+                # Float rows are only ever read for a shortlist; here it is every row
+                shortlist = np.arange(scanned)
+            scores = matrix @ query if shortlist is None else matrix[shortlist] @ query
+
+            k = min(top_k, len(scores))
+            if k < len(scores):
+                candidates = np.argpartition(-scores, k - 1)[:k]
+            else:
+                candidates = np.arange(len(scores))
+            top = candidates[np.argsort(-scores[candidates], kind='stable')]
+        metrics.count('scoring', 'rows_scanned', scanned)
+
+        rows = shortlist[top] if shortlist is not None else top
+        return [
+            dict(meta[row], similarity_score=float(scores[i]))
+            for i, row in zip(top, rows)
+        ]
+
+    def _check_version(self):
+        """Look for a newer corpus version in the background every check_seconds."""
+        if time.monotonic() - self._checked_at < self.check_seconds:
+            return
+        with self._lock:
+            if self._checking:
+                return
+            self._checking = True
+            self._checked_at = time.monotonic()
+        threading.Thread(target=self._refresh, name=f"index-check-{self.table_name}", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            version = self._corpus_version()
+            if version != self.version:
+                logging.info(f"{self.table_name} changed ({self.version} -> {version}); reloading the index")
+                with self._load_lock:
+                    self.load()
+        except Exception as e:
+            logging.error(f"Error checking the corpus version of {self.table_name}: {str(e)}")
+        finally:
+            with self._lock:
+                self._checking = False
+
+    def _corpus_version(self):
+        ensure_version_table(self._connection)
+        with self._connection() as conn:
+            return corpus_version(conn, self.table_name)
+
+    @staticmethod
+    def _metadata(row):
+        return {
+            'id': row['id'],
+            'text': row['text'],
+            'title': row['title'],
+            'url': row['url'],
+            'chunk_id': row['chunk_id']
+        }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_vector_index(table_name, connection):
+    with _indexes_lock:
+        if table_name not in _indexes:
+            _indexes[table_name] = VectorIndex(table_name, connection)
+        return _indexes[table_name]
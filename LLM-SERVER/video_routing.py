@@ -0,0 +1,183 @@
+"""
+Coarse routing for the resident vector index: chunks are grouped by video
+(title) and each video keeps the centroid of its chunk vectors. A routed
+search scores the centroids first and then only the chunks of the nprobe
+closest videos, IVF-style. The report
+
+    python video_routing.py --table bents --queries 200
+
+prints recall@5 against exact search, latency and chunks scored for
+several nprobe settings.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+# Videos whose chunks are scored per query; 0 scores every chunk
+VIDEO_NPROBE = int(os.getenv("VIDEO_NPROBE", "0"))
+
+
+class VideoRouter:
+    """
+    Per-video centroids over a row-aligned matrix of normalized vectors.
+    Updates go through copy(), so a search holding the previous router is
+    never affected by an upsert or delete running at the same time.
+    """
+
+    def __init__(self, dimension):
+        self._titles = []
+        self._rows = {}
+        self._groups = {}
+        self._sums = np.zeros((0, dimension), dtype=np.float32)
+        self._centroids = None
+
+    @classmethod
+    def build(cls, matrix, titles):
+        router = cls(matrix.shape[1])
+        positions = {}
+        for position, title in enumerate(titles):
+            positions.setdefault(title, []).append(position)
+        router._titles = list(positions)
+        router._rows = {title: row for row, title in enumerate(router._titles)}
+        router._groups = positions
+        router._sums = np.zeros((len(positions), matrix.shape[1]), dtype=np.float32)
+        for row, title in enumerate(router._titles):
+            router._sums[row] = matrix[positions[title]].sum(axis=0)
+        return router
+
+    def __len__(self):
+        return len(self._titles)
+
+    def copy(self):
+        router = VideoRouter(self._sums.shape[1])
+        router._titles = list(self._titles)
+        router._rows = dict(self._rows)
+        router._groups = dict(self._groups)
+        router._sums = self._sums.copy()
+        return router
+
+    def add(self, position, title, vector):
+        if title not in self._rows:
+            self._rows[title] = len(self._titles)
+            self._titles.append(title)
+            self._groups[title] = []
+            self._sums = np.vstack([self._sums, np.zeros((1, self._sums.shape[1]), dtype=np.float32)])
+        # Lists are replaced rather than appended to, since copies share them
+        self._groups[title] = self._groups[title] + [position]
+        self._sums[self._rows[title]] += vector
+        self._centroids = None
+
+    def replace(self, title, old_vector, new_vector):
+        self._sums[self._rows[title]] += new_vector - old_vector
+        self._centroids = None
+
+    def remove(self, dropped, size):
+        """
+        Drop rows from a matrix of size rows; dropped maps each removed
+        position to its vector. Remaining positions shift down to match the
+        compacted matrix.
+        """
+        kept = np.ones(size, dtype=bool)
+        kept[list(dropped)] = False
+        moved = np.cumsum(kept) - 1
+        groups = {}
+        for title, positions in self._groups.items():
+            for position in positions:
+                if position in dropped:
+                    self._sums[self._rows[title]] -= dropped[position]
+            remaining = [int(moved[position]) for position in positions if position not in dropped]
+            if remaining:
+                groups[title] = remaining
+        self._titles = [title for title in self._titles if title in groups]
+        self._sums = self._sums[[self._rows[title] for title in self._titles]]
+        self._rows = {title: row for row, title in enumerate(self._titles)}
+        self._groups = groups
+        self._centroids = None
+
+    def candidates(self, query, nprobe):
+        """Sorted positions of the chunks of the nprobe videos closest to query."""
+        centroids = self._centroids
+        if centroids is None:
+            norms = np.linalg.norm(self._sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = self._centroids = self._sums / norms
+        scores = centroids @ query
+        closest = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self._groups[self._titles[row]] for row in closest]))
+
+
+def recall_report(index, queries, top_k=5, nprobes=(1, 2, 4, 8, 16, 32, 64, 128, 256)):
+    """
+    recall@top_k of routed search against exact search over the same index,
+    with mean latency and mean chunks scored per nprobe.
+    """
+    index.ensure_loaded()
+    matrix = index._matrix
+    queries = np.asarray(queries, dtype=np.float32)
+    exact = []
+    # Touch the whole matrix once so the exact baseline is not charged for page faults
+    matrix @ (queries[0] / np.linalg.norm(queries[0]))
+    started = time.perf_counter()
+    for query in queries:
+        scores = matrix @ (query / np.linalg.norm(query))
+        exact.append(set(np.argpartition(-scores, top_k - 1)[:top_k].tolist()))
+    report = [{
+        'nprobe': None,
+        'recall': 1.0,
+        'mean_ms': (time.perf_counter() - started) * 1000 / len(queries),
+        'mean_chunks': len(matrix)
+    }]
+
+    router = index.video_router()
+    positions = {entry['chunk_id']: i for i, entry in enumerate(index._meta)}
+    for nprobe in nprobes:
+        if nprobe >= len(router):
+            break
+        hits = 0
+        scanned = 0
+        started = time.perf_counter()
+        for query, expected in zip(queries, exact):
+            found = index.search(query, top_k, nprobe=nprobe)
+            hits += len(expected & {positions[result['chunk_id']] for result in found})
+        elapsed = time.perf_counter() - started
+        for query in queries:
+            scanned += len(router.candidates(query / np.linalg.norm(query), nprobe))
+        report.append({
+            'nprobe': nprobe,
+            'recall': hits / (top_k * len(queries)),
+            'mean_ms': elapsed * 1000 / len(queries),
+            'mean_chunks': scanned / len(queries)
+        })
+    return report
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    import db_pool
+    from vector_index import VectorIndex
+
+    parser = argparse.ArgumentParser(description="Recall and latency of per-video routed retrieval")
+    parser.add_argument("--table", default="bents")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.5,
+                        help="Queries are stored vectors plus Gaussian noise of this norm")
+    args = parser.parse_args()
+
+    index = VectorIndex(args.table, db_pool.connection, quantization='none')
+    index.load()
+    rng = np.random.default_rng(0)
+    samples = index._matrix[rng.choice(len(index), size=min(args.queries, len(index)), replace=False)]
+    noise = rng.standard_normal(samples.shape).astype(np.float32)
+    queries = samples + args.noise * noise / np.linalg.norm(noise, axis=1, keepdims=True)
+
+    print(f"{len(index)} chunks in {len(index.video_router())} videos")
+    print(f"{'nprobe':>8} {'recall@' + str(args.top_k):>10} {'mean ms':>9} {'chunks':>9}")
+    for row in recall_report(index, queries, args.top_k):
+        print(f"{'exact' if row['nprobe'] is None else row['nprobe']:>8} {row['recall']:10.3f} "
+              f"{row['mean_ms']:9.2f} {row['mean_chunks']:9.0f}")
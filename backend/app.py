@@ -13,8 +13,8 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 import langsmith
 from flask_cors import CORS
-import psycopg2
 from psycopg2.extras import RealDictCursor
+import db_pool
 import base64
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 import time
@@ -22,6 +22,9 @@ import json
 import numpy as np
 from typing import List
 from pydantic import BaseModel, Field
+from vector_index import (
+    bump_version, decode_vector, ensure_version_table, get_vector_index, storage_value, vector_column
+)
 
 class LLMResponseError(Exception):
     pass
@@ -79,6 +82,11 @@ llm = ChatOpenAI(openai_api_key=OPENAI_API_KEY, model="gpt-4o-2024-11-20", tempe
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Serve similarity search from the resident in-memory index instead of scanning the table per query
+USE_VECTOR_INDEX = os.getenv("USE_VECTOR_INDEX", "true").lower() == "true"
+# Chunks sent to OpenAI per embed_documents call during an upload
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
 def rewrite_query(query, chat_history=None):
     """
     Rewrites the user query to be more specific and searchable using LLM.
@@ -112,18 +120,17 @@ def rewrite_query(query, chat_history=None):
 def get_matched_products(video_title):
     logging.debug(f"Attempting to get matched products for title: {video_title}")
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query = """
-                SELECT id, title, tags, link FROM products 
-                WHERE LOWER(tags) LIKE LOWER(%s)
-            """
-            search_term = f"%{video_title}%"
-            logging.debug(f"Executing SQL query: {query} with search term: {search_term}")
-            cur.execute(query, (search_term,))
-            matched_products = cur.fetchall()
-            logging.debug(f"Raw matched products from database: {matched_products}")
-        conn.close()
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                query = """
+                    SELECT id, title, tags, link FROM products 
+                    WHERE LOWER(tags) LIKE LOWER(%s)
+                """
+                search_term = f"%{video_title}%"
+                logging.debug(f"Executing SQL query: {query} with search term: {search_term}")
+                cur.execute(query, (search_term,))
+                matched_products = cur.fetchall()
+                logging.debug(f"Raw matched products from database: {matched_products}")
 
         related_products = [
             {
@@ -142,16 +149,15 @@ def get_matched_products(video_title):
         return []
 def verify_database():
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT COUNT(*) FROM products")
-            count = cur.fetchone()['count']
-            logging.info(f"Total products in database: {count}")
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT COUNT(*) FROM products")
+                count = cur.fetchone()['count']
+                logging.info(f"Total products in database: {count}")
             
-            cur.execute("SELECT title FROM products LIMIT 5")
-            sample_titles = [row['title'] for row in cur.fetchall()]
-            logging.info(f"Sample product titles: {sample_titles}")
-        conn.close()
+                cur.execute("SELECT title FROM products LIMIT 5")
+                sample_titles = [row['title'] for row in cur.fetchall()]
+                logging.info(f"Sample product titles: {sample_titles}")
         return True
     except Exception as e:
         logging.error(f"Database verification failed: {str(e)}", exc_info=True)
@@ -262,37 +268,55 @@ def extract_metadata_from_text(text):
     title = text.split('\n')[0] if text else "Untitled Video"
     return {"title": title}
 
+def embed_chunks(chunks):
+    """Embed chunks with one embed_documents call per EMBED_BATCH_SIZE chunks instead of one call each."""
+    vectors = []
+    for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+        vectors.extend(embeddings.embed_documents(chunks[start:start + EMBED_BATCH_SIZE]))
+    return vectors
+
 def upsert_transcript(transcript_text, metadata, index_name):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     chunks = text_splitter.split_text(transcript_text)
     
+    column = vector_column()
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            for i, chunk in enumerate(chunks):
-                chunk_metadata = metadata.copy()
-                chunk_metadata['chunk_id'] = f"{metadata['title']}_chunk_{i}"
-                chunk_metadata['url'] = metadata.get('url', '')
-                chunk_metadata['title'] = metadata.get('title', 'Unknown Video')
-                
-                # Generate embeddings for the chunk
-                chunk_embedding = embeddings.embed_query(chunk)
+        # Embed before taking a pooled connection, so none is held across the OpenAI calls
+        chunk_embeddings = embed_chunks(chunks)
+        ensure_version_table(db_pool.connection)
+        with db_pool.connection() as conn:
+            records = []
+            with conn.cursor() as cur:
+                for i, (chunk, chunk_embedding) in enumerate(zip(chunks, chunk_embeddings)):
+                    chunk_metadata = metadata.copy()
+                    chunk_metadata['chunk_id'] = f"{metadata['title']}_chunk_{i}"
+                    chunk_metadata['url'] = metadata.get('url', '')
+                    chunk_metadata['title'] = metadata.get('title', 'Unknown Video')
                 
-                # Insert into bents table
-                cur.execute("""
-                    INSERT INTO bents (text, title, url, chunk_id, vector)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON CONFLICT (chunk_id) DO UPDATE
-                    SET text = EXCLUDED.text, vector = EXCLUDED.vector
-                """, (chunk, chunk_metadata['title'], chunk_metadata['url'], 
-                      chunk_metadata['chunk_id'], str(chunk_embedding)))
-        conn.commit()
+                    # Insert into bents table
+                    cur.execute(f"""
+                        INSERT INTO bents (text, title, url, chunk_id, {column})
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (chunk_id) DO UPDATE
+                        SET text = EXCLUDED.text, {column} = EXCLUDED.{column}
+                        RETURNING id, title, url
+                    """, (chunk, chunk_metadata['title'], chunk_metadata['url'], 
+                          chunk_metadata['chunk_id'], storage_value(chunk_embedding)))
+                    row_id, title, url = cur.fetchone()
+                    records.append({
+                        'id': row_id,
+                        'text': chunk,
+                        'title': title,
+                        'url': url,
+                        'chunk_id': chunk_metadata['chunk_id'],
+                        'vector': chunk_embedding
+                    })
+            bump_version(conn, "bents")
+            conn.commit()
+        get_vector_index("bents", db_pool.connection).upsert(records)
     except Exception as e:
         logging.error(f"Error upserting transcript: {str(e)}")
         raise
-    finally:
-        if conn:
-            conn.close()
 
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_exception_type(LLMResponseError))
 def retry_llm_call(qa_chain, query, chat_history):
@@ -312,9 +336,6 @@ def retry_llm_call(qa_chain, query, chat_history):
         logging.error(f"Unexpected error in LLM call: {str(e)}")
         raise LLMNoResponseError("LLM failed due to an unexpected error")
 
-def connect_to_db():
-    return psycopg2.connect(os.getenv("POSTGRES_URL"))
-
 def get_embeddings(query):
     try:
         return embeddings.embed_query(query)
@@ -325,53 +346,57 @@ def get_embeddings(query):
 def cosine_similarity(v1, v2):
     return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
 
-def search_neon_db(query_embedding, table_name, top_k=5):
-    conn = None
+def search_neon_db(query_embedding, table_name="bents", top_k=5):
+    if USE_VECTOR_INDEX:
+        try:
+            return get_vector_index(table_name, db_pool.connection).search(query_embedding, top_k)
+        except Exception as e:
+            logging.error(f"Error in search_neon_db: {str(e)}")
+            raise
+    return scan_neon_db(query_embedding, table_name, top_k)
+
+def scan_neon_db(query_embedding, table_name="bents", top_k=5):
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Query with table name as parameter
-            query = f"""
-                SELECT id, vector, text, title, url, chunk_id 
-                FROM {table_name}
-                WHERE vector IS NOT NULL
-            """
-            cur.execute(query)
-            rows = cur.fetchall()
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Query with table name as parameter
+                column = vector_column()
+                query = f"""
+                    SELECT id, {column} AS vector, text, title, url, chunk_id 
+                    FROM {table_name}
+                    WHERE {column} IS NOT NULL
+                """
+                cur.execute(query)
+                rows = cur.fetchall()
             
-            similarities = []
-            for row in rows:
-                try:
-                    vector_str = row['vector']
-                    vector_values = vector_str.strip('[]').split(',')
-                    vector = np.array([float(x.strip()) for x in vector_values])
+                similarities = []
+                for row in rows:
+                    try:
+                        vector = decode_vector(row['vector'])
                     
-                    if len(vector) == len(query_embedding):
-                        similarity = cosine_similarity(query_embedding, vector)
-                        similarities.append((similarity, row))
-                except Exception as e:
-                    logging.error(f"Error processing vector for row {row['id']}: {str(e)}")
-                    continue
+                        if len(vector) == len(query_embedding):
+                            similarity = cosine_similarity(query_embedding, vector)
+                            similarities.append((similarity, row))
+                    except Exception as e:
+                        logging.error(f"Error processing vector for row {row['id']}: {str(e)}")
+                        continue
             
-            similarities.sort(reverse=True, key=lambda x: x[0])
-            return [
-                {
-                    'id': row['id'],
-                    'text': row['text'],
-                    'title': row['title'],
-                    'url': row['url'],
-                    'chunk_id': row['chunk_id'],
-                    'similarity_score': float(sim)
-                }
-                for sim, row in similarities[:top_k]
-            ]
+                similarities.sort(reverse=True, key=lambda x: x[0])
+                return [
+                    {
+                        'id': row['id'],
+                        'text': row['text'],
+                        'title': row['title'],
+                        'url': row['url'],
+                        'chunk_id': row['chunk_id'],
+                        'similarity_score': float(sim)
+                    }
+                    for sim, row in similarities[:top_k]
+                ]
 
     except Exception as e:
-        logging.error(f"Error in search_neon_db: {str(e)}")
+        logging.error(f"Error in scan_neon_db: {str(e)}")
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def handle_query(query):
     query_embedding = get_embeddings(query)
@@ -596,14 +621,17 @@ def get_user_data(user_id):
         logging.error(f"Error fetching user data: {str(e)}", exc_info=True)
         return jsonify({'error': 'An error occurred fetching user data'}), 500
 
+@app.route('/pool_stats', methods=['GET'])
+def pool_stats():
+    return jsonify(db_pool.get_pool().stats())
+
 @app.route('/documents')
 def get_documents():
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM products")
-            documents = cur.fetchall()
-        conn.close()
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM products")
+                documents = cur.fetchall()
         return jsonify(documents)
     except Exception as e:
         print(f"Error in get_documents: {str(e)}")
@@ -613,15 +641,16 @@ def get_documents():
 def add_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "INSERT INTO products (title, tags, link) VALUES (%s, %s, %s) RETURNING id",
-                (data['title'], ','.join(data['tags']), data['link'])
-            )
-            product_id = cur.fetchone()['id']
-        conn.commit()
-        conn.close()
+        ensure_version_table(db_pool.connection)
+        with db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "INSERT INTO products (title, tags, link) VALUES (%s, %s, %s) RETURNING id",
+                    (data['title'], ','.join(data['tags']), data['link'])
+                )
+                product_id = cur.fetchone()['id']
+            bump_version(conn, 'products')
+            conn.commit()
         return jsonify({'success': True, 'product_id': product_id})
     except Exception as e:
         print(f"Error in add_document: {str(e)}")
@@ -631,11 +660,12 @@ def add_document():
 def delete_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM products WHERE id = %s", (data['id'],))
-        conn.commit()
-        conn.close()
+        ensure_version_table(db_pool.connection)
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM products WHERE id = %s", (data['id'],))
+            bump_version(conn, 'products')
+            conn.commit()
         return jsonify({'success': True})
     except Exception as e:
         print(f"Error in delete_document: {str(e)}")
@@ -645,14 +675,15 @@ def delete_document():
 def update_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE products SET title = %s, tags = %s, link = %s WHERE id = %s",
-                (data['title'], ','.join(data['tags']), data['link'], data['id'])
-            )
-        conn.commit()
-        conn.close()
+        ensure_version_table(db_pool.connection)
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE products SET title = %s, tags = %s, link = %s WHERE id = %s",
+                    (data['title'], ','.join(data['tags']), data['link'], data['id'])
+                )
+            bump_version(conn, 'products')
+            conn.commit()
         return jsonify({'success': True})
     except Exception as e:
         print(f"Error in update_document: {str(e)}")
@@ -707,27 +738,40 @@ def upload_document():
             text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
             chunks = text_splitter.split_text(transcript_text)
             
-            conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-            with conn.cursor() as cur:
-                for i, chunk in enumerate(chunks):
-                    chunk_embedding = embeddings.embed_query(chunk)
-                    chunk_id = f"{metadata['title']}_chunk_{i}"
+            column = vector_column()
+            chunk_embeddings = embed_chunks(chunks)
+            ensure_version_table(db_pool.connection)
+            with db_pool.connection() as conn:
+                records = []
+                with conn.cursor() as cur:
+                    for i, (chunk, chunk_embedding) in enumerate(zip(chunks, chunk_embeddings)):
+                        chunk_id = f"{metadata['title']}_chunk_{i}"
                     
-                    cur.execute(f"""
-                        INSERT INTO {table_name} (text, title, url, chunk_id, vector)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (chunk_id) DO UPDATE
-                        SET text = EXCLUDED.text, vector = EXCLUDED.vector
-                    """, (
-                        chunk,
-                        metadata.get('title', 'Unknown Video'),
-                        metadata.get('url', ''),
-                        chunk_id,
-                        str(chunk_embedding)
-                    ))
-            
-            conn.commit()
-            conn.close()
+                        cur.execute(f"""
+                            INSERT INTO {table_name} (text, title, url, chunk_id, {column})
+                            VALUES (%s, %s, %s, %s, %s)
+                            ON CONFLICT (chunk_id) DO UPDATE
+                            SET text = EXCLUDED.text, {column} = EXCLUDED.{column}
+                            RETURNING id, title, url
+                        """, (
+                            chunk,
+                            metadata.get('title', 'Unknown Video'),
+                            metadata.get('url', ''),
+                            chunk_id,
+                            storage_value(chunk_embedding)
+                        ))
+                        row_id, title, url = cur.fetchone()
+                        records.append({
+                            'id': row_id,
+                            'text': chunk,
+                            'title': title,
+                            'url': url,
+                            'chunk_id': chunk_id,
+                            'vector': chunk_embedding
+                        })
+                bump_version(conn, table_name)
+                conn.commit()
+            get_vector_index(table_name, db_pool.connection).upsert(records)
             os.remove(file_path)
             
             return jsonify({'success': True, 'message': 'File uploaded and processed successfully'})
@@ -122,6 +122,34 @@ app.post('/chat', async (req, res) => {
   }
 });
 
+// Product writes bump corpus_versions.products in the same transaction, so the Flask
+// servers' product index and answer cache notice edits made here
+let versionTableReady = false;
+async function writeProducts(write) {
+  if (!versionTableReady) {
+    await pool.query(
+      'CREATE TABLE IF NOT EXISTS corpus_versions (table_name text PRIMARY KEY, version bigint NOT NULL)'
+    );
+    versionTableReady = true;
+  }
+  const client = await pool.connect();
+  try {
+    await client.query('BEGIN');
+    const result = await write(client);
+    await client.query(
+      `INSERT INTO corpus_versions (table_name, version) VALUES ('products', 1)
+       ON CONFLICT (table_name) DO UPDATE SET version = corpus_versions.version + 1`
+    );
+    await client.query('COMMIT');
+    return result;
+  } catch (error) {
+    await client.query('ROLLBACK');
+    throw error;
+  } finally {
+    client.release();
+  }
+}
+
 app.get('/documents', async (req, res) => {
   try {
     const { rows } = await pool.query('SELECT * FROM products');
@@ -135,10 +163,10 @@ app.get('/documents', async (req, res) => {
 app.post('/add_document', async (req, res) => {
   try {
     const { title, tags, link, image_url } = req.body;
-    const { rows } = await pool.query(
+    const { rows } = await writeProducts(client => client.query(
       'INSERT INTO products (id, title, tags, link, image_url) VALUES (uuid_generate_v4(), $1, $2, $3, $4) RETURNING *',
       [title, tags, link, image_url]
-    );
+    ));
     res.json(rows[0]);
   } catch (error) {
     console.error('Error adding document:', error);
@@ -149,7 +177,7 @@ app.post('/add_document', async (req, res) => {
 app.post('/delete_document', async (req, res) => {
   try {
     const { id } = req.body;
-    await pool.query('DELETE FROM products WHERE id = $1', [id]);
+    await writeProducts(client => client.query('DELETE FROM products WHERE id = $1', [id]));
     res.json({ success: true });
   } catch (error) {
     console.error('Error deleting document:', error);
@@ -160,10 +188,10 @@ app.post('/delete_document', async (req, res) => {
 app.post('/update_document', async (req, res) => {
   try {
     const { id, title, tags, link } = req.body;
-    await pool.query(
+    await writeProducts(client => client.query(
       'UPDATE products SET title = $2, tags = $3, link = $4 WHERE id = $1',
       [id, title, tags, link]
-    );
+    ));
     res.json({ success: true });
   } catch (error) {
     console.error('Error updating document:', error);
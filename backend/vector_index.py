@@ -0,0 +1,317 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from psycopg2 import Binary
+from psycopg2.extras import RealDictCursor
+
+# How embeddings are written: 'text' keeps the stringified list in bents.vector,
+# 'float32' / 'float16' write raw little-endian bytes to the bents.vector_bin bytea column
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "text")
+
+# Binary vectors carry a 4-byte format tag so float32 and float16 rows can coexist
+# and the payload stays 4-byte aligned for np.frombuffer
+BINARY_FORMATS = {
+    'float32': (b'F32\x00', np.dtype('<f4')),
+    'float16': (b'F16\x00', np.dtype('<f2')),
+}
+BINARY_TAGS = {tag: dtype for tag, dtype in BINARY_FORMATS.values()}
+TAG_SIZE = 4
+
+# Seconds between checks of whether another process has changed a table behind the loaded index
+VECTOR_INDEX_CHECK_SECONDS = float(os.getenv("VECTOR_INDEX_CHECK_SECONDS", "30"))
+
+_version_table_ready = threading.Event()
+
+
+def parse_vector(value):
+    """Parse a stored vector ('[0.1, 0.2, ...]') into a float32 array."""
+    return np.array(value.strip('[]').split(','), dtype=np.float32)
+
+
+def encode_vector(vector, storage=None):
+    storage = storage or VECTOR_STORAGE
+    if storage == 'text':
+        return str([float(x) for x in vector])
+    tag, dtype = BINARY_FORMATS[storage]
+    return tag + np.asarray(vector, dtype=dtype).tobytes()
+
+
+def decode_vector(value):
+    """
+    Decode a stored vector. Binary values are wrapped with np.frombuffer, so the
+    returned array is a read-only view over the driver's buffer, not a copy.
+    Text values fall back to parse_vector.
+    """
+    if isinstance(value, str):
+        return parse_vector(value)
+    buffer = memoryview(value)
+    tag = bytes(buffer[:TAG_SIZE])
+    if tag not in BINARY_TAGS:
+        raise ValueError(f"Unknown vector format tag: {tag!r}")
+    return np.frombuffer(buffer, dtype=BINARY_TAGS[tag], offset=TAG_SIZE)
+
+
+def vector_column(storage=None):
+    return 'vector' if (storage or VECTOR_STORAGE) == 'text' else 'vector_bin'
+
+
+def storage_value(vector, storage=None):
+    """The query parameter to write for the configured vector column."""
+    storage = storage or VECTOR_STORAGE
+    if storage == 'text':
+        return encode_vector(vector, storage)
+    return Binary(encode_vector(vector, storage))
+
+
+def ensure_version_table(connection):
+    """
+    Create corpus_versions on a connection of its own, so a caller's open
+    transaction is never committed halfway. Call it before bump_version or
+    corpus_version.
+    """
+    if _version_table_ready.is_set():
+        return
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS corpus_versions (
+                    table_name text PRIMARY KEY,
+                    version bigint NOT NULL
+                )
+            """)
+        conn.commit()
+    _version_table_ready.set()
+
+
+def bump_version(conn, table_name):
+    """Mark table_name as changed; call inside the transaction that writes or deletes its rows."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO corpus_versions (table_name, version) VALUES (%s, 1)
+            ON CONFLICT (table_name) DO UPDATE SET version = corpus_versions.version + 1
+        """, (table_name,))
+
+
+def corpus_version(conn, table_name):
+    """
+    Version of a chunk table: the ingest counter plus the row count, so rows
+    added or removed by writers that do not bump the counter are noticed too.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM corpus_versions WHERE table_name = %s", (table_name,))
+        row = cur.fetchone()
+        cur.execute(f"SELECT COUNT(*) FROM {table_name}")
+        count = cur.fetchone()[0]
+    return f"{row[0] if row else 0}:{count}"
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex:
+    """
+    Resident copy of a chunk table: a contiguous, pre-normalized float32 matrix
+    plus a parallel list of chunk metadata. Top-k is one matrix-vector product
+    followed by argpartition instead of a per-row Python loop.
+    """
+
+    def __init__(self, table_name, connection, check_seconds=VECTOR_INDEX_CHECK_SECONDS):
+        self.table_name = table_name
+        self._connection = connection
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        # Serializes loads, so concurrent first searches or refreshes fetch the table once
+        self._load_lock = threading.Lock()
+        self._matrix = None
+        self._meta = []
+        self._positions = {}
+        self._loaded = False
+        self.version = None
+        self._checked_at = time.monotonic()
+        self._checking = False
+
+    def __len__(self):
+        return len(self._meta)
+
+    @property
+    def dimension(self):
+        return self._matrix.shape[1] if self._matrix is not None and self._matrix.size else None
+
+    def load(self):
+        column = vector_column()
+        # Read before the rows, so a write landing in between is picked up by the next check
+        version = self._corpus_version()
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    SELECT id, {column} AS vector, text, title, url, chunk_id
+                    FROM {self.table_name}
+                    WHERE {column} IS NOT NULL
+                """)
+                rows = cur.fetchall()
+
+        vectors = []
+        meta = []
+        dimension = None
+        for row in rows:
+            try:
+                vector = decode_vector(row['vector'])
+            except Exception as e:
+                logging.error(f"Error processing vector for row {row['id']}: {str(e)}")
+                continue
+            if dimension is None:
+                dimension = len(vector)
+            if len(vector) != dimension:
+                logging.error(f"Skipping row {row['id']}: vector has {len(vector)} dimensions, expected {dimension}")
+                continue
+            vectors.append(vector)
+            meta.append(self._metadata(row))
+
+        matrix = np.vstack(vectors).astype(np.float32) if vectors else np.zeros((0, 0), dtype=np.float32)
+        matrix = np.ascontiguousarray(normalize_rows(matrix), dtype=np.float32)
+        with self._lock:
+            self._matrix = matrix
+            self._meta = meta
+            self._positions = {entry['chunk_id']: i for i, entry in enumerate(meta)}
+            self._loaded = True
+            self.version = version
+            self._checked_at = time.monotonic()
+        logging.info(f"Loaded {len(meta)} vectors from {self.table_name} into memory")
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            # Concurrent first searches wait for one load instead of each fetching the table
+            with self._load_lock:
+                if not self._loaded:
+                    self.load()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+    def upsert(self, records):
+        """
+        Insert or replace chunks in place, keyed by chunk_id. Each record needs
+        id, text, title, url, chunk_id and vector (list or array).
+        """
+        if not self._loaded:
+            # Nothing resident yet; the next search loads the fresh table.
+            return
+        with self._lock:
+            matrix = self._matrix
+            meta = list(self._meta)
+            positions = dict(self._positions)
+            new_rows = []
+            replaced = {}
+            for record in records:
+                vector = np.asarray(record['vector'], dtype=np.float32)
+                if matrix.size and len(vector) != matrix.shape[1]:
+                    logging.error(f"Skipping chunk {record['chunk_id']}: dimension mismatch")
+                    continue
+                entry = self._metadata(record)
+                if entry['chunk_id'] in positions:
+                    position = positions[entry['chunk_id']]
+                    meta[position] = entry
+                    replaced[position] = vector
+                else:
+                    positions[entry['chunk_id']] = len(meta)
+                    meta.append(entry)
+                    new_rows.append(vector)
+
+            matrix = matrix.copy() if replaced else matrix
+            for position, vector in replaced.items():
+                matrix[position] = normalize_rows(vector[None, :])[0]
+            if new_rows:
+                appended = normalize_rows(np.vstack(new_rows).astype(np.float32))
+                matrix = appended if not matrix.size else np.vstack([matrix, appended])
+
+            self._matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+            self._meta = meta
+            self._positions = positions
+
+    def search(self, query_embedding, top_k=5):
+        self.ensure_loaded()
+        self._check_version()
+        with self._lock:
+            matrix = self._matrix
+            meta = self._meta
+
+        if not meta:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if len(query) != matrix.shape[1]:
+            logging.error(f"Query has {len(query)} dimensions, index has {matrix.shape[1]}")
+            return []
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        scores = matrix @ (query / norm)
+
+        k = min(top_k, len(scores))
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(scores))
+        top = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        return [
+            dict(meta[i], similarity_score=float(scores[i]))
+            for i in top
+        ]
+
+    def _check_version(self):
+        """Look for a newer corpus version in the background every check_seconds."""
+        if time.monotonic() - self._checked_at < self.check_seconds:
+            return
+        with self._lock:
+            if self._checking:
+                return
+            self._checking = True
+            self._checked_at = time.monotonic()
+        threading.Thread(target=self._refresh, name=f"index-check-{self.table_name}", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            version = self._corpus_version()
+            if version != self.version:
+                logging.info(f"{self.table_name} changed ({self.version} -> {version}); reloading the index")
+                with self._load_lock:
+                    self.load()
+        except Exception as e:
+            logging.error(f"Error checking the corpus version of {self.table_name}: {str(e)}")
+        finally:
+            with self._lock:
+                self._checking = False
+
+    def _corpus_version(self):
+        ensure_version_table(self._connection)
+        with self._connection() as conn:
+            return corpus_version(conn, self.table_name)
+
+    @staticmethod
+    def _metadata(row):
+        return {
+            'id': row['id'],
+            'text': row['text'],
+            'title': row['title'],
+            'url': row['url'],
+            'chunk_id': row['chunk_id']
+        }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_vector_index(table_name, connection):
+    with _indexes_lock:
+        if table_name not in _indexes:
+            _indexes[table_name] = VectorIndex(table_name, connection)
+        return _indexes[table_name]